@@ -0,0 +1,20 @@
+import json
+import os
+from contextlib import contextmanager
+
+############# ESCRITA ATÔMICA DE ARQUIVOS DE ESTADO #############
+
+@contextmanager
+def escrita_atomica(caminho):
+    """Devolve o caminho temporário onde o bloco deve gravar; ao fim do bloco ele substitui `caminho`.
+
+    Se o bloco falhar, o arquivo anterior fica intacto (uma execução interrompida nunca deixa estado pela metade).
+    """
+    tmp_path = f"{caminho}.tmp"
+    yield tmp_path
+    os.replace(tmp_path, caminho)
+
+def salvar_json(caminho, dados):
+    """Salva `dados` como JSON em `caminho` (escrita atômica)."""
+    with escrita_atomica(caminho) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(dados, f)
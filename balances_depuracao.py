@@ -1,111 +1,508 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import time
 import pygsheets
 import pandas as pd
 from datetime import datetime
 import os
 import json
+import sqlite3
 from pathlib import Path
+from decimal import Decimal
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import select
+from sheets_writer import SheetWriter
+from metricas import metricas, METRICAS_PORTA
+import historico
+from historico import ArquivoHistorico
+from arquivos import salvar_json
+from conciliacao import (COLUNAS_EXCECOES, MAPA_CONTAS_MERCHANTS, agora_brasilia, conciliar, dia_brasilia,
+                         load_base_conciliacao, save_base_conciliacao)
 
 ############# CONFIGURAÇÃO DO GOOGLE SHEETS #############
 
-try:
-    print("Conectando ao Google Sheets...")
-    gc = pygsheets.authorize(service_file=os.getenv('GOOGLE_SHEETS_CREDS', 'controles.json'))
-    sh = gc.open('Daily Balance - Nox Pay')
+@metricas.cronometrado("sheets_chamada_segundos", operacao="conexao")
+def connect_sheets():
+    """Conecta ao Google Sheets e retorna a planilha e as abas usadas pelo loop."""
+    try:
+        print("Conectando ao Google Sheets...")
+        gc = pygsheets.authorize(service_file=os.getenv('GOOGLE_SHEETS_CREDS', 'controles.json'))
+        sh = gc.open('Daily Balance - Nox Pay')
 
-    # Conectando às abas
-    wks_JACI = sh.worksheet_by_title("DATABASE JACI")
-    print("✓ Conectado à aba DATABASE JACI")
-    
-    wks_backtxs = sh.worksheet_by_title("Backoffice Ajustes")
-    print("✓ Conectado à aba Backoffice Ajustes")
-    
-    wks_balances = sh.worksheet_by_title("jaci")
-    print("✓ Conectado à aba jaci")
-    
-    print("Conexão com Google Sheets estabelecida com sucesso!")
-except Exception as e:
-    print(f"Erro ao conectar ao Google Sheets: {e}")
-    raise
+        # Conectando às abas
+        wks_JACI = sh.worksheet_by_title("DATABASE JACI")
+        print("✓ Conectado à aba DATABASE JACI")
+        
+        wks_backtxs = sh.worksheet_by_title("Backoffice Ajustes")
+        print("✓ Conectado à aba Backoffice Ajustes")
+        
+        wks_balances = sh.worksheet_by_title("jaci")
+        print("✓ Conectado à aba jaci")
+        
+        print("Conexão com Google Sheets estabelecida com sucesso!")
+        return sh, wks_JACI, wks_backtxs, wks_balances
+    except Exception as e:
+        print(f"Erro ao conectar ao Google Sheets: {e}")
+        raise
+
+############# CONFIGURAÇÃO DO BANCO DE DADOS #############
+
+# Configurações do Banco de Dados
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASS'),
+    'database': os.getenv('DB_NAME'),
+    'port': int(os.getenv('DB_PORT', "5432"))
+}
+
+# Tamanho máximo do pool de conexões
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', "4"))
+
+# Espera após uma falha: dobra a cada falha seguida, até o máximo
+BACKOFF_INICIAL_SEGUNDOS = 5
+BACKOFF_MAXIMO_SEGUNDOS = 60
+
+class ConexaoPreparada(psycopg2.extensions.connection):
+    """Conexão que lembra quais prepared statements já foram criados nela."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+@metricas.cronometrado("db_conexao_segundos", etapa="pool")
+def criar_pool():
+    """Cria o pool de conexões persistentes com o banco."""
+    return psycopg2.pool.ThreadedConnectionPool(
+        1, DB_POOL_MAX, connection_factory=ConexaoPreparada, **DB_CONFIG
+    )
+
+@metricas.cronometrado("db_conexao_segundos", etapa="checkout")
+def obter_conexao(pool):
+    """Pega uma conexão do pool validada com SELECT 1, descartando as que caíram."""
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return conn
+        except psycopg2.Error as e:
+            print(f"Conexão do pool inválida ({e}), descartando...")
+            metricas.incrementar("db_conexoes_descartadas_total")
+            pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("Nenhuma conexão saudável disponível no pool")
+
+def executar_preparada(cursor, nome, query, params=()):
+    """Executa `query` como prepared statement do servidor, preparando-a na primeira vez em cada conexão.
+
+    Os parâmetros são escritos como %s na query; conexões fora do pool executam a query direto.
+    """
+    preparadas = getattr(cursor.connection, "preparadas", None)
+    if preparadas is None:
+        cursor.execute(query, params or None)
+        return
+
+    if nome not in preparadas:
+        partes = query.split("%s")
+        query_preparada = "".join(
+            parte + (f"${i + 1}" if i < len(partes) - 1 else "") for i, parte in enumerate(partes)
+        )
+        cursor.execute(f"PREPARE {nome} AS {query_preparada}")
+        preparadas.add(nome)
+
+    if params:
+        cursor.execute(f"EXECUTE {nome} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {nome}")
+
+############# AGREGAÇÃO INCREMENTAL DE PAGAMENTOS #############
+
+# Pagamentos gravados há menos que isso ficam para o próximo ciclo (commits atrasados)
+ATRASO_JANELA_SEGUNDOS = 30
+
+# A cada N ciclos completos (de 60 s) o dia inteiro é reagregado, pegando pagamentos que mudaram de
+# status depois de criados; medido pelo relógio, para os ciclos por evento não anteciparem a revarredura
+CICLOS_REVARREDURA = int(os.getenv('CICLOS_REVARREDURA_PAGAMENTOS', "15"))
+INTERVALO_REVARREDURA_SEGUNDOS = CICLOS_REVARREDURA * 60
+
+# Início do dia e da hora atuais em Brasília, no mesmo formato de core_payment.created_at_date
+INICIO_DIA_SQL = "(DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')"
+INICIO_HORA_SQL = "(DATE_TRUNC('hour', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')"
+
+# Limites da janela incremental; `ate` no mesmo formato (UTC sem fuso) de created_at_date e do início do dia
+QUERY_JANELA = f"""
+        SELECT
+            DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AS dia,
+            {INICIO_DIA_SQL} AS inicio_dia,
+            (NOW() - %s::int * INTERVAL '1 second') AT TIME ZONE 'GMT' AS ate,
+            NOW() AT TIME ZONE 'GMT' AS agora;
+        """
+
+class AgregadorIncremental:
+    """Agregado do dia de core_payment mantido em memória.
+
+    Cada ciclo consulta só as linhas criadas depois da marca d'água (`ate`) do ciclo anterior,
+    soma os valores por chave e devolve apenas as chaves cujo total mudou. As subclasses definem
+    `query` (com os parâmetros de e até), `nome` (do prepared statement) e `n_chave`
+    (quantas colunas iniciais formam a chave).
+
+    Com `cauda` ligada (modo por eventos), os totais devolvidos incluem também as linhas depois da
+    marca d'água até agora; essa cauda é relida a cada ciclo e nunca avança a marca d'água, então
+    commits atrasados continuam sendo pegos.
+    """
+    query = None
+    nome = None
+    n_chave = 1
+
+    def __init__(self, atraso_segundos=ATRASO_JANELA_SEGUNDOS, cauda=False):
+        self.atraso_segundos = atraso_segundos
+        self.cauda = cauda
+        self.dia = None
+        self.ate = None
+        self.agregado = {}
+        self.entregue = {}  # totais devolvidos no ciclo anterior (com a cauda, se ligada)
+        self.proxima_revarredura = 0
+
+    def janela(self, cursor):
+        """Retorna o dia atual (Brasília), o início do dia, o fim da janela e o instante atual, pelo relógio do banco."""
+        executar_preparada(cursor, "janela_dia", QUERY_JANELA, (self.atraso_segundos,))
+        return cursor.fetchone()
+
+    def consultar(self, cursor, de, ate):
+        executar_preparada(cursor, self.nome, self.query, (de, ate))
+        return [(tuple(linha[:self.n_chave]), tuple(linha[self.n_chave:])) for linha in cursor.fetchall()]
+
+    def atualizar(self, cursor):
+        """Incorpora as linhas novas e retorna as linhas (chave + totais) que mudaram."""
+        dia, inicio_dia, ate, agora = self.janela(cursor)
+        anterior = self.entregue
+
+        if dia != self.dia or time.monotonic() >= self.proxima_revarredura:
+            # Virada do dia ou revarredura periódica: reagrega o dia inteiro
+            if dia != self.dia:
+                anterior = {}
+            self.agregado = dict(self.consultar(cursor, inicio_dia, ate))
+            self.dia = dia
+            self.proxima_revarredura = time.monotonic() + INTERVALO_REVARREDURA_SEGUNDOS
+            print(f"Agregado do dia recalculado ({type(self).__name__}): {len(self.agregado)} chaves")
+        else:
+            for chave, valores in self.consultar(cursor, self.ate, ate):
+                atuais = self.agregado.get(chave, (0,) * len(valores))
+                self.agregado[chave] = tuple(atual + valor for atual, valor in zip(atuais, valores))
+
+        self.ate = ate
+
+        totais = self.agregado
+        if self.cauda:
+            totais = dict(self.agregado)
+            for chave, valores in self.consultar(cursor, ate, agora):
+                atuais = totais.get(chave, (0,) * len(valores))
+                totais[chave] = tuple(atual + valor for atual, valor in zip(atuais, valores))
+        self.entregue = dict(totais)
+
+        # Chaves que sumiram na revarredura (ex.: estornos) voltam zeradas
+        alteradas = []
+        for chave in totais.keys() | anterior.keys():
+            valores = totais.get(chave)
+            if valores != anterior.get(chave):
+                if valores is None:
+                    valores = (0,) * len(anterior[chave])
+                alteradas.append((*chave, *valores))
+        return alteradas
 
 ############# FUNÇÃO PARA OBTER SALDO TOTAL POR MERCHANT #############
 
-# Arquivo para armazenar os saldos da meia-noite
-SALDOS_FILE = "saldos_meia_noite.json"
+# Snapshots do balance_decimal de cada merchant à meia-noite de Brasília, gravados em SQLite;
+# com eles o saldo_0h é uma consulta por chave e o loop não precisa somar core_payment
+SNAPSHOTS_SALDOS = os.getenv('SNAPSHOTS_SALDOS', "1") == "1"
+SNAPSHOTS_FILE = os.getenv('SNAPSHOTS_FILE', "snapshots_saldos.sqlite3")
 
-def load_saldos_meia_noite():
-    """Carrega os saldos da meia-noite do arquivo"""
-    if Path(SALDOS_FILE).exists():
-        with open(SALDOS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+# Grava também um snapshot no início de cada hora (histórico intradiário)
+SNAPSHOT_HORARIO = os.getenv('SNAPSHOT_HORARIO', "0") == "1"
 
-def save_saldos_meia_noite(saldos):
-    """Salva os saldos da meia-noite no arquivo"""
-    with open(SALDOS_FILE, 'w') as f:
-        json.dump(saldos, f)
+# Sem snapshots: mantém o total do dia por merchant em memória em vez de reagregar core_payment a cada ciclo
+SALDO_0H_INCREMENTAL = os.getenv('SALDO_0H_INCREMENTAL', "0") == "1"
 
-def get_balances(cursor):
-    """Obtém os saldos das contas: atual e da meia-noite (horário de Brasília)"""
-    try:
-        query = """
+class SnapshotsSaldos:
+    """Snapshots dos saldos por merchant em SQLite, só com inserções (vale o primeiro valor de cada chave).
+
+    Cada snapshot é identificado pelo dia de Brasília (AAAA-MM-DD) e pela hora (0 = meia-noite).
+    Os saldos são guardados como texto para não perder casas do NUMERIC, e os snapshots do dia
+    corrente ficam também em memória.
+    """
+    def __init__(self, arquivo=SNAPSHOTS_FILE):
+        self.arquivo = arquivo
+        self.lock = Lock()
+        self.conn = None
+        self.cache = {}  # (dia, hora) -> {merchant_id: Decimal}
+
+    def _conexao(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.arquivo, check_same_thread=False)
+            with self.conn:
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS snapshots_saldos (
+                        dia TEXT NOT NULL,
+                        hora INTEGER NOT NULL,
+                        merchant_id INTEGER NOT NULL,
+                        saldo TEXT,
+                        capturado_em TEXT NOT NULL,
+                        PRIMARY KEY (dia, hora, merchant_id)
+                    )""")
+        return self.conn
+
+    def gravar(self, dia, hora, saldos):
+        """Grava {merchant_id: saldo} em uma única transação; merchants já presentes no snapshot são mantidos."""
+        capturado_em = datetime.now().isoformat(timespec="seconds")
+        linhas = [
+            (dia, hora, merchant_id, None if saldo is None else str(saldo), capturado_em)
+            for merchant_id, saldo in saldos.items()
+        ]
+        with self.lock:
+            conn = self._conexao()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO snapshots_saldos VALUES (?, ?, ?, ?, ?)", linhas)
+            self.cache.pop((dia, hora), None)
+
+    def saldos(self, dia, hora=0):
+        """Retorna {merchant_id: saldo} do snapshot (vazio se ainda não foi capturado)."""
+        with self.lock:
+            if (dia, hora) not in self.cache:
+                # Só o dia consultado fica em memória
+                self.cache = {chave: valor for chave, valor in self.cache.items() if chave[0] == dia}
+                linhas = self._conexao().execute(
+                    "SELECT merchant_id, saldo FROM snapshots_saldos WHERE dia = ? AND hora = ?", (dia, hora)
+                )
+                self.cache[(dia, hora)] = {
+                    merchant_id: None if saldo is None else Decimal(saldo) for merchant_id, saldo in linhas
+                }
+            return self.cache[(dia, hora)]
+
+    def historico(self, merchant_id, de=None, ate=None, hora=0):
+        """Saldos de um merchant nos snapshots entre os dias `de` e `ate` (inclusive), como [(dia, saldo)]."""
+        with self.lock:
+            linhas = self._conexao().execute(
+                """SELECT dia, saldo FROM snapshots_saldos
+                   WHERE merchant_id = ? AND hora = ? AND dia >= ? AND dia <= ?
+                   ORDER BY dia""",
+                (merchant_id, hora, de or "0000-00-00", ate or "9999-99-99"),
+            ).fetchall()
+        return [(dia, None if saldo is None else Decimal(saldo)) for dia, saldo in linhas]
+
+    def fechar(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            self.cache = {}
+
+snapshots = SnapshotsSaldos()
+
+# Soma que leva do saldo da meia-noite ao saldo atual
+MOVIMENTO_SQL = """SUM(CASE 
+                WHEN cp.status_text = 'PAID' AND cp.method_text = 'PIX' THEN cp.amount_decimal
+                WHEN cp.status_text = 'PAID' AND cp.method_text = 'PIXOUT' THEN -cp.amount_decimal
+                WHEN cp.status_text = 'REFUNDED' THEN -cp.amount_decimal
+                ELSE 0
+            END)"""
+
+def query_saldos(filtrar_merchants=False, inicio=INICIO_DIA_SQL):
+    """Uma única agregação por merchant, juntada aos merchants (sem subquery correlacionada).
+
+    Soma o movimento desde `inicio` (padrão: meia-noite de Brasília; "%s" para receber o instante
+    como parâmetro). Com `filtrar_merchants`, recebe ainda a lista de merchant_ids (%s, duas vezes).
+    """
+    filtro_pagamentos = "AND cp.merchant_id = ANY(%s)" if filtrar_merchants else ""
+    filtro_merchants = "WHERE cm.id = ANY(%s)" if filtrar_merchants else ""
+    return f"""
+        WITH movimentos AS (
+            SELECT
+                cp.merchant_id,
+                {MOVIMENTO_SQL} AS total_transacoes
+            FROM public.core_payment cp
+            WHERE cp.created_at_date >= {inicio}
+            AND cp.created_at_date < NOW()
+            AND cp.status_text IN ('PAID', 'REFUNDED')
+            AND cp.method_text IN ('PIX', 'PIXOUT')
+            {filtro_pagamentos}
+            GROUP BY cp.merchant_id
+        )
         SELECT 
             cm.id AS merchant_id,
             cm.balance_decimal AS saldo_atual,
             cm.name_text,
-            COALESCE(
-                (SELECT SUM(CASE 
-                    WHEN status_text = 'PAID' AND method_text = 'PIX' THEN amount_decimal
-                    WHEN status_text = 'PAID' AND method_text = 'PIXOUT' THEN -amount_decimal
-                    WHEN status_text = 'REFUNDED' THEN -amount_decimal
-                    ELSE 0
-                END)
-                FROM public.core_payment cp
-                WHERE cp.merchant_id = cm.id
-                AND cp.created_at_date >= (DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')
-                AND cp.created_at_date < NOW()
-                AND cp.status_text IN ('PAID', 'REFUNDED')
-                AND cp.method_text IN ('PIX', 'PIXOUT')), 0
-            ) as total_transacoes
+            COALESCE(mv.total_transacoes, 0) AS total_transacoes
         FROM public.core_merchant cm
+        LEFT JOIN movimentos mv ON mv.merchant_id = cm.id
+        {filtro_merchants}
         ORDER BY cm.id ASC;
         """
-        
-        print("Executando query de saldos...")
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        df = pd.DataFrame(results, columns=["merchant_id", "saldo_atual", "name_text", "total_transacoes"])
-        df["saldo_0h"] = df["saldo_atual"] - df["total_transacoes"]
-        df = df[["merchant_id", "saldo_atual", "saldo_0h", "name_text"]]
-        
-        print(f"✓ Query de saldos retornou {len(df)} registros")
-        return df
 
-    except Exception as e:
-        print(f"Erro ao obter saldos das contas: {e}")
-        return pd.DataFrame(columns=["merchant_id", "saldo_atual", "saldo_0h", "name_text"])
+QUERY_SALDOS = query_saldos()
+QUERY_SALDOS_MERCHANTS = query_saldos(filtrar_merchants=True)
 
-############# FUNÇÃO PARA OBTER ÚLTIMA LINHA PREENCHIDA #############
+# Reconstrução dos saldos em um instante passado (captura dos snapshots)
+QUERY_SNAPSHOT = query_saldos(inicio="%s")
+QUERY_SNAPSHOT_MERCHANTS = query_saldos(filtrar_merchants=True, inicio="%s")
 
-def get_last_row(worksheet):
-    """Obtém a última linha preenchida de uma aba do Google Sheets."""
-    try:
-        last_row = len(worksheet.get_col(9, include_tailing_empty=False)) + 1
-        print(f"Última linha encontrada em {worksheet.title}: {last_row}")
-        return last_row
-    except Exception as e:
-        print(f"Erro ao obter última linha: {e}")
-        return 1
+# Relógio do banco: agora em Brasília e os inícios do dia e da hora, todos do mesmo NOW()
+QUERY_RELOGIO = f"""
+        SELECT NOW() AT TIME ZONE 'America/Sao_Paulo' AS agora, {INICIO_DIA_SQL} AS inicio_dia, {INICIO_HORA_SQL} AS inicio_hora;
+        """
+
+QUERY_MERCHANTS = """
+        SELECT cm.id AS merchant_id, cm.balance_decimal AS saldo_atual, cm.name_text
+        FROM public.core_merchant cm
+        ORDER BY cm.id ASC;
+        """
+
+QUERY_MERCHANTS_FILTRADA = """
+        SELECT cm.id AS merchant_id, cm.balance_decimal AS saldo_atual, cm.name_text
+        FROM public.core_merchant cm
+        WHERE cm.id = ANY(%s)
+        ORDER BY cm.id ASC;
+        """
+
+def query_movimentos(fim):
+    """Total movimentado por merchant a partir de um instante (%s) até `fim`."""
+    return f"""
+        SELECT cp.merchant_id, {MOVIMENTO_SQL} AS total_transacoes
+        FROM public.core_payment cp
+        WHERE cp.created_at_date >= %s
+        AND cp.created_at_date < {fim}
+        AND cp.status_text IN ('PAID', 'REFUNDED')
+        AND cp.method_text IN ('PIX', 'PIXOUT')
+        GROUP BY cp.merchant_id;
+        """
+
+QUERY_MOVIMENTOS = query_movimentos("%s")
+QUERY_MOVIMENTOS_CAUDA = query_movimentos("NOW()")
+
+class AcumuladoSaldos(AgregadorIncremental):
+    """Total movimentado no dia por merchant; `saldo_0h` vira uma consulta ao dicionário."""
+    query = QUERY_MOVIMENTOS
+    nome = "movimentos_dia"
+    n_chave = 1
+
+    def totais(self, cursor):
+        """Retorna {merchant_id: total do dia até agora}, somando a cauda ainda fora da marca d'água."""
+        self.atualizar(cursor)
+        totais = {chave[0]: valores[0] for chave, valores in self.agregado.items()}
+
+        # A cauda (últimos segundos) não avança a marca d'água: é relida no próximo ciclo
+        executar_preparada(cursor, "movimentos_cauda", QUERY_MOVIMENTOS_CAUDA, (self.ate,))
+        for merchant_id, total in cursor.fetchall():
+            totais[merchant_id] = totais.get(merchant_id, 0) + total
+        return totais
+
+acumulado_saldos = AcumuladoSaldos()
+
+@metricas.cronometrado("db_consulta_segundos", consulta="snapshot")
+def capturar_snapshot(cursor, dia, hora, inicio, merchant_ids=None):
+    """Grava o snapshot (dia, hora) com os saldos no instante `inicio`: saldo atual menos o movimento desde então.
+
+    No primeiro ciclo depois da meia-noite o movimento somado é só o dos últimos segundos.
+    """
+    if merchant_ids is None:
+        executar_preparada(cursor, "snapshot", QUERY_SNAPSHOT, (inicio,))
+    else:
+        ids = list(merchant_ids)
+        executar_preparada(cursor, "snapshot_merchants", QUERY_SNAPSHOT_MERCHANTS, (inicio, ids, ids))
+    saldos = {
+        merchant_id: None if saldo_atual is None else saldo_atual - total_transacoes
+        for merchant_id, saldo_atual, _, total_transacoes in cursor.fetchall()
+    }
+    snapshots.gravar(dia, hora, saldos)
+    print(f"✓ Snapshot de {dia} {hora:02d}h gravado para {len(saldos)} merchants")
+
+def saldos_com_snapshot(cursor, merchant_ids=None):
+    """Linhas (merchant_id, saldo_atual, name_text, total_transacoes) com o saldo_0h vindo do snapshot do dia."""
+    executar_preparada(cursor, "relogio", QUERY_RELOGIO)
+    agora, inicio_dia, inicio_hora = cursor.fetchone()
+    dia = agora.date().isoformat()
+
+    # Primeiro ciclo do dia (ou da hora): captura o snapshot antes de usá-lo
+    if not snapshots.saldos(dia):
+        capturar_snapshot(cursor, dia, 0, inicio_dia)
+    if SNAPSHOT_HORARIO and agora.hour and not snapshots.saldos(dia, agora.hour):
+        capturar_snapshot(cursor, dia, agora.hour, inicio_hora)
+
+    if merchant_ids is None:
+        executar_preparada(cursor, "merchants", QUERY_MERCHANTS)
+    else:
+        executar_preparada(cursor, "merchants_filtrada", QUERY_MERCHANTS_FILTRADA, (list(merchant_ids),))
+    linhas = cursor.fetchall()
+
+    # Merchants criados depois da captura entram no snapshot do dia na primeira vez que aparecem
+    saldos_0h = snapshots.saldos(dia)
+    novos = [linha[0] for linha in linhas if linha[0] not in saldos_0h]
+    if novos:
+        capturar_snapshot(cursor, dia, 0, inicio_dia, novos)
+        saldos_0h = snapshots.saldos(dia)
+
+    # O total do dia é a diferença para o snapshot, como na reconstrução por core_payment
+    return [
+        (merchant_id, saldo_atual, name_text,
+         0 if saldo_atual is None or saldos_0h.get(merchant_id) is None else saldo_atual - saldos_0h[merchant_id])
+        for merchant_id, saldo_atual, name_text in linhas
+    ]
+
+def saldos_reconstruidos(cursor, merchant_ids=None):
+    """Linhas (merchant_id, saldo_atual, name_text, total_transacoes) somando o movimento do dia em core_payment."""
+    if SALDO_0H_INCREMENTAL:
+        print("Executando query de saldos (total do dia incremental)...")
+        totais = acumulado_saldos.totais(cursor)
+        if merchant_ids is None:
+            executar_preparada(cursor, "merchants", QUERY_MERCHANTS)
+        else:
+            executar_preparada(cursor, "merchants_filtrada", QUERY_MERCHANTS_FILTRADA, (list(merchant_ids),))
+        return [(*linha, totais.get(linha[0], 0)) for linha in cursor.fetchall()]
+    
+    if merchant_ids is None:
+        print("Executando query de saldos...")
+        executar_preparada(cursor, "saldos", QUERY_SALDOS)
+    else:
+        print(f"Executando query de saldos para {len(merchant_ids)} merchants...")
+        ids = list(merchant_ids)
+        executar_preparada(cursor, "saldos_merchants", QUERY_SALDOS_MERCHANTS, (ids, ids))
+    return cursor.fetchall()
+
+@metricas.cronometrado("db_consulta_segundos", consulta="saldos")
+def get_balances(cursor, merchant_ids=None):
+    """Obtém os saldos das contas: atual e da meia-noite (horário de Brasília)
+
+    Com `merchant_ids`, consulta só esses merchants (modo por eventos). Erros do banco são
+    propagados para o loop, que descarta a conexão e aplica o backoff.
+    """
+    if SNAPSHOTS_SALDOS:
+        try:
+            print("Executando query de saldos (saldo_0h do snapshot da meia-noite)...")
+            results = saldos_com_snapshot(cursor, merchant_ids)
+        except sqlite3.Error as e:
+            print(f"Erro no arquivo de snapshots ({e}), reconstruindo o saldo_0h por core_payment")
+            results = saldos_reconstruidos(cursor, merchant_ids)
+    else:
+        results = saldos_reconstruidos(cursor, merchant_ids)
+    
+    df = pd.DataFrame(results, columns=["merchant_id", "saldo_atual", "name_text", "total_transacoes"])
+    df["saldo_0h"] = df["saldo_atual"] - df["total_transacoes"]
+    df = df[["merchant_id", "saldo_atual", "saldo_0h", "name_text"]]
+    
+    print(f"✓ Query de saldos retornou {len(df)} registros")
+    return df
 
 ############# FUNÇÃO PARA OBTER PAGAMENTOS EM TEMPO REAL #################
 
-def get_payments(cursor):
-    """Obtém os pagamentos processados do dia atual."""
-    try:
-        query = """
-        SELECT DISTINCT
+COLUNAS_PAGAMENTOS = ["data", "merchant", "provider", "meth", "quantidade", "volume"]
+CHAVE_PAGAMENTOS = ["data", "merchant", "provider", "meth"]
+
+class AgregadorPagamentos(AgregadorIncremental):
+    """Pagamentos PAID do dia por (data, merchant, provider, meth)."""
+    query = """
+        SELECT
             DATE_TRUNC('day', cp.created_at_date AT TIME ZONE 'America/Sao_Paulo') AS data, 
             cm.name_text AS merchant, 
             cp.provider_text AS provider, 
@@ -115,130 +512,626 @@ def get_payments(cursor):
         FROM core_payment cp 
         JOIN core_merchant cm ON cm.id = cp.merchant_id
         WHERE cp.status_text = 'PAID' 
-        AND cp.created_at_date >= (DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')
-        -- Apenas dados do dia atual considerando horário de Brasília
-        GROUP BY data, merchant, cm.name_text, cp.provider_text, cp.method_text
-        ORDER BY data DESC;
+        AND cp.created_at_date >= %s
+        AND cp.created_at_date < %s
+        GROUP BY data, cm.name_text, cp.provider_text, cp.method_text;
         """
-        print("Executando query de pagamentos do dia...")
-        cursor.execute(query)
-        results = cursor.fetchall()
-        df = pd.DataFrame(results, columns=["data", "merchant", "provider", "meth", "quantidade", "volume"])
-        
-        if not df.empty:
-            df = df.drop_duplicates()
-            print(f"✓ Query de pagamentos retornou {len(df)} registros do dia")
-        return df
-    except Exception as e:
-        print(f"Erro ao obter pagamentos: {e}")
-        return pd.DataFrame()
+    nome = "pagamentos_dia"
+    n_chave = 4
+
+agregador_pagamentos = AgregadorPagamentos()
+
+# Linha da aba DATABASE JACI de cada chave do dia, salva depois de cada envio ao Sheets; com ela a
+# execução seguinte regrava os totais do dia nas mesmas linhas em vez de repeti-los no fim da aba
+LINHAS_JACI_FILE = os.getenv('LINHAS_JACI_FILE', "linhas_jaci.json")
+
+def load_linhas_jaci():
+    """Carrega {chave: linha} das chaves de pagamentos gravadas pela execução anterior."""
+    if not Path(LINHAS_JACI_FILE).exists():
+        return {}
+    try:
+        with open(LINHAS_JACI_FILE, 'r') as f:
+            linhas = json.load(f)
+        return {(pd.Timestamp(data), *resto): linha for data, *resto, linha in linhas}
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Erro ao ler as linhas da aba DATABASE JACI ({e}), chaves do dia serão reescritas no fim da aba")
+        return {}
+
+def linhas_jaci_do_dia(linhas_chave):
+    """Só as chaves do dia mais recente: as dos dias anteriores não voltam a ser atualizadas."""
+    if not linhas_chave:
+        return []
+    ultimo_dia = max(chave[0] for chave in linhas_chave)
+    return [[str(data), *resto, linha] for (data, *resto), linha in linhas_chave.items() if data == ultimo_dia]
+
+def save_linhas_jaci(linhas):
+    """Salva as linhas de linhas_jaci_do_dia (escrita atômica)."""
+    salvar_json(LINHAS_JACI_FILE, linhas)
+
+@metricas.cronometrado("db_consulta_segundos", consulta="pagamentos")
+def get_payments(cursor):
+    """Obtém os totais de pagamentos do dia que mudaram desde o último ciclo."""
+    print("Executando query incremental de pagamentos do dia...")
+    results = agregador_pagamentos.atualizar(cursor)
+    results.sort(key=lambda linha: tuple(str(valor) for valor in linha[:4]), reverse=True)
+    df = pd.DataFrame(results, columns=COLUNAS_PAGAMENTOS)
+    
+    if not df.empty:
+        print(f"✓ Query de pagamentos retornou {len(df)} registros alterados do dia")
+    return df
 
 ############# FUNÇÃO PARA OBTER TRANSAÇÕES DO BACKOFFICE EM TEMPO REAL #################
 
+# Estado do feed (dia, posição e totais por minuto), salvo depois de cada envio ao Sheets
+FEED_BACKOFFICE_FILE = os.getenv('FEED_BACKOFFICE_FILE', "feed_backoffice.json")
+
+# Linhas lidas por página e páginas por ciclo; o que passar disso fica para o ciclo seguinte
+LOTE_BACKOFFICE = int(os.getenv('LOTE_BACKOFFICE', "1000"))
+MAX_PAGINAS_BACKOFFICE = int(os.getenv('MAX_PAGINAS_BACKOFFICE', "10"))
+
+COLUNAS_BACKOFFICE = ["merchant", "descricao", "valor_total", "data_criacao"]
+CHAVE_BACKOFFICE = ["data_criacao", "merchant", "descricao"]
+
+# Próxima página do dia depois da posição (created_at_date, id), até o fim da janela
+QUERY_BACKOFFICE = """
+        SELECT bt.id, bt.created_at_date, COALESCE(cm.name_text, bt.merchant_id::text) AS merchant,
+            bt.description_text AS descricao, bt.amount_decimal
+        FROM public.core_backofficetrasactions bt
+        LEFT JOIN public.core_merchant cm ON cm.id = bt.merchant_id
+        WHERE bt.created_at_date >= %s
+        AND (bt.created_at_date, bt.id) > (%s, %s)
+        AND bt.created_at_date < %s
+        ORDER BY bt.created_at_date, bt.id
+        LIMIT %s;
+        """
+
+# Revarredura: totais por minuto do dia até a posição (created_at_date, id), somados no banco
+QUERY_BACKOFFICE_MINUTOS = """
+        SELECT DATE_TRUNC('minute', bt.created_at_date) AS minuto, COALESCE(cm.name_text, bt.merchant_id::text) AS merchant,
+            bt.description_text AS descricao, SUM(bt.amount_decimal)
+        FROM public.core_backofficetrasactions bt
+        LEFT JOIN public.core_merchant cm ON cm.id = bt.merchant_id
+        WHERE bt.created_at_date >= %s
+        AND (bt.created_at_date, bt.id) <= (%s, %s)
+        GROUP BY 1, 2, 3;
+        """
+
+class FeedBackoffice:
+    """Transações do backoffice do dia lidas em páginas pela chave (created_at_date, id).
+
+    Cada linha é lida uma vez e somada ao total do seu minuto (merchant, descrição);
+    `atualizar` devolve só os minutos que mudaram, que são regravados na aba por upsert.
+    Como no agregador de pagamentos, a janela para `atraso_segundos` antes de NOW(), os totais
+    do dia até a posição são reagregados no banco a cada INTERVALO_REVARREDURA_SEGUNDOS (linhas de
+    commits que chegaram depois da posição) e, com `cauda` ligada, os totais devolvidos incluem as
+    linhas até agora sem avançar a posição.
+    """
+    def __init__(self, arquivo=FEED_BACKOFFICE_FILE, atraso_segundos=ATRASO_JANELA_SEGUNDOS, cauda=False):
+        self.arquivo = arquivo
+        self.atraso_segundos = atraso_segundos
+        self.cauda = cauda
+        self.dia = None
+        self.ultimo = None   # (created_at_date, id) da última linha lida
+        self.totais = {}     # (data_criacao, merchant, descricao) -> valor total
+        self.linhas = {}     # mesma chave -> linha da aba onde o minuto foi gravado
+        self.entregue = {}   # totais devolvidos no ciclo anterior (com a cauda, se ligada)
+        self.proxima_revarredura = time.monotonic() + INTERVALO_REVARREDURA_SEGUNDOS
+
+    def carregar(self):
+        """Retoma o feed salvo pela execução anterior (descartado na virada do dia)."""
+        if not Path(self.arquivo).exists():
+            return
+        try:
+            with open(self.arquivo, 'r') as f:
+                estado = json.load(f)
+            self.dia = datetime.fromisoformat(estado["dia"])
+            self.ultimo = (datetime.fromisoformat(estado["ultimo"][0]), estado["ultimo"][1]) if estado["ultimo"] else None
+            self.totais = {tuple(chave): Decimal(total) for *chave, total in estado["totais"]}
+            self.linhas = {tuple(chave): linha for *chave, linha in estado["linhas"]}
+            self.entregue = dict(self.totais)
+            print(f"Feed do backoffice retomado: {len(self.totais)} minutos do dia {self.dia.date()}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Erro ao ler o estado do feed do backoffice ({e}), relendo o dia")
+            self.dia, self.ultimo, self.totais, self.linhas, self.entregue = None, None, {}, {}, {}
+
+    def estado(self):
+        """Cópia serializável do feed, para salvar depois que o envio ao Sheets terminar."""
+        return {
+            "dia": self.dia.isoformat() if self.dia else None,
+            "ultimo": [self.ultimo[0].isoformat(), self.ultimo[1]] if self.ultimo else None,
+            "totais": [[*chave, str(total)] for chave, total in self.totais.items()],
+            "linhas": [[*chave, linha] for chave, linha in self.linhas.items()],
+        }
+
+    def ler_paginas(self, cursor, inicio_dia, ultimo, ate, totais):
+        """Soma em `totais` as linhas depois da posição `ultimo` até `ate`, no máximo MAX_PAGINAS_BACKOFFICE páginas.
+
+        Retorna (posição da última linha lida, se chegou até `ate`); o restante fica para o ciclo seguinte.
+        """
+        paginas = 0
+        while True:
+            de, de_id = ultimo or (inicio_dia, 0)
+            executar_preparada(cursor, "backoffice_pagina", QUERY_BACKOFFICE,
+                               (inicio_dia, de, de_id, ate, LOTE_BACKOFFICE))
+            pagina = cursor.fetchall()
+            for _, criado_em, merchant, descricao, valor in pagina:
+                chave = (str(criado_em.replace(second=0, microsecond=0)), merchant, descricao)
+                totais[chave] = totais.get(chave, 0) + valor
+            if pagina:
+                ultimo = (pagina[-1][1], pagina[-1][0])
+            paginas += 1
+            if len(pagina) < LOTE_BACKOFFICE:
+                return ultimo, True
+            if paginas >= MAX_PAGINAS_BACKOFFICE:
+                print(f"Backoffice: limite de {MAX_PAGINAS_BACKOFFICE} páginas no ciclo, o restante fica para o próximo")
+                return ultimo, False
+
+    def atualizar(self, cursor):
+        """Lê as páginas novas e retorna as linhas (merchant, descricao, valor_total, data_criacao) alteradas."""
+        executar_preparada(cursor, "janela_dia", QUERY_JANELA, (self.atraso_segundos,))
+        dia, inicio_dia, ate, agora = cursor.fetchone()
+        anterior = self.entregue
+        if dia != self.dia:
+            if self.dia is not None:
+                print("Virada do dia: feed do backoffice reiniciado")
+            self.dia, self.ultimo, self.totais, self.linhas = dia, None, {}, {}
+            anterior = {}
+            self.proxima_revarredura = time.monotonic() + INTERVALO_REVARREDURA_SEGUNDOS
+
+        revarredura = self.ultimo is not None and time.monotonic() >= self.proxima_revarredura
+        if revarredura:
+            # Reagrega no banco tudo até a posição: linhas gravadas com created_at_date já atrás dela
+            # (commits mais atrasados que a janela) entram no total do minuto sem contar duas vezes
+            executar_preparada(cursor, "backoffice_minutos", QUERY_BACKOFFICE_MINUTOS, (inicio_dia, *self.ultimo))
+            self.totais = {
+                (str(minuto), merchant, descricao): total for minuto, merchant, descricao, total in cursor.fetchall()
+            }
+            self.proxima_revarredura = time.monotonic() + INTERVALO_REVARREDURA_SEGUNDOS
+            print(f"Feed do backoffice reagregado: {len(self.totais)} minutos do dia")
+        self.ultimo, completo = self.ler_paginas(cursor, inicio_dia, self.ultimo, ate, self.totais)
+
+        totais = self.totais
+        if self.cauda and completo:
+            totais = dict(self.totais)
+            self.ler_paginas(cursor, inicio_dia, self.ultimo, agora, totais)
+        if not revarredura:
+            # Fora da revarredura nenhum minuto some; o que estava só na cauda anterior mantém o valor
+            totais = {**anterior, **totais}
+        self.entregue = dict(totais)
+
+        # Minutos que sumiram na revarredura voltam zerados
+        alterados = sorted(
+            (chave for chave in totais.keys() | anterior.keys() if totais.get(chave) != anterior.get(chave)),
+            key=lambda chave: tuple(str(valor) for valor in chave),
+        )
+        return [
+            (merchant, descricao, totais.get((data, merchant, descricao), Decimal(0)), data)
+            for data, merchant, descricao in alterados
+        ]
+
+feed_backoffice = FeedBackoffice()
+
+def save_feed_backoffice(estado):
+    """Salva o estado do feed do backoffice (escrita atômica)."""
+    salvar_json(FEED_BACKOFFICE_FILE, estado)
+
+@metricas.cronometrado("db_consulta_segundos", consulta="backoffice")
 def get_backtransactions(cursor):
-    """Obtém transações do Backoffice do dia atual."""
+    """Obtém os totais por minuto do backoffice do dia que mudaram desde o último ciclo."""
+    print("Executando query incremental de backoffice do dia...")
+    results = feed_backoffice.atualizar(cursor)
+    df = pd.DataFrame(results, columns=COLUNAS_BACKOFFICE)
+    
+    if not df.empty:
+        print(f"✓ Query de backoffice retornou {len(df)} minutos alterados do dia")
+    return df
+
+############# MODO POR EVENTOS (LISTEN/NOTIFY) #############
+
+# Ativa o modo por eventos; exige os triggers de sql/notificacoes_saldos.sql instalados no banco
+MODO_EVENTOS = os.getenv('MODO_EVENTOS', "0") == "1"
+
+# Canal usado pelos triggers em pg_notify
+CANAL_EVENTOS = "nox_saldos"
+
+# Depois do primeiro evento, espera mais este tempo juntando os seguintes antes de atualizar
+DEBOUNCE_SEGUNDOS = float(os.getenv('DEBOUNCE_EVENTOS_SEGUNDOS', "2"))
+
+class OuvinteEventos:
+    """Escuta as notificações dos triggers e agrupa os merchants alterados por tabela."""
+    def __init__(self):
+        self.conn = None
+
+    def conectar(self):
+        print(f"Escutando o canal {CANAL_EVENTOS}...")
+        self.conn = psycopg2.connect(**DB_CONFIG)
+        self.conn.autocommit = True
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CANAL_EVENTOS}")
+
+    def fechar(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+        self.conn = None
+
+    def aguardar(self, timeout):
+        """Espera até `timeout` segundos por eventos; retorna {tabela: {merchant_id}} (vazio se nada chegou)."""
+        limite = time.monotonic() + timeout
+        eventos = {}
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conectar()
+
+            while True:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                if select.select([self.conn], [], [], restante) == ([], [], []):
+                    break
+                self.conn.poll()
+                primeiro = not eventos
+                while self.conn.notifies:
+                    notificacao = self.conn.notifies.pop(0)
+                    dados = json.loads(notificacao.payload)
+                    eventos.setdefault(dados["tabela"], set()).add(dados["merchant_id"])
+                if primeiro and eventos:
+                    limite = min(limite, time.monotonic() + DEBOUNCE_SEGUNDOS)
+            return eventos
+
+        except (psycopg2.Error, OSError, ValueError) as e:
+            # Sem escuta, cai para o polling: espera o restante do intervalo e tenta reconectar depois
+            print(f"Erro ao escutar eventos ({e}), usando polling neste intervalo")
+            self.fechar()
+            time.sleep(max(0, limite - time.monotonic()))
+            return eventos
+
+def etapas_por_eventos(eventos):
+    """Escolhe as consultas necessárias e os merchants de saldo a atualizar para um lote de eventos."""
+    merchants = set().union(*eventos.values())
+    etapas = {"saldos": partial(get_balances, merchant_ids=merchants)}
+    if "core_payment" in eventos:
+        etapas["pagamentos"] = get_payments
+    if "core_backofficetrasactions" in eventos:
+        etapas["backoffice"] = get_backtransactions
+    return etapas
+
+############# ARQUIVO HISTÓRICO E JANELA DAS ABAS #############
+
+# Linhas de dados mantidas nas abas DATABASE JACI e Backoffice Ajustes (0 desliga); as mais antigas
+# ficam só no arquivo histórico em Parquet (historico.py)
+JANELA_PLANILHA_LINHAS = int(os.getenv('JANELA_PLANILHA_LINHAS', "20000"))
+
+# Linhas de cabeçalho no topo das abas, que nunca são apagadas
+LINHAS_CABECALHO_PLANILHA = int(os.getenv('LINHAS_CABECALHO_PLANILHA', "1"))
+
+arquivo_historico = ArquivoHistorico()
+
+def arquivar(tabela, df):
+    """Grava no arquivo histórico as linhas enviadas para a aba; uma falha aqui não interrompe o ciclo."""
     try:
-        query = """
-        SELECT DISTINCT
-            (SELECT cm2.name_text FROM core_merchant cm2 WHERE id = merchant_id) AS merchant,
-            description_text AS descricao,
-            SUM(amount_decimal) AS valor_total,
-            DATE_TRUNC('minute', created_at_date) AS data_criacao,
-            MAX(created_at_date) as ultima_atualizacao
-        FROM public.core_backofficetrasactions
-        WHERE created_at_date >= DATE_TRUNC('day', NOW())  -- Apenas dados do dia atual
-        GROUP BY DATE_TRUNC('minute', created_at_date), merchant_id, descricao
-        ORDER BY ultima_atualizacao ASC
-        LIMIT 100;
-        """
-        print("Executando query de backoffice do dia...")
-        cursor.execute(query)
-        results = cursor.fetchall()
-        df = pd.DataFrame(results, columns=["merchant", "descricao", "valor_total", "data_criacao", "ultima_atualizacao"])
-        
-        if not df.empty:
-            df = df.drop(columns=["ultima_atualizacao"])
-            df = df.drop_duplicates()
-            print(f"✓ Query de backoffice retornou {len(df)} registros do dia")
-        return df
+        arquivo_historico.arquivar(tabela, df)
     except Exception as e:
-        print(f"Erro ao obter transações do backoffice: {e}")
-        return pd.DataFrame()
+        print(f"Erro ao arquivar {tabela} no histórico: {e}")
+
+def aparar_aba(writer, wks, tabela):
+    """Mantém a aba dentro da janela: arquiva as linhas mais antigas (lidas da própria aba) e as apaga.
+
+    Só apara quando o excesso passa de 10% da janela, para não apagar linhas a cada ciclo.
+    Deve ser chamada sem envio em andamento; retorna True se apagou linhas.
+    """
+    if not JANELA_PLANILHA_LINHAS or not historico.disponivel() or wks.title not in writer.proxima_linha:
+        return False
+    excesso = writer.proxima_linha[wks.title] - 1 - LINHAS_CABECALHO_PLANILHA - JANELA_PLANILHA_LINHAS
+    if excesso <= JANELA_PLANILHA_LINHAS // 10:
+        return False
+
+    inicio = LINHAS_CABECALHO_PLANILHA + 1
+    colunas = historico.TABELAS[tabela]["colunas"]
+    with metricas.medir("sheets_chamada_segundos", operacao="get_values"):
+        valores = wks.get_values((inicio, 1), (inicio + excesso - 1, len(colunas)),
+                                 value_render=pygsheets.ValueRenderOption.UNFORMATTED_VALUE)
+    df = pd.DataFrame([list(linha) + [""] * (len(colunas) - len(linha)) for linha in valores], columns=colunas)
+
+    # As linhas só saem da planilha depois de gravadas no arquivo
+    arquivo_historico.arquivar(tabela, df)
+    writer.remover_linhas(wks, inicio, excesso)
+    print(f"✓ {excesso} linhas antigas de '{wks.title}' arquivadas e removidas da planilha")
+    return True
+
+############# CONCILIAÇÃO IUGU x JACI #############
+
+# Intervalo mínimo entre duas leituras da aba IUGU Subcontas (a varredura da IUGU roda bem menos que o loop)
+INTERVALO_LEITURA_IUGU_SEGUNDOS = int(os.getenv('INTERVALO_LEITURA_IUGU_SEGUNDOS', "300"))
+
+# Aba da tabela de exceções: resumo em A1 e tabela a partir de A2
+ABA_CONCILIACAO = os.getenv('ABA_CONCILIACAO', "Conciliação")
+
+class ConciliacaoIugu:
+    """Concilia os saldos da aba IUGU Subcontas com os saldos do jaci e publica só as exceções.
+
+    A aba da IUGU é lida no máximo a cada INTERVALO_LEITURA_IUGU_SEGUNDOS; a comparação (conciliacao.py)
+    roda a cada ciclo sobre a última leitura. Lê a planilha, então só deve ser usada com o writer ocioso.
+    """
+    def __init__(self, sh):
+        self.wks_iugu = sh.worksheet_by_title("IUGU Subcontas")
+        self.wks = sh.worksheet_by_title(ABA_CONCILIACAO)
+        self.df_iugu = None
+        self.status_iugu = ""
+        self.proxima_leitura = 0
+        self.dia = dia_brasilia()
+        self.base = load_base_conciliacao()
+
+        # A tabela da execução anterior é apagada uma vez; depois o writer só envia o que muda
+        with metricas.medir("sheets_chamada_segundos", operacao="clear"):
+            self.wks.clear(start="A2")
+        self.linhas_escritas = 0
+
+    def ler_iugu(self):
+        """Lê o status (A1) e a tabela da aba IUGU Subcontas em uma única chamada."""
+        with metricas.medir("sheets_chamada_segundos", operacao="get_values"):
+            valores = self.wks_iugu.get_values((1, 1), (self.wks_iugu.rows, 3),
+                                               value_render=pygsheets.ValueRenderOption.UNFORMATTED_VALUE)
+        self.status_iugu = str(valores[0][0]) if valores and valores[0] else ""
+
+        # A linha 2 é o cabeçalho (Account, transactions_total, saldo_cents); o saldo já vem em reais
+        contas = [(linha[0], linha[2] if len(linha) > 2 else "") for linha in valores[2:] if linha and linha[0] != ""]
+        self.df_iugu = pd.DataFrame(contas, columns=["account", "saldo"])
+        self.proxima_leitura = time.monotonic() + INTERVALO_LEITURA_IUGU_SEGUNDOS
+        print(f"✓ Aba IUGU Subcontas lida: {len(self.df_iugu)} subcontas ({self.status_iugu})")
+
+    def atualizar(self, writer, df_saldos):
+        """Concilia com os saldos atuais e agenda a tabela de exceções no writer."""
+        if time.monotonic() >= self.proxima_leitura:
+            self.ler_iugu()
+        if self.df_iugu is None or self.df_iugu.empty or df_saldos is None or df_saldos.empty:
+            return
+
+        # A deriva é medida desde a primeira conciliação de cada merchant no dia
+        if dia_brasilia() != self.dia:
+            self.dia, self.base = dia_brasilia(), {}
+        with metricas.medir("conciliacao_segundos"):
+            excecoes, diferencas = conciliar(self.df_iugu, df_saldos, base=self.base)
+        novas = {merchant: diferenca for merchant, diferenca in diferencas.items() if merchant not in self.base}
+        if novas:
+            self.base.update(novas)
+            save_base_conciliacao(self.base)
+
+        linhas = [COLUNAS_EXCECOES] + excecoes.astype(object).where(excecoes.notna(), "").values.tolist()
+        # Linhas que sobraram de uma tabela maior são esvaziadas (o writer só envia as células que mudam)
+        vazias = [[""] * len(COLUNAS_EXCECOES)] * max(self.linhas_escritas - len(linhas), 0)
+        writer.set_values(self.wks, (2, 1), linhas + vazias)
+        self.linhas_escritas = len(linhas)
+
+        rodado = agora_brasilia().strftime("%Y-%m-%d %H:%M:%S")
+        writer.update_value(self.wks, "A1", f"Conciliação {rodado}: {len(excecoes)} exceções, "
+                                            f"{len(diferencas)} merchants conciliados | IUGU: {self.status_iugu}")
+        print(f"✓ Conciliação IUGU x jaci: {len(excecoes)} exceções preparadas para a aba '{ABA_CONCILIACAO}'")
 
 ############# LOOP PRINCIPAL - TEMPO REAL #############
 
-print("\nIniciando loop principal...")
-while True:
+# Intervalo entre o início de dois ciclos completos (polling)
+INTERVALO_CICLO_SEGUNDOS = 60
+
+def executar_etapa(pool, funcao):
+    """Executa uma consulta em uma conexão própria do pool; retorna (resultado, segundos)."""
+    inicio = time.perf_counter()
+    conn = obter_conexao(pool)
     try:
-        current_time = datetime.now()
-        print(f"\n{'='*50}")
-        print(f"Nova atualização iniciada em: {current_time}")
-        print(f"{'='*50}")
-
-        # Executa a cópia dos saldos à meia-noite
-        if current_time.hour == 0 and current_time.minute == 0:
-            print("Meia-noite detectada, aguardando 1 minuto...")
-            time.sleep(60)
-        
-        # Conexão com o banco de dados
-        print("\nConectando ao banco de dados...")
-        with psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASS'),
-            database=os.getenv('DB_NAME'),
-            port=int(os.getenv('DB_PORT', "5432"))
-        ) as conn:
-            print("✓ Conexão estabelecida com sucesso")
-            
-            with conn.cursor() as cursor:
-                # Atualiza saldos
-                print("\nAtualizando saldos...")
-                df_balances = get_balances(cursor)
-                if not df_balances.empty:
-                    wks_balances.set_dataframe(df_balances, (1, 1), encoding="utf-8", copy_head=True)
-                    print("✓ Saldos atualizados com sucesso na aba 'jaci'")
-
-                # Atualiza pagamentos   
-                print("\nAtualizando pagamentos...")
-                df_payments = get_payments(cursor)
+        with conn.cursor() as cursor:
+            resultado = funcao(cursor)
+    except Exception:
+        pool.putconn(conn, close=True)
+        raise
+    pool.putconn(conn)
+    return resultado, time.perf_counter() - inicio
+
+def enviar_sheets(writer, *apos_envio):
+    """Envia as alterações pendentes do writer; retorna os segundos gastos.
+
+    As funções de `apos_envio` só são chamadas se o envio der certo (ex.: salvar o estado do que
+    já está na planilha).
+    """
+    inicio = time.perf_counter()
+    writer.flush()
+    for funcao in apos_envio:
+        funcao()
+    return time.perf_counter() - inicio
+
+def juntar_saldos(df_atual, df_parcial):
+    """Substitui no DataFrame de saldos as linhas dos merchants atualizados por evento."""
+    if df_atual is None or df_atual.empty:
+        return df_parcial
+    df = pd.concat([df_atual[~df_atual["merchant_id"].isin(df_parcial["merchant_id"])], df_parcial])
+    return df.sort_values("merchant_id").reset_index(drop=True)
+
+def main(max_ciclos=None):
+    """Loop de atualização; `max_ciclos` encerra após esse número de ciclos (usado pelos benchmarks)."""
+    sh, wks_JACI, wks_backtxs, wks_balances = connect_sheets()
+
+    # Todas as escritas do ciclo são enviadas juntas, só com as células alteradas
+    writer = SheetWriter(sh)
+
+    # Os minutos do backoffice já gravados pela execução anterior são regravados na mesma linha
+    feed_backoffice.carregar()
+    writer.linhas_chave.setdefault(wks_backtxs.title, {}).update(feed_backoffice.linhas)
+    writer.linhas_chave.setdefault(wks_JACI.title, {}).update(load_linhas_jaci())
+
+    # As consultas rodam em paralelo, cada uma em sua conexão; o envio ao Sheets roda em
+    # segundo plano e se sobrepõe à espera e às consultas do ciclo seguinte
+    executor_consultas = ThreadPoolExecutor(max_workers=3)
+    executor_sheets = ThreadPoolExecutor(max_workers=1)
+    envio_anterior = None
+
+    if METRICAS_PORTA:
+        metricas.iniciar_servidor(METRICAS_PORTA)
+
+    # Sem o mapa de subcontas para merchants a conciliação fica desligada
+    conciliacao = None
+    if MAPA_CONTAS_MERCHANTS:
+        try:
+            conciliacao = ConciliacaoIugu(sh)
+        except Exception as e:
+            print(f"Erro ao preparar a conciliação IUGU x jaci (desligada nesta execução): {e}")
+
+    ouvinte = None
+    if MODO_EVENTOS:
+        print("Modo por eventos ativo (LISTEN/NOTIFY), com polling completo como fallback")
+        ouvinte = OuvinteEventos()
+        # A marca d'água continua ATRASO_JANELA_SEGUNDOS atrás; os últimos segundos entram pela cauda,
+        # relida a cada ciclo (o saldo_0h incremental já soma a própria cauda)
+        agregador_pagamentos.cauda = True
+        feed_backoffice.cauda = True
+
+    pool = None
+    falhas = 0
+    df_saldos = None
+    proximo_ciclo_completo = time.monotonic()
+    ciclos = 0
+
+    print("\nIniciando loop principal...")
+    while max_ciclos is None or ciclos < max_ciclos:
+        # Espera o próximo ciclo completo; no modo por eventos, acorda antes se algo mudar
+        eventos = {}
+        espera = proximo_ciclo_completo - time.monotonic()
+        if espera > 0:
+            print(f"Aguardando {espera:.0f} segundos para próxima atualização...")
+            if ouvinte is not None:
+                eventos = ouvinte.aguardar(espera)
+            else:
+                time.sleep(espera)
+
+        inicio_ciclo = time.monotonic()
+        try:
+            current_time = datetime.now()
+            print(f"\n{'='*50}")
+            if eventos:
+                resumo = ", ".join(f"{tabela}: {len(ids)}" for tabela, ids in eventos.items())
+                print(f"Atualização por eventos iniciada em: {current_time} ({resumo})")
+            else:
+                print(f"Nova atualização iniciada em: {current_time}")
+            print(f"{'='*50}")
+
+            # Conexões persistentes com o banco de dados
+            if pool is None:
+                print("\nCriando pool de conexões com o banco de dados...")
+                pool = criar_pool()
+
+            if eventos:
+                etapas = etapas_por_eventos(eventos)
+            else:
+                etapas = {"saldos": get_balances, "pagamentos": get_payments, "backoffice": get_backtransactions}
+
+            print(f"\nExecutando consultas em paralelo: {', '.join(etapas)}...")
+            futuros = {nome: executor_consultas.submit(executar_etapa, pool, funcao) for nome, funcao in etapas.items()}
+            resultados, erro_consulta = {}, None
+            for nome, futuro in futuros.items():
+                try:
+                    resultados[nome] = futuro.result()
+                except Exception as e:
+                    # As outras etapas já avançaram o estado incremental; os resultados delas ainda são
+                    # enviados e o erro é relançado no fim do ciclo (backoff)
+                    print(f"Erro na consulta de {nome}: {e}")
+                    erro_consulta = erro_consulta or e
+            tempos = {nome: segundos for nome, (_, segundos) in resultados.items()}
+
+            # O writer só recebe os dados novos depois que o envio do ciclo anterior terminou
+            if envio_anterior is not None:
+                try:
+                    tempos["sheets (ciclo anterior)"] = envio_anterior.result()
+                except Exception as e:
+                    print(f"Erro ao enviar alterações para o Google Sheets (serão reenviadas): {e}")
+                envio_anterior = None
+
+            # Com o writer ocioso, apara as abas que passaram da janela
+            jaci_aparado = backoffice_aparado = False
+            try:
+                jaci_aparado = aparar_aba(writer, wks_JACI, "pagamentos")
+                backoffice_aparado = aparar_aba(writer, wks_backtxs, "backoffice")
+            except Exception as e:
+                print(f"Erro ao aparar as abas (nova tentativa no próximo ciclo): {e}")
+
+            df_balances = resultados["saldos"][0] if "saldos" in resultados else pd.DataFrame()
+            if not df_balances.empty:
+                df_saldos = juntar_saldos(df_saldos, df_balances) if eventos else df_balances
+                writer.set_dataframe(wks_balances, df_saldos, (1, 1), copy_head=True)
+                print("✓ Saldos preparados para a aba 'jaci'")
+
+            if conciliacao is not None:
+                try:
+                    conciliacao.atualizar(writer, df_saldos)
+                except Exception as e:
+                    print(f"Erro na conciliação IUGU x jaci (nova tentativa no próximo ciclo): {e}")
+
+            jaci_alterado = jaci_aparado
+            if "pagamentos" in resultados:
+                df_payments = resultados["pagamentos"][0]
                 if not df_payments.empty:
-                    last_row_JACI = get_last_row(wks_JACI)
-                    wks_JACI.set_dataframe(df_payments, (last_row_JACI, 1), encoding="utf-8", copy_head=False)
-                    print("✓ Pagamentos atualizados com sucesso na aba 'DATABASE JACI'")
+                    writer.upsert_dataframe(wks_JACI, df_payments, CHAVE_PAGAMENTOS)
+                    arquivar("pagamentos", df_payments)
+                    jaci_alterado = True
+                    print("✓ Pagamentos preparados para a aba 'DATABASE JACI'")
 
-                # Atualiza backoffice
-                print("\nAtualizando transações do backoffice...")
-                df_backtxs = get_backtransactions(cursor)
+            backoffice_alterado = backoffice_aparado
+            if "backoffice" in resultados:
+                df_backtxs = resultados["backoffice"][0]
                 if not df_backtxs.empty:
-                    last_row_backtxs = get_last_row(wks_backtxs)
-                    wks_backtxs.set_dataframe(df_backtxs, (last_row_backtxs, 1), encoding="utf-8", copy_head=False)
-                    print("✓ Transações do backoffice atualizadas com sucesso na aba 'Backoffice Ajustes'")
+                    writer.upsert_dataframe(wks_backtxs, df_backtxs, CHAVE_BACKOFFICE)
+                    arquivar("backoffice", df_backtxs)
+                    backoffice_alterado = True
+                    print("✓ Transações do backoffice preparadas para a aba 'Backoffice Ajustes'")
+
+            # As linhas das chaves mudam com o upsert e quando a aba é aparada
+            apos_envio = []
+            if jaci_alterado:
+                apos_envio.append(partial(save_linhas_jaci, linhas_jaci_do_dia(writer.linhas_chave.get(wks_JACI.title, {}))))
+            if backoffice_alterado:
+                linhas_aba = writer.linhas_chave.get(wks_backtxs.title, {})
+                # Inclui os minutos que por enquanto só existem na cauda
+                feed_backoffice.linhas = {
+                    chave: linhas_aba[chave] for chave in feed_backoffice.entregue if chave in linhas_aba
+                }
+                apos_envio.append(partial(save_feed_backoffice, feed_backoffice.estado()))
+
+            # Envia todas as alterações do ciclo em uma única chamada, em segundo plano
+            print("\nEnviando alterações para o Google Sheets em segundo plano...")
+            envio_anterior = executor_sheets.submit(enviar_sheets, writer, *apos_envio)
+            if erro_consulta is not None:
+                raise erro_consulta
+            falhas = 0
+
+            tempos["ciclo"] = time.monotonic() - inicio_ciclo
+            print("Tempos por etapa: " + " | ".join(f"{nome} {segundos:.2f}s" for nome, segundos in tempos.items()))
+            metricas.observar("balances_ciclo_segundos", tempos["ciclo"], modo="eventos" if eventos else "completo")
+            metricas.exportar()
            
-    except Exception as e:
-        print(f"\nERRO CRÍTICO: {e}")
-        print("Fechando conexão antiga...")
-        try:
-            cursor.close()
-            conn.close()
-        except:
-            pass
-        print("Tentando reiniciar o loop em 60 segundos...")
-        time.sleep(60)
-        continue
-
-    print(f"\nAtualização concluída em: {datetime.now()}")
-    print("Aguardando 60 segundos para próxima atualização...")
-    time.sleep(60)
+        except Exception as e:
+            print(f"\nERRO CRÍTICO: {e}")
+            metricas.incrementar("balances_ciclos_com_erro_total")
+            falhas += 1
+            espera = min(BACKOFF_INICIAL_SEGUNDOS * 2 ** (falhas - 1), BACKOFF_MAXIMO_SEGUNDOS)
+            print(f"Tentando reiniciar o loop em {espera} segundos (falha {falhas} seguida)...")
+            time.sleep(espera)
+            proximo_ciclo_completo = time.monotonic()
+            continue
 
-# Configurações do Banco de Dados
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASS'),
-    'database': os.getenv('DB_NAME'),
-    'port': int(os.getenv('DB_PORT', "5432"))
-}
+        print(f"\nAtualização concluída em: {datetime.now()}")
+        ciclos += 1
+        if not eventos:
+            proximo_ciclo_completo = inicio_ciclo + INTERVALO_CICLO_SEGUNDOS
+
+    # Só chega aqui com max_ciclos: espera o último envio e libera as conexões
+    if envio_anterior is not None:
+        envio_anterior.result()
+    executor_consultas.shutdown()
+    executor_sheets.shutdown()
+    if ouvinte is not None:
+        ouvinte.fechar()
+    if pool is not None:
+        pool.closeall()
+    snapshots.fechar()
 
 # Configurações do Google Sheets
 SHEETS_CONFIG = {
@@ -249,4 +1142,7 @@ SHEETS_CONFIG = {
         'backoffice': "Backoffice Ajustes",
         'balances': "jaci"
     }
-}
\ No newline at end of file
+}
+
+if __name__ == "__main__":
+    main()
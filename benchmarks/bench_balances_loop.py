@@ -0,0 +1,140 @@
+"""Benchmark do loop do balances_depuracao contra um Postgres local e uma planilha em memória.
+
+Roda BENCH_CICLOS ciclos seguidos do main() (sem a espera de 60 s entre eles) para cada escala
+e mede o tempo de parede por ciclo, separando o primeiro (agregação do dia inteiro) dos demais.
+Entre os ciclos, novos pagamentos são inseridos para simular o movimento do dia.
+
+Uso:
+    BENCH_DSN=postgresql://localhost/bench_daily_balance python benchmarks/bench_balances_loop.py
+
+O banco apontado por BENCH_DSN é descartável: as tabelas core_* são recriadas nele.
+Escalas no formato merchants x pagamentos do dia, ex.: BENCH_ESCALAS="100x10000,1000x200000".
+"""
+import os
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from simuladores import PlanilhaSimulada, diretorio_temporario
+
+# Os snapshots de saldo, o estado do feed do backoffice, as linhas da aba DATABASE JACI e o arquivo
+# histórico ficam em um diretório descartável
+DIRETORIO = diretorio_temporario()
+os.environ['SNAPSHOTS_FILE'] = os.path.join(DIRETORIO, "snapshots_saldos.sqlite3")
+os.environ['FEED_BACKOFFICE_FILE'] = os.path.join(DIRETORIO, "feed_backoffice.json")
+os.environ['LINHAS_JACI_FILE'] = os.path.join(DIRETORIO, "linhas_jaci.json")
+os.environ['HISTORICO_DIR'] = os.path.join(DIRETORIO, "historico")
+
+import balances_depuracao
+from bench_get_balances import preparar_fixture
+
+BENCH_DSN = os.getenv('BENCH_DSN')
+BENCH_ESCALAS = os.getenv('BENCH_ESCALAS', "100x10000,1000x100000")
+BENCH_CICLOS = int(os.getenv('BENCH_CICLOS', "10"))
+BENCH_LATENCIA_SHEETS = float(os.getenv('BENCH_LATENCIA_SHEETS', "0.3"))
+
+# Ajustes do backoffice e pagamentos novos que chegam durante o benchmark
+SEED_BACKOFFICE = """
+INSERT INTO public.core_backofficetrasactions (merchant_id, description_text, amount_decimal, created_at_date)
+SELECT
+    1 + (random() * (%(merchants)s - 1))::int,
+    (ARRAY['Ajuste', 'Estorno', 'Tarifa'])[1 + (random() * 2)::int],
+    round((random() * 500)::numeric, 2),
+    (NOW() AT TIME ZONE 'GMT') - random() * (INTERVAL '12 hours')
+FROM generate_series(1, %(merchants)s) g;
+ANALYZE public.core_backofficetrasactions;
+"""
+
+MOVIMENTO = """
+INSERT INTO public.core_payment (merchant_id, status_text, method_text, provider_text, amount_decimal, created_at_date)
+SELECT
+    1 + (random() * (%(merchants)s - 1))::int,
+    'PAID',
+    (ARRAY['PIX', 'PIXOUT'])[1 + (random())::int],
+    'iugu',
+    round((random() * 1000)::numeric, 2),
+    (NOW() AT TIME ZONE 'GMT') - INTERVAL '1 minute'
+FROM generate_series(1, %(novos)s) g;
+"""
+
+def simular_movimento(merchants, novos, parar):
+    """Insere `novos` pagamentos por segundo até `parar` ser sinalizado."""
+    conn = psycopg2.connect(BENCH_DSN)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        while not parar.wait(1):
+            cursor.execute(MOVIMENTO, {"merchants": merchants, "novos": novos})
+    conn.close()
+
+def medir_escala(merchants, pagamentos):
+    planilha = PlanilhaSimulada("Daily Balance - Nox Pay", latencia=BENCH_LATENCIA_SHEETS)
+    abas = tuple(planilha.worksheet_by_title(titulo) for titulo in ("DATABASE JACI", "Backoffice Ajustes", "jaci"))
+    balances_depuracao.connect_sheets = lambda: (planilha, *abas)
+
+    # Estado incremental zerado a cada escala
+    balances_depuracao.agregador_pagamentos = balances_depuracao.AgregadorPagamentos()
+    balances_depuracao.acumulado_saldos = balances_depuracao.AcumuladoSaldos()
+    balances_depuracao.snapshots.fechar()
+    Path(balances_depuracao.SNAPSHOTS_FILE).unlink(missing_ok=True)
+    balances_depuracao.feed_backoffice = balances_depuracao.FeedBackoffice()
+    Path(balances_depuracao.FEED_BACKOFFICE_FILE).unlink(missing_ok=True)
+    Path(balances_depuracao.LINHAS_JACI_FILE).unlink(missing_ok=True)
+
+    # Tempo de cada ciclo, lido do histograma de métricas do próprio loop
+    duracoes = []
+    observar = balances_depuracao.metricas.observar
+    def registrar(nome, valor, **rotulos):
+        if nome == "balances_ciclo_segundos":
+            duracoes.append(valor)
+        observar(nome, valor, **rotulos)
+    balances_depuracao.metricas.observar = registrar
+
+    parar = threading.Event()
+    movimento = threading.Thread(target=simular_movimento, args=(merchants, max(pagamentos // 3600, 1), parar))
+    movimento.start()
+    inicio = time.perf_counter()
+    try:
+        balances_depuracao.main(max_ciclos=BENCH_CICLOS)
+    finally:
+        parar.set()
+        movimento.join()
+        balances_depuracao.metricas.observar = observar
+    total = time.perf_counter() - inicio
+
+    demais = duracoes[1:] or duracoes
+    print(f"  primeiro ciclo {duracoes[0]:8.2f} s | demais (mediana) {statistics.median(demais):6.2f} s | "
+          f"{len(duracoes) / total:5.2f} ciclos/s | {planilha.celulas_escritas} células em {planilha.lotes} lotes")
+
+def main():
+    if not BENCH_DSN:
+        print("Defina BENCH_DSN apontando para um Postgres local descartável.")
+        sys.exit(1)
+
+    # Evita recriar tabelas por engano em um banco de verdade
+    conn = psycopg2.connect(BENCH_DSN)
+    conn.autocommit = True
+    nome_banco = conn.get_dsn_parameters().get("dbname", "")
+    if "bench" not in nome_banco and "test" not in nome_banco:
+        print(f"O banco '{nome_banco}' não parece descartável (o nome deve conter 'bench' ou 'test').")
+        sys.exit(1)
+
+    balances_depuracao.DB_CONFIG = {"dsn": BENCH_DSN}
+    balances_depuracao.INTERVALO_CICLO_SEGUNDOS = 0
+
+    for escala in BENCH_ESCALAS.split(","):
+        merchants, pagamentos = (int(x) for x in escala.lower().split("x"))
+        print(f"\nEscala: {merchants} merchants x {pagamentos} pagamentos/dia, {BENCH_CICLOS} ciclos")
+        preparar_fixture(conn, merchants, pagamentos)
+        with conn.cursor() as cursor:
+            cursor.execute(SEED_BACKOFFICE, {"merchants": merchants})
+        medir_escala(merchants, pagamentos)
+
+    conn.close()
+
+if __name__ == "__main__":
+    main()
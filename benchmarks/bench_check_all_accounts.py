@@ -0,0 +1,125 @@
+"""Benchmark de ponta a ponta do check_all_accounts() contra dublês locais (IUGU, SSH e Sheets).
+
+Nenhum serviço real é acessado: a IUGU é um servidor HTTPS local (benchmarks/simuladores.py),
+o SSH é um stub que atende o curl remoto e os túneis, e as planilhas ficam em memória.
+Cada cenário roda duas vezes: a execução fria (sem cursores) e a aquecida (cursores da anterior).
+
+Uso:
+    python benchmarks/bench_check_all_accounts.py
+
+Parâmetros (variáveis de ambiente):
+    BENCH_CONTAS         quantidades de contas por cenário, ex.: "50,200"
+    BENCH_TAMANHOS       tamanhos de extrato sorteados para as contas normais, ex.: "0,10,500,5000"
+    BENCH_GRANDES        contas grandes por cenário e o tamanho delas, ex.: "2x200000"
+    BENCH_LATENCIA       latência base da IUGU em segundos (padrão 0.05)
+    BENCH_TAXA_504       fração das respostas com 504 (padrão 0)
+    BENCH_TRANSPORTES    transportes a comparar, ex.: "tunel,curl"
+"""
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from simuladores import (ClienteSheetsSimulado, ServidorIugu, SSHSimulado, diretorio_temporario,
+                         gerar_certificado)
+
+BENCH_CONTAS = os.getenv('BENCH_CONTAS', "50,200")
+BENCH_TAMANHOS = os.getenv('BENCH_TAMANHOS', "0,10,500,5000")
+BENCH_GRANDES = os.getenv('BENCH_GRANDES', "2x200000")
+BENCH_LATENCIA = float(os.getenv('BENCH_LATENCIA', "0.05"))
+BENCH_TAXA_504 = float(os.getenv('BENCH_TAXA_504', "0"))
+BENCH_TRANSPORTES = os.getenv('BENCH_TRANSPORTES', "tunel,curl")
+
+# Os arquivos de estado e o certificado local ficam em um diretório descartável
+DIRETORIO = diretorio_temporario()
+CERTIFICADO = gerar_certificado(DIRETORIO)
+if CERTIFICADO:
+    os.environ['IUGU_CA_FILE'] = CERTIFICADO[0]
+os.environ['IUGU_CURSORES_FILE'] = os.path.join(DIRETORIO, "cursores_iugu.json")
+os.environ['IUGU_ESTADO_FILE'] = os.path.join(DIRETORIO, "estado_iugu_subcontas.json")
+os.environ['IUGU_ROSTER_FILE'] = os.path.join(DIRETORIO, "roster_subcontas.json")
+os.environ['IUGU_CHECKPOINT_FILE'] = os.path.join(DIRETORIO, "checkpoint_iugu.jsonl")
+
+import daily_balance_noxpay
+
+def montar_cenario(n_contas, tamanhos, n_grandes, tamanho_grande, semente=7):
+    """Sorteia os extratos das contas; retorna (contas por token, roster da aba Subcontas, CONTAS_GRANDES)."""
+    aleatorio = random.Random(semente)
+    contas, roster, grandes = {}, [], {}
+    for i in range(n_contas):
+        token = f"token_{i}"
+        account = f"conta_{i}"
+        if i < n_grandes:
+            contas[token] = tamanho_grande
+            grandes[account] = {"timeout": 60, "retries": 3, "batch_size": 100}
+        else:
+            contas[token] = aleatorio.choice(tamanhos)
+        roster.append({"account": account, "live_token_full": token, "NOX": "SIM"})
+    return contas, roster, grandes
+
+def executar(ssh, cliente_sheets):
+    """Roda uma varredura completa; retorna o tempo de parede em segundos."""
+    planilha = cliente_sheets.open("Daily Balance - Nox Pay")
+    planilha.worksheet_by_title("IUGU Subcontas").celulas[(1, 2)] = "TRUE"
+    daily_balance_noxpay.cursores.clear()
+    # Cada execução do cron é um processo novo, com o rate limiter zerado
+    daily_balance_noxpay.rate_limiter = daily_balance_noxpay.RateLimiter()
+    inicio = time.perf_counter()
+    daily_balance_noxpay.check_all_accounts()
+    return time.perf_counter() - inicio
+
+def medir_cenario(n_contas, transporte, tamanhos, n_grandes, tamanho_grande):
+    contas, roster, grandes = montar_cenario(n_contas, tamanhos, n_grandes, tamanho_grande)
+    servidor = ServidorIugu(contas, latencia=BENCH_LATENCIA, taxa_504=BENCH_TAXA_504, certificado=CERTIFICADO)
+    ssh = SSHSimulado(servidor)
+    cliente_sheets = ClienteSheetsSimulado()
+    cliente_sheets.open("Gateway").worksheet_by_title("Subcontas").registros = roster
+
+    daily_balance_noxpay.url_financial = servidor.url_financial
+    daily_balance_noxpay.IUGU_TRANSPORTE = transporte
+    daily_balance_noxpay.CONTAS_GRANDES = grandes
+    daily_balance_noxpay.connect_ssh = lambda: ssh
+    daily_balance_noxpay.pygsheets.authorize = lambda **kwargs: cliente_sheets
+    for arquivo in (daily_balance_noxpay.CURSORES_FILE, daily_balance_noxpay.ESTADO_FILE,
+                    daily_balance_noxpay.ROSTER_FILE, daily_balance_noxpay.CHECKPOINT_FILE):
+        Path(arquivo).unlink(missing_ok=True)
+
+    linhas = []
+    for rodada in ("fria", "aquecida"):
+        requisicoes_antes = servidor.requisicoes
+        planilha = cliente_sheets.open("Daily Balance - Nox Pay")
+        celulas_antes = planilha.celulas_escritas
+        segundos = executar(ssh, cliente_sheets)
+        requisicoes = servidor.requisicoes - requisicoes_antes
+        linhas.append(
+            f"  {transporte:<6} {rodada:<9} {segundos:8.2f} s | {n_contas / segundos:7.1f} contas/s | "
+            f"{requisicoes:5d} requisições ({requisicoes / segundos:6.1f}/s) | "
+            f"{planilha.celulas_escritas - celulas_antes:5d} células no Sheets | "
+            f"rate limit {daily_balance_noxpay.rate_limiter.stats()['tempo_espera_total']:.2f} s"
+        )
+
+    daily_balance_noxpay.close_tunnels()
+    servidor.fechar()
+    return linhas
+
+def main():
+    tamanhos = [int(t) for t in BENCH_TAMANHOS.split(",")]
+    n_grandes, tamanho_grande = (int(x) for x in BENCH_GRANDES.lower().split("x"))
+    transportes = [t for t in BENCH_TRANSPORTES.split(",") if t != "tunel" or CERTIFICADO]
+
+    resultados = []
+    for n_contas in (int(n) for n in BENCH_CONTAS.split(",")):
+        for transporte in transportes:
+            resultados.append(f"\n{n_contas} contas ({n_grandes} grandes com {tamanho_grande} transações), "
+                              f"latência {BENCH_LATENCIA * 1000:.0f} ms, 504 em {BENCH_TAXA_504:.0%}")
+            resultados.extend(medir_cenario(n_contas, transporte, tamanhos, n_grandes, tamanho_grande))
+
+    print("\n" + "=" * 50)
+    print("RESULTADOS")
+    print("=" * 50)
+    print("\n".join(resultados))
+
+if __name__ == "__main__":
+    main()
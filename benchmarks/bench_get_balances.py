@@ -0,0 +1,196 @@
+"""Benchmark da query de saldos (get_balances) contra um Postgres local com dados sintéticos.
+
+Compara a versão antiga (subquery correlacionada por merchant) com a agregação única
+(QUERY_SALDOS), com o modo incremental (SALDO_0H_INCREMENTAL) e com o saldo_0h lido do
+snapshot da meia-noite (SNAPSHOTS_SALDOS), usando EXPLAIN ANALYZE.
+
+Uso:
+    BENCH_DSN=postgresql://localhost/bench_daily_balance python benchmarks/bench_get_balances.py
+
+O banco apontado por BENCH_DSN é descartável: as tabelas core_* são recriadas nele.
+Escalas no formato merchants x pagamentos do dia, ex.: BENCH_ESCALAS="100x10000,1000x200000".
+"""
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import balances_depuracao
+
+BENCH_DSN = os.getenv('BENCH_DSN')
+BENCH_ESCALAS = os.getenv('BENCH_ESCALAS', "100x10000,1000x100000,2000x500000")
+BENCH_REPETICOES = int(os.getenv('BENCH_REPETICOES', "5"))
+
+# Query original de get_balances, mantida aqui como referência
+QUERY_SALDOS_CORRELACIONADA = """
+        SELECT
+            cm.id AS merchant_id,
+            cm.balance_decimal AS saldo_atual,
+            cm.name_text,
+            COALESCE(
+                (SELECT SUM(CASE
+                    WHEN status_text = 'PAID' AND method_text = 'PIX' THEN amount_decimal
+                    WHEN status_text = 'PAID' AND method_text = 'PIXOUT' THEN -amount_decimal
+                    WHEN status_text = 'REFUNDED' THEN -amount_decimal
+                    ELSE 0
+                END)
+                FROM public.core_payment cp
+                WHERE cp.merchant_id = cm.id
+                AND cp.created_at_date >= (DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')
+                AND cp.created_at_date < NOW()
+                AND cp.status_text IN ('PAID', 'REFUNDED')
+                AND cp.method_text IN ('PIX', 'PIXOUT')), 0
+            ) as total_transacoes
+        FROM public.core_merchant cm
+        ORDER BY cm.id ASC;
+        """
+
+SCHEMA = """
+DROP TABLE IF EXISTS public.core_payment;
+DROP TABLE IF EXISTS public.core_backofficetrasactions;
+DROP TABLE IF EXISTS public.core_merchant;
+
+CREATE TABLE public.core_merchant (
+    id SERIAL PRIMARY KEY,
+    name_text TEXT NOT NULL,
+    balance_decimal NUMERIC(18, 2) NOT NULL DEFAULT 0
+);
+
+CREATE TABLE public.core_payment (
+    id BIGSERIAL PRIMARY KEY,
+    merchant_id INTEGER NOT NULL REFERENCES public.core_merchant (id),
+    status_text TEXT NOT NULL,
+    method_text TEXT NOT NULL,
+    provider_text TEXT,
+    amount_decimal NUMERIC(18, 2) NOT NULL,
+    created_at_date TIMESTAMP NOT NULL
+);
+CREATE INDEX ON public.core_payment (created_at_date);
+CREATE INDEX ON public.core_payment (merchant_id, created_at_date);
+
+CREATE TABLE public.core_backofficetrasactions (
+    id BIGSERIAL PRIMARY KEY,
+    merchant_id INTEGER NOT NULL REFERENCES public.core_merchant (id),
+    description_text TEXT,
+    amount_decimal NUMERIC(18, 2) NOT NULL,
+    created_at_date TIMESTAMP NOT NULL
+);
+CREATE INDEX ON public.core_backofficetrasactions (created_at_date);
+"""
+
+# Pagamentos de hoje (a partir da meia-noite de Brasília) e dos 6 dias anteriores, como histórico
+SEED = """
+INSERT INTO public.core_merchant (name_text, balance_decimal)
+SELECT 'merchant_' || g, round((random() * 100000)::numeric, 2)
+FROM generate_series(1, %(merchants)s) g;
+
+INSERT INTO public.core_payment (merchant_id, status_text, method_text, provider_text, amount_decimal, created_at_date)
+SELECT
+    1 + (random() * (%(merchants)s - 1))::int,
+    (ARRAY['PAID', 'PAID', 'PAID', 'REFUNDED', 'PENDING'])[1 + (random() * 4)::int],
+    (ARRAY['PIX', 'PIX', 'PIXOUT', 'BOLETO'])[1 + (random() * 3)::int],
+    (ARRAY['iugu', 'celcoin', 'starkbank'])[1 + (random() * 2)::int],
+    round((random() * 1000)::numeric, 2),
+    (NOW() AT TIME ZONE 'GMT') - random() * (INTERVAL '7 days')
+FROM generate_series(1, %(pagamentos)s * 7) g;
+
+ANALYZE public.core_merchant;
+ANALYZE public.core_payment;
+"""
+
+def preparar_fixture(conn, merchants, pagamentos):
+    """Recria as tabelas e popula com `merchants` merchants e ~`pagamentos` pagamentos por dia."""
+    with conn.cursor() as cursor:
+        cursor.execute(SCHEMA)
+        cursor.execute(SEED, {"merchants": merchants, "pagamentos": pagamentos})
+
+def explain_analyze(cursor, query, params=None):
+    """Executa EXPLAIN ANALYZE e retorna (planejamento ms, execução ms, buffers lidos)."""
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+    plano = cursor.fetchone()[0]
+    if isinstance(plano, str):
+        plano = json.loads(plano)
+    plano = plano[0]
+    buffers = plano["Plan"].get("Shared Hit Blocks", 0) + plano["Plan"].get("Shared Read Blocks", 0)
+    return plano["Planning Time"], plano["Execution Time"], buffers
+
+def medir_query(cursor, nome, query):
+    planejamentos, execucoes = [], []
+    for _ in range(BENCH_REPETICOES):
+        planejamento, execucao, buffers = explain_analyze(cursor, query)
+        planejamentos.append(planejamento)
+        execucoes.append(execucao)
+    print(f"  {nome:<32} planejamento {statistics.median(planejamentos):8.2f} ms | "
+          f"execução {statistics.median(execucoes):9.2f} ms | buffers {buffers}")
+    return statistics.median(execucoes)
+
+def medir_incremental(conn):
+    """Mede o ciclo em regime do modo incremental (marca d'água já no fim do dia)."""
+    acumulado = balances_depuracao.AcumuladoSaldos()
+    tempos = []
+    with conn.cursor() as cursor:
+        acumulado.totais(cursor)  # primeiro ciclo agrega o dia inteiro
+        for _ in range(BENCH_REPETICOES):
+            inicio = time.perf_counter()
+            acumulado.totais(cursor)
+            cursor.execute(balances_depuracao.QUERY_MERCHANTS)
+            cursor.fetchall()
+            tempos.append((time.perf_counter() - inicio) * 1000)
+    mediana = statistics.median(tempos)
+    print(f"  {'incremental (ciclo em regime)':<32} total {mediana:18.2f} ms (ida e volta incluída)")
+    return mediana
+
+def medir_snapshot(conn):
+    """Mede a captura do snapshot da meia-noite e o ciclo em regime (merchants + consulta ao snapshot)."""
+    with tempfile.TemporaryDirectory() as diretorio:
+        balances_depuracao.snapshots = balances_depuracao.SnapshotsSaldos(str(Path(diretorio) / "snapshots.sqlite3"))
+        tempos = []
+        with conn.cursor() as cursor:
+            inicio = time.perf_counter()
+            balances_depuracao.saldos_com_snapshot(cursor)  # primeiro ciclo do dia captura o snapshot
+            captura = (time.perf_counter() - inicio) * 1000
+            for _ in range(BENCH_REPETICOES):
+                inicio = time.perf_counter()
+                balances_depuracao.saldos_com_snapshot(cursor)
+                tempos.append((time.perf_counter() - inicio) * 1000)
+        balances_depuracao.snapshots.fechar()
+    mediana = statistics.median(tempos)
+    print(f"  {'snapshot (captura do dia)':<32} total {captura:18.2f} ms")
+    print(f"  {'snapshot (ciclo em regime)':<32} total {mediana:18.2f} ms (ida e volta incluída)")
+    return mediana
+
+def main():
+    if not BENCH_DSN:
+        print("Defina BENCH_DSN apontando para um Postgres local descartável.")
+        sys.exit(1)
+
+    # Evita recriar tabelas por engano em um banco de verdade
+    conn = psycopg2.connect(BENCH_DSN)
+    conn.autocommit = True
+    nome_banco = conn.get_dsn_parameters().get("dbname", "")
+    if "bench" not in nome_banco and "test" not in nome_banco:
+        print(f"O banco '{nome_banco}' não parece descartável (o nome deve conter 'bench' ou 'test').")
+        sys.exit(1)
+
+    for escala in BENCH_ESCALAS.split(","):
+        merchants, pagamentos = (int(x) for x in escala.lower().split("x"))
+        print(f"\nEscala: {merchants} merchants x {pagamentos} pagamentos/dia")
+        preparar_fixture(conn, merchants, pagamentos)
+
+        with conn.cursor() as cursor:
+            antiga = medir_query(cursor, "subquery correlacionada", QUERY_SALDOS_CORRELACIONADA)
+            nova = medir_query(cursor, "agregação única (QUERY_SALDOS)", balances_depuracao.QUERY_SALDOS)
+        medir_incremental(conn)
+        medir_snapshot(conn)
+        print(f"  ganho da agregação única: {antiga / nova:.1f}x")
+
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Dublês locais da IUGU, do SSH e do Google Sheets usados pelos benchmarks.
+
+Nada aqui acessa a rede externa: a IUGU é um servidor HTTPS local, o SSH é um stub que executa
+o "curl remoto" e os port forwards contra esse servidor, e a planilha fica em memória.
+"""
+import gzip
+import io
+import json
+import random
+import re
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+############# IUGU #############
+
+def gerar_certificado(diretorio):
+    """Gera um certificado autoassinado para localhost com o openssl; retorna (cert, chave) ou None."""
+    cert = Path(diretorio) / "iugu_local.pem"
+    chave = Path(diretorio) / "iugu_local.key"
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+             "-keyout", str(chave), "-out", str(cert)],
+            check=True, capture_output=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Não foi possível gerar o certificado local ({e}); o túnel ficará indisponível")
+        return None
+    return str(cert), str(chave)
+
+def saldo_na_posicao(token, posicao):
+    """Saldo (em centavos) da transação `posicao` da conta, calculado sem guardar o extrato."""
+    return (zlib.crc32(token.encode()) % 1000 + posicao * 37) % 10_000_000
+
+class ServidorIugu:
+    """Endpoint financeiro falso: extrato por api_token com start/limit, latência e 504s configuráveis.
+
+    `contas` mapeia api_token -> número de transações. A latência de cada resposta é
+    `latencia + latencia_por_transacao * transações devolvidas`.
+    """
+    def __init__(self, contas, latencia=0.05, latencia_por_transacao=0.0, taxa_504=0.0,
+                 certificado=None, semente=42):
+        self.contas = contas
+        self.latencia = latencia
+        self.latencia_por_transacao = latencia_por_transacao
+        self.taxa_504 = taxa_504
+        self.aleatorio = random.Random(semente)
+        self.lock = threading.Lock()
+        self.requisicoes = 0
+        self.respostas_504 = 0
+        self.bytes_enviados = 0
+
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, corpo = servidor.responder(self.path)
+                if status == 200 and "gzip" in self.headers.get("accept-encoding", ""):
+                    corpo = gzip.compress(corpo)
+                    self.send_response(status)
+                    self.send_header("Content-Encoding", "gzip")
+                else:
+                    self.send_response(status)
+                self.send_header("Content-Type", "application/json" if status == 200 else "text/plain")
+                self.send_header("Content-Length", str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+                with servidor.lock:
+                    servidor.bytes_enviados += len(corpo)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.https = certificado is not None
+        if certificado:
+            contexto = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            contexto.load_cert_chain(*certificado)
+            self.httpd.socket = contexto.wrap_socket(self.httpd.socket, server_side=True)
+        self.porta = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url_financial(self):
+        esquema = "https" if self.https else "http"
+        return f"{esquema}://localhost:{self.porta}/v1/accounts/financial"
+
+    def responder(self, caminho):
+        parametros = parse_qs(urlparse(caminho).query)
+        token = parametros.get("api_token", [""])[0]
+        start = int(parametros.get("start", ["0"])[0])
+        limit = int(parametros.get("limit", ["50"])[-1])
+
+        with self.lock:
+            self.requisicoes += 1
+            erro_504 = self.aleatorio.random() < self.taxa_504
+            if erro_504:
+                self.respostas_504 += 1
+
+        total = self.contas.get(token, 0)
+        posicoes = range(start, min(start + limit, total))
+        time.sleep(self.latencia + self.latencia_por_transacao * len(posicoes))
+        if erro_504:
+            return 504, b"error code: 504"
+
+        corpo = {
+            "transactions_total": total,
+            "transactions": [
+                {"id": f"{token}-{p}", "amount_cents": 100, "balance_cents": saldo_na_posicao(token, p)}
+                for p in posicoes
+            ],
+        }
+        return 200, json.dumps(corpo).encode()
+
+    def fechar(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+############# SSH #############
+
+class _Saida(io.BytesIO):
+    """stdout/stderr de exec_command; `channel` imita o ChannelFile do paramiko."""
+    @property
+    def channel(self):
+        return self
+
+class TransporteSimulado:
+    """Transport que atende os port forwards (direct-tcpip) conectando direto no servidor local."""
+    def __init__(self, porta, latencia_canal=0.0):
+        self.porta = porta
+        self.latencia_canal = latencia_canal
+        self.canais_abertos = 0
+
+    def open_channel(self, tipo, destino, origem, timeout=None):
+        time.sleep(self.latencia_canal)
+        self.canais_abertos += 1
+        return socket.create_connection(("127.0.0.1", self.porta), timeout=timeout)
+
+    def is_active(self):
+        return True
+
+    def set_keepalive(self, intervalo):
+        pass
+
+class SSHSimulado:
+    """Cliente SSH falso: `exec_command` faz o papel do curl remoto e o transport faz os túneis.
+
+    `latencia_canal` simula o custo de abrir um canal na sessão SSH (por comando ou por túnel).
+    """
+    def __init__(self, servidor, latencia_canal=0.02):
+        self.servidor = servidor
+        self.latencia_canal = latencia_canal
+        self.transport = TransporteSimulado(servidor.porta, latencia_canal)
+        self.comandos = 0
+
+    def exec_command(self, comando, timeout=None):
+        time.sleep(self.latencia_canal)
+        self.comandos += 1
+        url = re.search(r'"(http[^"]+)"', comando).group(1)
+        partes = urlparse(url)
+        # Mesmo tratamento do servidor HTTP, sem o TLS (o curl remoto não é o que está sendo medido)
+        status, corpo = self.servidor.responder(f"{partes.path}?{partes.query}")
+        return None, _Saida(corpo), _Saida(b"")
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        pass
+
+############# GOOGLE SHEETS #############
+
+class AbaSimulada:
+    """Aba em memória com os métodos do pygsheets usados pelos scripts."""
+    def __init__(self, planilha, titulo, registros=None):
+        self.planilha = planilha
+        self.title = titulo
+        self.celulas = {}  # (linha, coluna) -> valor
+        self.registros = registros or []
+
+    @property
+    def spreadsheet(self):
+        return self.planilha
+
+    def _latencia(self):
+        time.sleep(self.planilha.latencia)
+        self.planilha.chamadas += 1
+
+    def get_value(self, endereco):
+        self._latencia()
+        coluna = ord(endereco[0].upper()) - ord("A") + 1
+        return self.celulas.get((int(endereco[1:]), coluna), "")
+
+    def get_col(self, coluna, include_tailing_empty=True):
+        self._latencia()
+        linhas = [linha for linha, c in self.celulas if c == coluna]
+        return [self.celulas[(linha, coluna)] for linha in range(1, max(linhas, default=0) + 1)]
+
+    def get_all_records(self):
+        self._latencia()
+        return list(self.registros)
+
+    @property
+    def rows(self):
+        return max((linha for linha, _ in self.celulas), default=1)
+
+    def clear(self, start="A1", end=None):
+        self._latencia()
+        linha_inicial, coluna_inicial = _indice_a1(start)
+        self.celulas = {
+            (linha, coluna): valor for (linha, coluna), valor in self.celulas.items()
+            if linha < linha_inicial or coluna < coluna_inicial
+        }
+
+    def get_values(self, inicio, fim, value_render=None, **kwargs):
+        self._latencia()
+        return [
+            [self.celulas.get((linha, coluna), "") for coluna in range(inicio[1], fim[1] + 1)]
+            for linha in range(inicio[0], fim[0] + 1)
+        ]
+
+    def delete_rows(self, indice, quantidade=1):
+        """Apaga as linhas e sobe as de baixo, como a planilha faz."""
+        self._latencia()
+        fim = indice + quantidade
+        self.celulas = {
+            (linha - quantidade if linha >= fim else linha, coluna): valor
+            for (linha, coluna), valor in self.celulas.items() if not indice <= linha < fim
+        }
+
+class _ApiSheetsSimulada:
+    def __init__(self, planilha):
+        self.planilha = planilha
+
+    def values_batch_update_by_data_filter(self, spreadsheet_id, data):
+        """Aplica os intervalos enviados pelo SheetWriter nas abas em memória."""
+        planilha = self.planilha
+        time.sleep(planilha.latencia)
+        planilha.chamadas += 1
+        planilha.lotes += 1
+        planilha.modificado_em = time.time()
+        for item in data:
+            titulo, intervalo = item["dataFilter"]["a1Range"].rsplit("!", 1)
+            aba = planilha.worksheet_by_title(titulo.strip("'"))
+            linha_ini, coluna_ini = _indice_a1(intervalo.split(":")[0])
+            for i, linha in enumerate(item["values"]):
+                for j, valor in enumerate(linha):
+                    aba.celulas[(linha_ini + i, coluna_ini + j)] = valor
+                    planilha.celulas_escritas += 1
+
+def _indice_a1(rotulo):
+    letras = re.match(r"[A-Z]+", rotulo).group(0)
+    coluna = 0
+    for letra in letras:
+        coluna = coluna * 26 + ord(letra) - ord("A") + 1
+    return int(rotulo[len(letras):]), coluna
+
+class PlanilhaSimulada:
+    """Planilha em memória compatível com o SheetWriter (values_batch_update_by_data_filter)."""
+    def __init__(self, titulo, latencia=0.1):
+        self.title = titulo
+        self.id = f"simulada-{titulo}"
+        self.latencia = latencia
+        self.abas = {}
+        self.chamadas = 0
+        self.lotes = 0
+        self.celulas_escritas = 0
+        self.modificado_em = time.time()
+        self.client = type("ClienteSimulado", (), {})()
+        self.client.sheet = _ApiSheetsSimulada(self)
+
+    @property
+    def updated(self):
+        """modifiedTime da planilha (RFC 3339), como o pygsheets retorna."""
+        time.sleep(self.latencia)
+        self.chamadas += 1
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.modificado_em)) + f".{int(self.modificado_em * 1000) % 1000:03d}Z"
+
+    def worksheet_by_title(self, titulo):
+        if titulo not in self.abas:
+            self.abas[titulo] = AbaSimulada(self, titulo)
+        return self.abas[titulo]
+
+class ClienteSheetsSimulado:
+    """Substitui o retorno de pygsheets.authorize; as planilhas são criadas sob demanda."""
+    def __init__(self, latencia=0.1):
+        self.latencia = latencia
+        self.planilhas = {}
+
+    def open(self, titulo):
+        if titulo not in self.planilhas:
+            self.planilhas[titulo] = PlanilhaSimulada(titulo, self.latencia)
+        return self.planilhas[titulo]
+
+def diretorio_temporario():
+    """Diretório descartável para os arquivos de estado gerados durante o benchmark."""
+    return tempfile.mkdtemp(prefix="bench_daily_balance_")
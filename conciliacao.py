@@ -0,0 +1,123 @@
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from arquivos import salvar_json
+
+############# CONCILIAÇÃO IUGU x JACI #############
+
+# Subconta IUGU -> merchant_id do banco, ex.: {"conta_a": 17, "conta_b": 17}. Várias subcontas de um
+# mesmo merchant são somadas antes da comparação. Sem mapa a conciliação fica desligada.
+try:
+    MAPA_CONTAS_MERCHANTS = {
+        str(conta): str(merchant)
+        for conta, merchant in json.loads(os.getenv('MAPA_CONTAS_MERCHANTS', '{}')).items()
+    }
+except (json.JSONDecodeError, AttributeError):
+    MAPA_CONTAS_MERCHANTS = {}
+
+# Diferença (em reais, em módulo) entre IUGU e banco a partir da qual o merchant vira exceção
+LIMITE_CONCILIACAO = float(os.getenv('LIMITE_CONCILIACAO', "1.00"))
+
+# Variação da diferença desde a primeira conciliação do dia a partir da qual o merchant vira exceção
+LIMITE_DERIVA_CONCILIACAO = float(os.getenv('LIMITE_DERIVA_CONCILIACAO', str(LIMITE_CONCILIACAO)))
+
+# Diferenças da primeira conciliação do dia (base da deriva), mantidas entre as execuções
+BASE_CONCILIACAO_FILE = os.getenv('BASE_CONCILIACAO_FILE', "base_conciliacao.json")
+
+COLUNAS_EXCECOES = ["merchant_id", "merchant", "contas_iugu", "saldo_iugu", "saldo_jaci", "diferenca", "deriva", "motivo"]
+
+def agora_brasilia():
+    return datetime.now(pytz.timezone('America/Sao_Paulo'))
+
+def dia_brasilia():
+    return agora_brasilia().strftime("%Y-%m-%d")
+
+def load_base_conciliacao():
+    """Carrega as diferenças da primeira conciliação do dia; {} se o arquivo é de outro dia."""
+    if Path(BASE_CONCILIACAO_FILE).exists():
+        try:
+            with open(BASE_CONCILIACAO_FILE, 'r') as f:
+                base = json.load(f)
+            if base.get("dia") == dia_brasilia():
+                return base["diferencas"]
+        except (OSError, json.JSONDecodeError, AttributeError, KeyError) as e:
+            print(f"Erro ao ler base da conciliação ({e}), recomeçando a deriva")
+    return {}
+
+def save_base_conciliacao(diferencas):
+    """Salva as diferenças base do dia (escrita atômica)"""
+    salvar_json(BASE_CONCILIACAO_FILE, {"dia": dia_brasilia(), "diferencas": diferencas})
+
+def conciliar(df_iugu, df_jaci, mapa=None, base=None,
+              limite=LIMITE_CONCILIACAO, limite_deriva=LIMITE_DERIVA_CONCILIACAO):
+    """Compara os saldos das subcontas IUGU com os saldos do banco, merchant a merchant.
+
+    `df_iugu` tem as colunas account e saldo (reais); `df_jaci` é o DataFrame de saldos do
+    balances_depuracao (merchant_id, saldo_atual, name_text). `base` mapeia merchant_id -> diferença
+    da primeira conciliação do dia, para o cálculo da deriva.
+
+    Retorna (exceções, diferenças): a tabela de exceções (COLUNAS_EXCECOES, maiores diferenças
+    primeiro) e as diferenças atuais por merchant_id.
+    """
+    mapa = MAPA_CONTAS_MERCHANTS if mapa is None else mapa
+    base = base or {}
+
+    iugu = pd.DataFrame({
+        "account": df_iugu["account"].astype(str),
+        "saldo": pd.to_numeric(df_iugu["saldo"], errors="coerce").astype("float64"),
+    })
+    contas_mapa = pd.DataFrame(list(mapa.items()), columns=["account", "merchant_id"])
+
+    # Subcontas do mapa com o saldo lido da IUGU (NaN se a conta não veio na varredura), somadas por merchant
+    mapeadas = contas_mapa.merge(iugu, on="account", how="left")
+    por_merchant = mapeadas.groupby("merchant_id", sort=False).agg(
+        contas_iugu=("account", ", ".join),
+        contas=("account", "size"),
+        com_saldo=("saldo", "count"),
+        saldo_iugu=("saldo", "sum"),
+    ).reset_index()
+    por_merchant["saldo_iugu"] = por_merchant["saldo_iugu"].where(por_merchant["com_saldo"] > 0)
+
+    jaci = pd.DataFrame({
+        "merchant_id": df_jaci["merchant_id"].astype(str),
+        "merchant": df_jaci["name_text"],
+        "saldo_jaci": pd.to_numeric(df_jaci["saldo_atual"].astype("string"), errors="coerce").astype("float64"),
+    })
+    df = por_merchant.merge(jaci, on="merchant_id", how="left")
+    df["diferenca"] = (df["saldo_iugu"] - df["saldo_jaci"]).round(2)
+    df["deriva"] = (df["diferenca"] - df["merchant_id"].map(base).astype("float64")).round(2)
+
+    df["motivo"] = np.select(
+        [
+            df["saldo_jaci"].isna(),
+            df["com_saldo"] < df["contas"],
+            df["diferenca"].abs() > limite,
+            df["deriva"].abs() > limite_deriva,
+        ],
+        ["merchant sem saldo no banco", "subconta sem saldo na IUGU", "diferença acima do limite",
+         "deriva acima do limite"],
+        default="",
+    )
+    excecoes = df[df["motivo"] != ""]
+
+    # Subcontas lidas da IUGU que não estão no mapa
+    sem_mapa = iugu[~iugu["account"].isin(contas_mapa["account"])]
+    sem_mapa = pd.DataFrame({
+        "merchant_id": "",
+        "contas_iugu": sem_mapa["account"],
+        "saldo_iugu": sem_mapa["saldo"],
+        "motivo": "subconta sem mapeamento",
+    })
+
+    excecoes = pd.concat([excecoes, sem_mapa], ignore_index=True).reindex(columns=COLUNAS_EXCECOES)
+    ordem = excecoes["diferenca"].abs().fillna(-1).sort_values(ascending=False, kind="stable").index
+    excecoes = excecoes.loc[ordem].reset_index(drop=True)
+
+    diferencas = df.dropna(subset=["diferenca"]).set_index("merchant_id")["diferenca"].to_dict()
+    return excecoes, diferencas
@@ -1,12 +1,33 @@
 import paramiko
 import json
-from time import sleep
-import pandas as pd
-from datetime import datetime, timedelta
+import http.client
+import ssl
+import socket
+import select
+import gzip
+import zlib
+import queue
+import random
+from urllib.parse import urlparse, parse_qs
+from time import sleep, monotonic, perf_counter
+from datetime import datetime, timezone
 import pygsheets
 import os
-from threading import Lock
+from pathlib import Path
+from threading import Lock, Thread
+from array import array
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 import pytz
+from sheets_writer import SheetWriter
+from arquivos import salvar_json
+from metricas import metricas
+
+# ijson é opcional: sem ele as respostas são decodificadas inteiras com json.load
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Configurações via variáveis de ambiente
 SSH_HOST = os.getenv('SSH_HOST')
@@ -15,38 +36,384 @@ SSH_USERNAME = os.getenv('SSH_USERNAME')
 SSH_PASSWORD = os.getenv('SSH_PASSWORD')
 url_financial = os.getenv('url_financial')
 
+# Número máximo de consultas simultâneas (canais abertos na mesma sessão SSH).
+# O sshd limita por padrão a 10 sessões por conexão (MaxSessions), por isso o padrão é 8.
+MAX_WORKERS = int(os.getenv('IUGU_MAX_WORKERS', "8"))
+
+# Bundle de CAs opcional para validar o TLS das consultas pelo túnel (padrão: CAs do sistema)
+IUGU_CA_FILE = os.getenv('IUGU_CA_FILE')
+
+# Contas grandes rodam em um pool próprio, em paralelo com as normais (somado a MAX_WORKERS, fica dentro do MaxSessions)
+MAX_WORKERS_GRANDES = int(os.getenv('IUGU_MAX_WORKERS_GRANDES', "2"))
+
+# Prazo padrão (segundos) de cada conta grande; pode ser sobrescrito com "prazo" na config da conta
+PRAZO_CONTAS_GRANDES = int(os.getenv('IUGU_PRAZO_CONTAS_GRANDES', "600"))
+
+# Transporte das consultas à IUGU: "tunel" (HTTP keep-alive via port forward SSH) ou "curl" (curl remoto)
+IUGU_TRANSPORTE = os.getenv('IUGU_TRANSPORTE', "tunel")
+
+# Arquivo com o último transactions_total conhecido de cada conta, reaproveitado entre execuções
+CURSORES_FILE = os.getenv('IUGU_CURSORES_FILE', "cursores_iugu.json")
+
+# Arquivo com a última tabela escrita na aba IUGU Subcontas (espelho inicial do modo incremental)
+ESTADO_FILE = os.getenv('IUGU_ESTADO_FILE', "estado_iugu_subcontas.json")
+
+# Cache da aba Gateway/Subcontas (contas ativas já separadas em grandes e normais), validado pelo modifiedTime da planilha.
+# Guarda só os ids das contas: os tokens nunca vão para o disco (o arquivo é persistido pelo cache do Actions).
+# Só evita leituras da aba no daemon e no merge; as varreduras de processos novos precisam ler os tokens
+ROSTER_FILE = os.getenv('IUGU_ROSTER_FILE', "roster_subcontas.json")
+
+# Checkpoint da varredura (JSONL só de acréscimos, uma linha por conta concluída); uma varredura interrompida
+# é retomada dele na execução seguinte se tiver começado há menos de IUGU_VALIDADE_CHECKPOINT segundos
+CHECKPOINT_FILE = os.getenv('IUGU_CHECKPOINT_FILE', "checkpoint_iugu.jsonl")
+VALIDADE_CHECKPOINT_SEGUNDOS = int(os.getenv('IUGU_VALIDADE_CHECKPOINT', "1800"))
+
+# Modo incremental: reaproveita saldos de contas sem novas transações e só reescreve células alteradas
+IUGU_INCREMENTAL = os.getenv('IUGU_INCREMENTAL', "1") == "1"
+
+# Divisão da varredura entre vários processos: cada shard consulta as contas com crc32(account) % SHARD_COUNT == SHARD_INDEX,
+# grava um resultado parcial e o modo "merge" (IUGU_MODO=merge) junta os parciais na aba IUGU Subcontas.
+# O modo "trigger" só lê B1 e grava ativo=true|false em GITHUB_OUTPUT, para o workflow não subir os shards à toa
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', "0"))
+SHARD_COUNT = max(int(os.getenv('SHARD_COUNT', "1")), 1)
+IUGU_MODO = os.getenv('IUGU_MODO', "completo")
+PARCIAIS_DIR = os.getenv('IUGU_PARCIAIS_DIR', "parciais_iugu")
+
+# Parciais mais antigos que isso (segundos) são ignorados no merge
+VALIDADE_PARCIAL_SEGUNDOS = int(os.getenv('IUGU_VALIDADE_PARCIAL', "1800"))
+
+# Modo daemon: processo contínuo que mantém Sheets e SSH conectados e verifica o trigger (B1) a cada
+# INTERVALO_TRIGGER segundos; IUGU_DAEMON_DURACAO limita o tempo de vida em segundos (0 = sem limite)
+IUGU_DAEMON = os.getenv('IUGU_DAEMON', "0") == "1"
+INTERVALO_TRIGGER = float(os.getenv('INTERVALO_TRIGGER', "5"))
+DAEMON_DURACAO_SEGUNDOS = int(os.getenv('IUGU_DAEMON_DURACAO', "0"))
+
+# Orçamento de requisições por minuto da IUGU, dividido igualmente entre os shards
+IUGU_MAX_REQ = int(os.getenv('IUGU_MAX_REQ', "900"))
+
 # Lista de contas com muitas transações
 try:
     CONTAS_GRANDES = json.loads(os.getenv('CONTAS_GRANDES', '{}'))
 except json.JSONDecodeError:
     CONTAS_GRANDES = {}
 
+class TokenBucket:
+    """Balde de tokens com reabastecimento contínuo; admissão O(1)."""
+    def __init__(self, capacidade, taxa):
+        self.capacidade = capacidade
+        self.taxa = taxa  # tokens por segundo
+        self.tokens = float(capacidade)
+        self.ultimo = monotonic()
+
+    def reservar(self, agora):
+        """Consome um token e retorna quantos segundos esperar por ele (chamar com o lock do limiter)."""
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.ultimo) * self.taxa)
+        self.ultimo = agora
+        self.tokens -= 1
+        # Saldo negativo = tokens já reservados por outras threads que ainda estão aguardando
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.taxa
+
 class RateLimiter:
-    def __init__(self, max_requests=900, time_window=60):
+    """Limita as requisições à IUGU com um balde global e, opcionalmente, baldes por host e por token.
+
+    Cada balde permite uma rajada de `burst` requisições e reabastece no ritmo que mantém
+    qualquer janela de `time_window` segundos dentro de `max_requests`.
+    """
+    def __init__(self, max_requests=900, time_window=60, burst=None, max_por_host=None, max_por_token=None):
         self.max_requests = max_requests
         self.time_window = time_window
-        self.requests = []
+        self.burst = burst or max(1, max_requests // 10)
+        self.max_por_host = max_por_host
+        self.max_por_token = max_por_token
         self.lock = Lock()
+        self.bucket_global = self._novo_bucket(max_requests)
+        self.buckets_host = {}
+        self.buckets_token = {}
+        self.total_requisicoes = 0
+        self.total_esperas = 0
+        self.tempo_espera_total = 0.0
+
+    def _novo_bucket(self, max_requests):
+        burst = min(self.burst, max_requests)
+        taxa = max(max_requests - burst, 1) / self.time_window
+        return TokenBucket(burst, taxa)
+
+    def _buckets(self, host, token):
+        buckets = [self.bucket_global]
+        if host and self.max_por_host:
+            if host not in self.buckets_host:
+                self.buckets_host[host] = self._novo_bucket(self.max_por_host)
+            buckets.append(self.buckets_host[host])
+        if token and self.max_por_token:
+            if token not in self.buckets_token:
+                self.buckets_token[token] = self._novo_bucket(self.max_por_token)
+            buckets.append(self.buckets_token[token])
+        return buckets
 
-    def wait_if_needed(self):
+    def wait_if_needed(self, host=None, token=None):
+        # Reserva os tokens sob o lock e dorme fora dele, sem travar as outras threads
         with self.lock:
-            now = datetime.now()
-            self.requests = [req_time for req_time in self.requests 
-                           if now - req_time < timedelta(seconds=self.time_window)]
-            
-            if len(self.requests) >= self.max_requests:
-                oldest = min(self.requests)
-                sleep_time = (oldest + timedelta(seconds=self.time_window) - now).total_seconds()
-                if sleep_time > 0:
-                    print(f"Rate limit IUGU atingido. Aguardando {sleep_time:.2f} segundos...")
-                    sleep(sleep_time)
-                self.requests = []
-            
-            self.requests.append(now)
+            agora = monotonic()
+            sleep_time = max(bucket.reservar(agora) for bucket in self._buckets(host, token))
+            self.total_requisicoes += 1
+            if sleep_time > 0:
+                self.total_esperas += 1
+                self.tempo_espera_total += sleep_time
+        # Uma medição por requisição admitida: vai só para o histograma (resumo no JSONL em exportar)
+        metricas.acumular("iugu_rate_limit_espera_segundos", sleep_time)
+        
+        if sleep_time > 0:
+            if sleep_time >= 1:
+                print(f"Rate limit IUGU atingido. Aguardando {sleep_time:.2f} segundos...")
+            sleep(sleep_time)
+
+    def stats(self):
+        """Retorna as estatísticas atuais do limiter."""
+        with self.lock:
+            bucket = self.bucket_global
+            tokens = min(bucket.capacidade, bucket.tokens + (monotonic() - bucket.ultimo) * bucket.taxa)
+            return {
+                "tokens_restantes": max(tokens, 0.0),
+                "requisicoes": self.total_requisicoes,
+                "esperas": self.total_esperas,
+                "tempo_espera_total": self.tempo_espera_total,
+            }
+
+# Instância global do rate limiter, com a fatia do orçamento deste shard (limite por token opcional via
+# IUGU_MAX_REQ_POR_TOKEN; cada token fica em um único shard, então esse limite não é dividido)
+rate_limiter = RateLimiter(
+    max_requests=max(IUGU_MAX_REQ // SHARD_COUNT, 1),
+    max_por_token=int(os.getenv('IUGU_MAX_REQ_POR_TOKEN', "0")) or None,
+)
+
+# Cursores por conta ({account: {"transactions_total": n, "saldo_centavos": s}}), carregados no início da varredura
+cursores = {}
+cursores_lock = Lock()
+
+# Tokens das subcontas ({account: live_token_full}), lidos da aba Subcontas; só em memória
+tokens_subcontas = {}
+
+def load_cursores():
+    """Carrega os cursores das contas salvos na última execução"""
+    if Path(CURSORES_FILE).exists():
+        try:
+            with open(CURSORES_FILE, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Erro ao ler cursores ({e}), ignorando cache")
+    return {}
+
+def save_cursores(cursores):
+    """Salva os cursores das contas no arquivo (escrita atômica)"""
+    salvar_json(CURSORES_FILE, cursores)
+
+def atualizar_cursor(account_id, total_transactions, saldo_centavos):
+    """Registra o total e o saldo mais recentes (em centavos) de uma conta."""
+    with cursores_lock:
+        cursores[account_id] = {"transactions_total": total_transactions, "saldo_centavos": saldo_centavos}
+
+def saldo_do_cursor(cursor):
+    """Saldo em centavos guardado no cursor; aceita o formato antigo (saldo_cents em reais, float)."""
+    if "saldo_centavos" in cursor:
+        return cursor["saldo_centavos"]
+    if "saldo_cents" in cursor:
+        return round(cursor["saldo_cents"] * 100)
+    return None
+
+def centavos(valor):
+    """Converte o balance_cents da IUGU (int, float ou texto) em centavos inteiros, sem passar por float."""
+    return int(Decimal(str(valor)))
+
+def formatar_reais(saldo_centavos):
+    """Valor em reais com duas casas, montado a partir dos centavos inteiros (ex.: 123456 -> '1234.56')."""
+    sinal = "-" if saldo_centavos < 0 else ""
+    reais, resto = divmod(abs(saldo_centavos), 100)
+    return f"{sinal}{reais}.{resto:02d}"
+
+class ResultadosContas:
+    """Resultados da varredura em colunas (arrays de inteiros), um slot por conta.
+
+    Cada worker grava direto no índice da sua conta, sem dicts nem DataFrames intermediários;
+    os saldos ficam em centavos inteiros e só viram texto na montagem das linhas da planilha.
+    """
+    __slots__ = ("contas", "totais", "saldos", "preenchidas")
+
+    COLUNAS = ["Account", "transactions_total", "saldo_cents"]
+
+    def __init__(self, contas):
+        self.contas = list(contas)
+        self.totais = array("q", bytes(8 * len(self.contas)))
+        self.saldos = array("q", bytes(8 * len(self.contas)))
+        self.preenchidas = bytearray(len(self.contas))
+
+    def registrar(self, indice, transactions_total, saldo_centavos):
+        # Cada índice é escrito por uma única thread
+        self.totais[indice] = transactions_total
+        self.saldos[indice] = saldo_centavos
+        self.preenchidas[indice] = 1
+
+    def __len__(self):
+        return self.preenchidas.count(1)
+
+    def completar(self, cursores_contas):
+        """Preenche as contas sem resultado com o último valor conhecido (cursores); retorna quantas."""
+        completadas = 0
+        for indice, conta in enumerate(self.contas):
+            if self.preenchidas[indice] or conta not in cursores_contas:
+                continue
+            cursor = cursores_contas[conta]
+            saldo_centavos = saldo_do_cursor(cursor)
+            # Cursor sem saldo (ex.: só o total de transações): a linha fica vazia
+            if saldo_centavos is None:
+                continue
+            self.registrar(indice, cursor.get("transactions_total", 0), saldo_centavos)
+            completadas += 1
+        return completadas
+
+    def linhas(self, copy_head=True):
+        """Linhas de texto da tabela no formato enviado ao Sheets, uma por conta na posição dela.
+
+        Contas sem resultado ficam com total e saldo vazios, para nenhuma linha mudar de posição.
+        """
+        linhas = [list(self.COLUNAS)] if copy_head else []
+        for indice, conta in enumerate(self.contas):
+            if self.preenchidas[indice]:
+                linhas.append([str(conta), str(self.totais[indice]), formatar_reais(self.saldos[indice])])
+            else:
+                linhas.append([str(conta), "", ""])
+        return linhas
+
+def load_estado_planilha():
+    """Carrega a tabela escrita na aba IUGU Subcontas na última execução"""
+    if Path(ESTADO_FILE).exists():
+        try:
+            with open(ESTADO_FILE, 'r') as f:
+                estado = json.load(f)
+            if isinstance(estado, dict) and "linhas" in estado:
+                return estado
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Erro ao ler estado da planilha ({e}), fazendo escrita completa")
+    return None
+
+def save_estado_planilha(inicio, linhas):
+    """Salva a tabela escrita na aba IUGU Subcontas (escrita atômica)"""
+    salvar_json(ESTADO_FILE, {"inicio": list(inicio), "linhas": linhas})
+
+def load_roster():
+    """Carrega o cache das subcontas ativas salvo na última leitura da aba Subcontas"""
+    if Path(ROSTER_FILE).exists():
+        try:
+            with open(ROSTER_FILE, 'r') as f:
+                roster = json.load(f)
+            # Formato antigo guardava pares [conta, token]: descartado e regravado só com os ids
+            if any(isinstance(conta, list) for conta in roster["ativas"]):
+                print("Cache das subcontas no formato antigo (com tokens), ignorando cache")
+                return None
+            return roster
+        except (OSError, json.JSONDecodeError, KeyError, TypeError) as e:
+            print(f"Erro ao ler cache das subcontas ({e}), ignorando cache")
+    return None
+
+def save_roster(roster):
+    """Salva o cache das subcontas ativas (escrita atômica)"""
+    salvar_json(ROSTER_FILE, roster)
+
+class CheckpointVarredura:
+    """Checkpoint da varredura em um JSONL só de acréscimos: um cabeçalho e uma linha por conta concluída.
+
+    Cada linha vai para o arquivo assim que a conta termina, então uma queda do processo perde no
+    máximo as contas em andamento; uma última linha truncada é descartada na leitura.
+    """
+    def __init__(self, arquivo=CHECKPOINT_FILE):
+        self.arquivo = arquivo
+        self.lock = Lock()
+        self.contas = {}  # account -> (transactions_total, saldo_centavos)
+        self.iniciado_em = None
+        self.f = None
+
+    def carregar(self):
+        """Lê o checkpoint da varredura anterior se ele ainda valer (mesmos shards e dentro da validade)."""
+        if not Path(self.arquivo).exists():
+            return 0
+        try:
+            with open(self.arquivo, 'r') as f:
+                linhas = f.read().splitlines()
+        except OSError as e:
+            print(f"Erro ao ler checkpoint ({e}), ignorando")
+            return 0
+        if not linhas:
+            return 0
+
+        try:
+            cabecalho = json.loads(linhas[0])
+            iniciado_em = datetime.fromisoformat(cabecalho["inicio"])
+        except (ValueError, KeyError) as e:
+            print(f"Cabeçalho do checkpoint inválido ({e}), ignorando")
+            return 0
+        idade = (datetime.now(timezone.utc) - iniciado_em).total_seconds()
+        if (cabecalho.get("shard"), cabecalho.get("shards")) != (SHARD_INDEX, SHARD_COUNT) \
+                or idade > VALIDADE_CHECKPOINT_SEGUNDOS:
+            print(f"Checkpoint ignorado (shard {cabecalho.get('shard')}/{cabecalho.get('shards')}, {idade:.0f}s de idade)")
+            return 0
+
+        for linha in linhas[1:]:
+            if not linha.strip():
+                continue
+            try:
+                registro = json.loads(linha)
+            except json.JSONDecodeError:
+                # Linha truncada pela queda do processo
+                continue
+            self.contas[registro["account"]] = (registro["transactions_total"], registro["saldo_centavos"])
+        self.iniciado_em = iniciado_em
+        return len(self.contas)
+
+    def abrir(self):
+        """Continua o checkpoint carregado ou começa um novo, com o cabeçalho da varredura."""
+        if self.iniciado_em is not None:
+            self.f = open(self.arquivo, 'a')
+            # Garante que a próxima linha não fique colada em uma linha truncada
+            self.f.write("\n")
+            return
+        self.iniciado_em = datetime.now(timezone.utc)
+        self.f = open(self.arquivo, 'w')
+        cabecalho = {"inicio": self.iniciado_em.isoformat(), "shard": SHARD_INDEX, "shards": SHARD_COUNT}
+        self.f.write(json.dumps(cabecalho) + "\n")
+        self.f.flush()
 
-# Instância global do rate limiter
-rate_limiter = RateLimiter()
+    def registrar(self, account, transactions_total, saldo_centavos):
+        linha = json.dumps({"account": account, "transactions_total": transactions_total,
+                            "saldo_centavos": saldo_centavos})
+        with self.lock:
+            self.contas[account] = (transactions_total, saldo_centavos)
+            if self.f is None or self.f.closed:
+                return
+            self.f.write(linha + "\n")
+            self.f.flush()
 
+    def resultados(self, contas):
+        """ResultadosContas com a ordem de `contas`, preenchido só com as contas do checkpoint."""
+        resultados = ResultadosContas(conta for conta, _ in contas)
+        with self.lock:
+            for indice, conta in enumerate(resultados.contas):
+                if conta in self.contas:
+                    resultados.registrar(indice, *self.contas[conta])
+        return resultados
+
+    def fechar(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+
+    def limpar(self):
+        """Esvazia o checkpoint depois de uma varredura completa (o arquivo continua existindo para o cache)."""
+        self.fechar()
+        with open(self.arquivo, 'w'):
+            pass
+        self.contas.clear()
+        self.iniciado_em = None
+
+@metricas.cronometrado("iugu_ssh_conexao_segundos")
 def connect_ssh():
     print("Conectando ao servidor SSH...")
     ssh_client = paramiko.SSHClient()
@@ -63,178 +430,1017 @@ def connect_ssh():
     print("Conexão SSH estabelecida com sucesso.")
     return ssh_client
 
-def execute_curl(ssh_client, url, timeout=30):
-    max_retries = 5 if any(acc in url for acc in CONTAS_GRANDES) else 2
+def preparar_url(url):
+    """Aplica o limite padrão (só quando a chamada não definiu o seu próprio) e separa a URL."""
+    if "limit=" not in url:
+        url += "&limit=50" if "?" in url else "?limit=50"
+    
+    partes_url = urlparse(url)
+    token = parse_qs(partes_url.query).get("api_token", [None])[0]
+    return url, partes_url, token
+
+class RespostaNaoJSON(ValueError):
+    """A IUGU (ou o proxy) respondeu com texto que não é JSON, ex.: 'error code: 504'."""
+    def __init__(self, texto):
+        super().__init__(texto[:200])
+        self.texto = texto
+
+# Erros de JSON malformado no meio do stream (json e ijson)
+ERROS_JSON = (ValueError, UnicodeDecodeError) + ((ijson.JSONError,) if ijson else ())
+
+class _FluxoComPrefixo:
+    """Devolve os bytes já lidos do início da resposta antes de continuar lendo o stream original."""
+    def __init__(self, prefixo, fluxo):
+        self.prefixo = prefixo
+        self.fluxo = fluxo
+        self.lidos = len(prefixo)
+
+    def read(self, size=-1):
+        if self.prefixo:
+            if size is None or size < 0:
+                dados = self.prefixo + self.fluxo.read()
+                self.lidos += len(dados) - len(self.prefixo)
+                self.prefixo = b""
+            else:
+                dados, self.prefixo = self.prefixo[:size], self.prefixo[size:]
+            return dados
+        dados = self.fluxo.read(size)
+        self.lidos += len(dados)
+        return dados
+
+def _resumir_resposta(dados):
+    """Mantém só a última transação da resposta e registra quantas vieram."""
+    transacoes = dados.get("transactions") or []
+    dados["transactions_recebidas"] = len(transacoes)
+    dados["transactions"] = transacoes[-1:]
+    return dados
+
+def ler_resposta_iugu(fluxo, transporte="curl"):
+    """Decodifica a resposta da IUGU direto do stream, sem montar a lista de transações em memória.
+
+    Retorna os campos simples do objeto (ex.: transactions_total), `transactions` só com a
+    última transação e `transactions_recebidas` com a quantidade recebida. A leitura para
+    assim que a lista de transações termina e o transactions_total já foi visto.
+    Levanta RespostaNaoJSON quando o corpo não é um objeto JSON.
+    """
+    inicio = fluxo.read(64)
+    if not inicio.lstrip().startswith(b"{"):
+        texto = inicio + fluxo.read(4096)
+        metricas.incrementar("iugu_bytes_recebidos_total", len(texto), transporte=transporte)
+        raise RespostaNaoJSON(texto.decode("utf-8", "replace"))
+    fluxo = _FluxoComPrefixo(inicio, fluxo)
+
+    # Os bytes contados são os do corpo já descompactado
+    try:
+        with metricas.medir("iugu_leitura_resposta_segundos", transporte=transporte):
+            return _decodificar_resposta(fluxo)
+    finally:
+        metricas.incrementar("iugu_bytes_recebidos_total", fluxo.lidos, transporte=transporte)
+
+def _decodificar_resposta(fluxo):
+    if ijson is None:
+        return _resumir_resposta(json.load(fluxo))
+
+    resposta = {}
+    ultima = None
+    recebidas = 0
+    construtor = None
+    for prefixo, evento, valor in ijson.parse(fluxo, use_float=True):
+        if construtor is not None:
+            # Montando a transação atual; a anterior já foi descartada
+            construtor.event(evento, valor)
+            if prefixo == "transactions.item" and evento in ("end_map", "end_array"):
+                ultima, construtor = construtor.value, None
+                recebidas += 1
+        elif prefixo == "transactions.item":
+            if evento in ("start_map", "start_array"):
+                construtor = ijson.ObjectBuilder()
+                construtor.event(evento, valor)
+            else:
+                ultima = valor
+                recebidas += 1
+        elif prefixo == "transactions" and evento == "end_array":
+            if "transactions_total" in resposta:
+                break
+        elif prefixo and "." not in prefixo and evento in ("string", "number", "boolean", "null"):
+            resposta[prefixo] = valor
+
+    resposta["transactions"] = [ultima] if recebidas else []
+    resposta["transactions_recebidas"] = recebidas
+    return resposta
+
+def aguardar_retentativa(tentativa, max_retries, segundos):
+    """Espera antes da próxima tentativa; depois da última não espera (quem chamou decide o que fazer)."""
+    if tentativa + 1 < max_retries:
+        sleep(segundos)
+
+def execute_curl(ssh_client, url, timeout=30, max_retries=2):
+    url, partes_url, token = preparar_url(url)
     
     for attempt in range(max_retries):
+        if attempt:
+            metricas.incrementar("iugu_retentativas_total", transporte="curl")
         try:
-            if "?" in url:
-                url += "&limit=50"
-            else:
-                url += "?limit=50"
-                
             curl_cmd = f'curl -s -m {timeout} "{url}" -H "accept: application/json"'
             print(f"Tentativa {attempt + 1}/{max_retries}: Executando consulta...")
             
+            # Todas as threads passam pelo mesmo rate limiter antes de abrir um canal
+            rate_limiter.wait_if_needed(host=partes_url.netloc, token=token)
+            inicio = perf_counter()
             stdin, stdout, stderr = ssh_client.exec_command(curl_cmd, timeout=timeout)
-            error = stderr.read().decode('utf-8')
-            response = stdout.read().decode('utf-8')
             
-            if error:
-                print(f"Erro no curl: {error}")
-                sleep(5)
+            # Lê o stdout em stream; o stderr só é consultado quando a resposta não veio
+            try:
+                dados = ler_resposta_iugu(stdout, transporte="curl")
+            except RespostaNaoJSON as e:
+                error = stderr.read().decode('utf-8')
+                if error:
+                    print(f"Erro no curl: {error}")
+                    metricas.incrementar("iugu_falhas_total", transporte="curl", motivo="curl")
+                    aguardar_retentativa(attempt, max_retries, 5)
+                elif "error code: 504" in e.texto:
+                    print("Erro 504 detectado, aguardando...")
+                    metricas.incrementar("iugu_falhas_total", transporte="curl", motivo="504")
+                    aguardar_retentativa(attempt, max_retries, 10)
+                else:
+                    print(f"Erro ao decodificar JSON: {e.texto[:200]}...")
+                    metricas.incrementar("iugu_falhas_total", transporte="curl", motivo="json")
+                    aguardar_retentativa(attempt, max_retries, 5)
+                continue
+            except ERROS_JSON as e:
+                print(f"Erro ao decodificar JSON: {e}")
+                metricas.incrementar("iugu_falhas_total", transporte="curl", motivo="json")
+                aguardar_retentativa(attempt, max_retries, 5)
                 continue
+            finally:
+                # A leitura pode parar antes do fim da resposta
+                stdout.channel.close()
+            
+            metricas.observar("iugu_requisicao_segundos", perf_counter() - inicio, transporte="curl")
+            return dados
                 
-            if "error code: 504" in response:
+        except Exception as e:
+            print(f"Erro na tentativa {attempt + 1}: {e}")
+            metricas.incrementar("iugu_falhas_total", transporte="curl", motivo="excecao")
+            aguardar_retentativa(attempt, max_retries, 5)
+            
+    return None
+
+class TunelIndisponivel(Exception):
+    """O servidor SSH não permitiu abrir o port forward (direct-tcpip)."""
+
+def _bombear(canal, sock):
+    """Copia bytes entre o canal direct-tcpip e a ponta local do socketpair até um dos lados fechar."""
+    try:
+        while True:
+            prontos, _, _ = select.select([canal, sock], [], [])
+            if canal in prontos:
+                dados = canal.recv(65536)
+                if not dados:
+                    break
+                sock.sendall(dados)
+            if sock in prontos:
+                dados = sock.recv(65536)
+                if not dados:
+                    break
+                canal.sendall(dados)
+    except (OSError, EOFError):
+        pass
+    finally:
+        canal.close()
+        sock.close()
+
+class ConexaoTunel(http.client.HTTPSConnection):
+    """Conexão HTTPS cujo socket é um port forward direct-tcpip da sessão SSH."""
+    def __init__(self, transport, host, port=443, timeout=30):
+        super().__init__(host, port, timeout=timeout, context=ssl.create_default_context(cafile=IUGU_CA_FILE))
+        self.transport = transport
+
+    def connect(self):
+        try:
+            canal = self.transport.open_channel(
+                "direct-tcpip", (self.host, self.port), ("127.0.0.1", 0), timeout=self.timeout
+            )
+        except paramiko.ChannelException as e:
+            raise TunelIndisponivel(e)
+        
+        # O TLS precisa de um socket de verdade: usa um socketpair e bombeia os bytes para o canal
+        local, remoto = socket.socketpair()
+        Thread(target=_bombear, args=(canal, remoto), daemon=True).start()
+        local.settimeout(self.timeout)
+        self.sock = self._context.wrap_socket(local, server_hostname=self.host)
+
+class PoolTunel:
+    """Pool de conexões HTTPS keep-alive para um host, todas passando pelo mesmo transport SSH."""
+    def __init__(self, transport, host, port=443):
+        self.transport = transport
+        self.host = host
+        self.port = port
+        self.livres = queue.LifoQueue()
+
+    def obter(self, timeout):
+        try:
+            conn = self.livres.get_nowait()
+        except queue.Empty:
+            conn = ConexaoTunel(self.transport, self.host, self.port, timeout=timeout)
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def devolver(self, conn):
+        self.livres.put(conn)
+
+    def fechar(self):
+        while not self.livres.empty():
+            self.livres.get_nowait().close()
+
+# Pools por (transport, host); transports em que o port forward foi recusado usam só o curl
+pools_tunel = {}
+tuneis_recusados = set()
+pools_lock = Lock()
+
+def get_pool_tunel(ssh_client, host, port):
+    transport = ssh_client.get_transport()
+    with pools_lock:
+        chave = (id(transport), host, port)
+        if chave not in pools_tunel:
+            pools_tunel[chave] = PoolTunel(transport, host, port)
+        return pools_tunel[chave]
+
+def close_tunnels():
+    """Fecha as conexões keep-alive abertas pelos túneis."""
+    with pools_lock:
+        for pool in pools_tunel.values():
+            pool.fechar()
+        pools_tunel.clear()
+
+def execute_tunnel(ssh_client, url, timeout=30, max_retries=2):
+    """Executa a consulta por HTTP keep-alive através de um port forward na sessão SSH."""
+    url, partes_url, token = preparar_url(url)
+    port = partes_url.port or 443
+    pool = get_pool_tunel(ssh_client, partes_url.hostname, port)
+    caminho = f"{partes_url.path}?{partes_url.query}"
+    
+    for attempt in range(max_retries):
+        conn = None
+        reutilizada = False
+        if attempt:
+            metricas.incrementar("iugu_retentativas_total", transporte="tunel")
+        try:
+            print(f"Tentativa {attempt + 1}/{max_retries}: Executando consulta (túnel)...")
+            rate_limiter.wait_if_needed(host=partes_url.netloc, token=token)
+            
+            inicio = perf_counter()
+            conn = pool.obter(timeout)
+            reutilizada = conn.sock is not None
+            conn.request("GET", caminho, headers={
+                "accept": "application/json",
+                "accept-encoding": "gzip",
+            })
+            resp = conn.getresponse()
+            
+            if resp.status == 504:
+                resp.read()
+                pool.devolver(conn)
                 print("Erro 504 detectado, aguardando...")
-                sleep(10)
+                metricas.incrementar("iugu_falhas_total", transporte="tunel", motivo="504")
+                aguardar_retentativa(attempt, max_retries, 10)
                 continue
             
+            # Descompacta e decodifica direto do stream, sem montar a resposta inteira em memória
+            corpo = gzip.GzipFile(fileobj=resp) if resp.getheader("content-encoding") == "gzip" else resp
             try:
-                return json.loads(response)
-            except json.JSONDecodeError:
-                print(f"Erro ao decodificar JSON: {response[:200]}...")
-                sleep(5)
+                dados = ler_resposta_iugu(corpo, transporte="tunel")
+            except ERROS_JSON + (OSError,) as e:
+                print(f"Erro ao decodificar JSON (HTTP {resp.status}): {e}")
+                metricas.incrementar("iugu_falhas_total", transporte="tunel", motivo="json")
+                conn.close()
+                aguardar_retentativa(attempt, max_retries, 5)
                 continue
-                
-        except Exception as e:
-            print(f"Erro na tentativa {attempt + 1}: {e}")
-            sleep(5)
             
+            # A leitura pode parar antes do fim do corpo: descarta o resto para reaproveitar a conexão
+            resp.read()
+            if resp.will_close:
+                conn.close()
+            else:
+                pool.devolver(conn)
+            metricas.observar("iugu_requisicao_segundos", perf_counter() - inicio, transporte="tunel")
+            return dados
+        
+        except TunelIndisponivel:
+            raise
+        except Exception as e:
+            print(f"Erro na tentativa {attempt + 1} (túnel): {e}")
+            metricas.incrementar("iugu_falhas_total", transporte="tunel", motivo="excecao")
+            if conn:
+                conn.close()
+            # Conexão keep-alive encerrada pelo servidor: tenta de novo na hora com uma conexão nova
+            if not (reutilizada and isinstance(e, ConnectionError)):
+                aguardar_retentativa(attempt, max_retries, 5)
+    
     return None
 
+def consultar_iugu(ssh_client, url, timeout=30, max_retries=2):
+    """Consulta a IUGU pelo túnel HTTP; usa o curl remoto quando o túnel não está disponível.
+
+    `max_retries` tentativas no transporte; quem faz o próprio backoff (contas grandes) passa 1.
+    """
+    transport = ssh_client.get_transport()
+    if IUGU_TRANSPORTE == "tunel" and id(transport) not in tuneis_recusados:
+        try:
+            return execute_tunnel(ssh_client, url, timeout=timeout, max_retries=max_retries)
+        except TunelIndisponivel as e:
+            print(f"Port forward recusado pelo servidor SSH ({e}), usando curl remoto")
+            tuneis_recusados.add(id(transport))
+    return execute_curl(ssh_client, url, timeout=timeout, max_retries=max_retries)
+
+def espera_backoff(tentativa, base=2, maximo=60):
+    """Tempo de espera com backoff exponencial e jitter ("full jitter") para a tentativa informada."""
+    return random.uniform(0, min(maximo, base * 2 ** tentativa))
+
+class PrazoEsgotado(Exception):
+    """O prazo de processamento da conta grande terminou."""
+
+def localizar_cauda(buscar_janela, inicio, janela, max_sondagens=64):
+    """Encontra a última transação da conta buscando janelas de `janela` transações a partir de `start`.
+
+    Parte de `inicio` (posição prevista da última transação) e avança com passos dobrados
+    enquanto a janela volta cheia, ou recua da mesma forma enquanto volta vazia; com a cauda
+    cercada, termina com busca binária. Uma janela parcial contém a cauda.
+    `buscar_janela(start, limit)` retorna (quantidade recebida, última transação da janela)
+    ou None em caso de falha.
+    Retorna (posição da última transação, transação), ou (-1, None) para conta sem transações.
+    """
+    existe, ultima = -1, None  # maior posição que sabidamente existe e a transação dela
+    vazia = None               # menor posição que sabidamente não existe
+    passo = janela
+    start = max(inicio, 0)
+
+    for _ in range(max_sondagens):
+        resultado = buscar_janela(start, janela)
+        if resultado is None:
+            return None
+
+        quantidade, ultima_janela = resultado
+        if quantidade:
+            existe, ultima = start + quantidade - 1, ultima_janela
+            if quantidade < janela or vazia == existe + 1:
+                return existe, ultima
+        else:
+            vazia = start
+            if existe == start - 1:
+                return existe, ultima
+
+        if vazia is None:
+            # Janela cheia: a cauda está mais à frente
+            start = existe + passo
+            passo *= 2
+        elif existe < 0 and start > 0:
+            # Janela vazia sem nenhuma posição conhecida antes dela: recua
+            start = max(0, vazia - passo)
+            passo *= 2
+        elif vazia - existe - 1 <= janela:
+            # O que falta cabe em uma janela: a próxima busca traz a cauda
+            start = existe + 1
+        else:
+            start = (existe + 1 + vazia) // 2
+
+    print(f"Cauda não encontrada após {max_sondagens} consultas")
+    return None
+
+@metricas.cronometrado("iugu_conta_segundos", tipo="grande")
 def get_account_balance_large(ssh_client, token, account_id):
-    """Função específica para contas com muitas transações"""
+    """Função específica para contas com muitas transações.
+
+    Cada conta tem o próprio prazo; as consultas que falham são repetidas com backoff
+    exponencial com jitter, e a última transação é localizada com `localizar_cauda`.
+    """
     config = CONTAS_GRANDES[account_id]  # Pega configuração específica da conta
     timeout = config["timeout"]
     max_retries = config["retries"]
-    batch_size = config["batch_size"]
+    batch_size = max(int(config.get("batch_size", 1)), 1)
+    prazo = monotonic() + config.get("prazo", PRAZO_CONTAS_GRANDES)
 
     print(f"\nProcessando conta grande: {account_id}")
-    
+
+    def consultar(url):
+        """Consulta respeitando o prazo da conta, com backoff entre as tentativas.
+
+        Cada tentativa é uma única requisição limitada ao tempo restante: as retentativas e
+        esperas ficam só aqui, então o prazo não é ultrapassado por esperas do transporte.
+        """
+        for attempt in range(max_retries):
+            restante = prazo - monotonic()
+            if restante <= 0:
+                raise PrazoEsgotado()
+            response = consultar_iugu(ssh_client, url, timeout=min(timeout, max(int(restante), 1)), max_retries=1)
+            if response and "transactions_total" in response:
+                return response
+            metricas.incrementar("iugu_retentativas_total", transporte="conta_grande")
+            if attempt + 1 < max_retries:
+                espera = min(espera_backoff(attempt), max(prazo - monotonic(), 0))
+                print(f"Tentativa {attempt + 1} falhou para a conta {account_id}, aguardando {espera:.1f} segundos...")
+                sleep(espera)
+        return None
+
+    def buscar_janela(start, limit):
+        print(f"Buscando transações da conta {account_id} (posição {start}, janela {limit})")
+        response = consultar(f"{url_financial}?api_token={token}&start={start}&limit={limit}")
+        if not response:
+            return None
+        transacoes = response.get("transactions") or []
+        return response.get("transactions_recebidas", len(transacoes)), (transacoes[-1] if transacoes else None)
+
     try:
-        # Primeira chamada para pegar o total
-        response = execute_curl(ssh_client, f"{url_financial}?api_token={token}", timeout=timeout)
-        if not response or "transactions_total" not in response:
+        # Posição prevista: cursor da execução anterior ou o total informado pela IUGU
+        cursor = cursores.get(account_id, {})
+        response = consultar(f"{url_financial}?api_token={token}&limit=1")
+        if not response:
             print("Não foi possível obter o total de transações")
             return None
 
         total_transactions = response["transactions_total"]
         print(f"Total de transações: {total_transactions}")
 
-        # Para contas muito grandes, vamos direto para o final
-        start = total_transactions - 1 if total_transactions > 0 else 0
-        
-        # Tenta pegar a última transação
-        for attempt in range(max_retries):
-            url = f"{url_financial}?api_token={token}&start={start}&limit=1"
-            print(f"Tentando pegar última transação (posição {start})")
-            
-            response = execute_curl(ssh_client, url, timeout=timeout)
-            
-            if response and response.get("transactions"):
-                last_transaction = response["transactions"][0]  # Pegamos apenas a última
-                saldo_cents = float(last_transaction["balance_cents"]) / 100
-                print(f"Saldo encontrado: R$ {saldo_cents:,.2f}")
-                return {
-                    "Account": account_id,
-                    "transactions_total": total_transactions,
-                    "saldo_cents": saldo_cents
-                }
-            
-            print(f"Tentativa {attempt + 1} falhou, aguardando 30 segundos...")
-            sleep(30)
-    
+        # Sem transações novas desde a última execução, o saldo não mudou
+        saldo_anterior = saldo_do_cursor(cursor)
+        if IUGU_INCREMENTAL and cursor.get("transactions_total") == total_transactions and saldo_anterior is not None:
+            print(f"Conta sem novas transações, saldo mantido: R$ {formatar_reais(saldo_anterior)}")
+            return total_transactions, saldo_anterior
+
+        # O total pode estar defasado; a busca parte da posição prevista e corrige nos dois sentidos
+        cauda = localizar_cauda(buscar_janela, total_transactions - 1, batch_size)
+        if cauda is None:
+            print(f"Não foi possível localizar a última transação da conta {account_id}")
+            return None
+
+        posicao, last_transaction = cauda
+        if last_transaction is None:
+            print(f"Conta {account_id} não possui transações")
+            return 0, 0
+
+        total_transactions = posicao + 1
+        saldo_centavos = centavos(last_transaction["balance_cents"])
+        print(f"Saldo encontrado: R$ {formatar_reais(saldo_centavos)} (posição {posicao})")
+        atualizar_cursor(account_id, total_transactions, saldo_centavos)
+        return total_transactions, saldo_centavos
+
+    except PrazoEsgotado:
+        print(f"Prazo da conta grande {account_id} esgotado")
+        return None
     except Exception as e:
         print(f"Erro ao processar conta grande {account_id}: {e}")
         return None
 
+@metricas.cronometrado("iugu_conta_segundos", tipo="normal")
 def get_account_balance(ssh_client, token, account_id):
     try:
         timeout = 300 if account_id in CONTAS_GRANDES else 30
         max_retries = 5 if account_id in CONTAS_GRANDES else 3
         
-        # Primeiro pega o total de transações
-        response = execute_curl(ssh_client, f"{url_financial}?api_token={token}", timeout=timeout)
+        response = None
+        
+        # Com cursor salvo, vai direto para a posição prevista da última transação
+        cursor = cursores.get(account_id)
+        if cursor and cursor.get("transactions_total", 0) > 0:
+            previsto = cursor["transactions_total"]
+            response = consultar_iugu(ssh_client,
+                                   f"{url_financial}?api_token={token}&start={previsto - 1}&limit=1",
+                                   timeout=timeout)
+            
+            if response and response.get("transactions_total") == previsto and response.get("transactions"):
+                saldo_centavos = centavos(response["transactions"][-1]["balance_cents"])
+                print(f"Saldo encontrado (cursor): R$ {formatar_reais(saldo_centavos)}")
+                atualizar_cursor(account_id, previsto, saldo_centavos)
+                return previsto, saldo_centavos
+            print(f"Cursor da conta {account_id} desatualizado, buscando nova posição...")
+        
+        # Sem cursor (ou consulta falhou): pega o total de transações
+        if not response or "transactions_total" not in response:
+            response = consultar_iugu(ssh_client, f"{url_financial}?api_token={token}&limit=1", timeout=timeout)
         
         if not response:
             print(f"Token inválido ou erro de conexão para conta {account_id}")
-            return {
-                "Account": account_id,
-                "transactions_total": 0,
-                "saldo_cents": 0
-            }
+            return 0, 0
             
         if response.get("transactions_total", 0) == 0:
             print(f"Conta {account_id} não possui transações")
-            return {
-                "Account": account_id,
-                "transactions_total": 0,
-                "saldo_cents": 0
-            }
+            return 0, 0
             
         total_transactions = response["transactions_total"]
         print(f"Total de transações: {total_transactions}")
         
-        # Se tem transações, pega as últimas
-        start = max(0, total_transactions - 50)
-        response = execute_curl(ssh_client, 
-                             f"{url_financial}?api_token={token}&start={start}",
-                             timeout=timeout)
+        # Se tem transações, pega apenas a última
+        response = consultar_iugu(ssh_client,
+                               f"{url_financial}?api_token={token}&start={total_transactions - 1}&limit=1",
+                               timeout=timeout)
         
         if response and response.get("transactions"):
             last_transaction = response["transactions"][-1]
-            saldo_cents = float(last_transaction["balance_cents"]) / 100
-            print(f"Saldo encontrado: R$ {saldo_cents:,.2f}")
-            return {
-                "Account": account_id,
-                "transactions_total": total_transactions,
-                "saldo_cents": saldo_cents
-            }
+            saldo_centavos = centavos(last_transaction["balance_cents"])
+            print(f"Saldo encontrado: R$ {formatar_reais(saldo_centavos)}")
+            atualizar_cursor(account_id, total_transactions, saldo_centavos)
+            return total_transactions, saldo_centavos
         
         print(f"Erro ao obter transações para conta {account_id}")
                 
     except Exception as e:
         print(f"Erro ao processar conta {account_id}: {e}")
     
+    return 0, 0
+
+def registrar_resultado(resultados, indice, checkpoint, account, transactions_total, saldo_centavos):
+    """Grava o resultado no slot da conta e no checkpoint (só saldos encontrados; as demais são refeitas)."""
+    resultados.registrar(indice, transactions_total, saldo_centavos)
+    if checkpoint is not None and transactions_total > 0:
+        checkpoint.registrar(account, transactions_total, saldo_centavos)
+
+def processar_conta_normal(resultados, indice, ssh_client, token, account, checkpoint=None):
+    """Consulta o saldo de uma conta normal e grava no slot dela; executada em paralelo pelo pool de threads."""
+    transactions_total, saldo_centavos = get_account_balance(ssh_client, token, account)
+    registrar_resultado(resultados, indice, checkpoint, account, transactions_total, saldo_centavos)
+    print(f"Resultado {account}: saldo R$ {formatar_reais(saldo_centavos)} | "
+          f"total transações {transactions_total}")
+
+def processar_conta_grande(resultados, indice, ssh_client, token, account, checkpoint=None):
+    """Consulta uma conta grande; se a busca dedicada falhar, tenta o método das contas normais."""
+    resultado = get_account_balance_large(ssh_client, token, account)
+    metodo = "grande"
+
+    if not resultado:
+        print(f"Conta {account} não retornou dados válidos, usando método alternativo")
+        resultado = get_account_balance(ssh_client, token, account)
+        metodo = "método alternativo"
+
+    transactions_total, saldo_centavos = resultado
+    registrar_resultado(resultados, indice, checkpoint, account, transactions_total, saldo_centavos)
+    print(f"Resultado {account} ({metodo}): saldo R$ {formatar_reais(saldo_centavos)} | "
+          f"total transações {transactions_total}")
+
+def export_resultados(writer, wks_IUGU_subacc, resultados, inicio=(2, 1)):
+    """Agenda a tabela de resultados na aba IUGU Subcontas e retorna as linhas para salvar como estado.
+
+    No modo incremental o espelho do writer parte da tabela da última execução,
+    então só as células que mudaram são enviadas. Se a tabela anterior era maior, as linhas
+    que sobram são esvaziadas (o set_values não apaga células).
+    """
+    estado = load_estado_planilha()
+    if estado and IUGU_INCREMENTAL:
+        writer.carregar_espelho(wks_IUGU_subacc, estado["linhas"], tuple(estado["inicio"]))
+    
+    linhas = resultados.linhas(copy_head=True)
+    if estado:
+        sobra = len(estado["linhas"]) - len(linhas)
+        writer.set_values(wks_IUGU_subacc, inicio, linhas + [[""] * len(ResultadosContas.COLUNAS)] * max(sobra, 0))
+    else:
+        # Sem o estado da última execução não se sabe o tamanho da tabela anterior: limpa abaixo da nova
+        with metricas.medir("sheets_chamada_segundos", operacao="clear"):
+            wks_IUGU_subacc.clear(start=f"A{inicio[0] + len(linhas)}", end=f"C{wks_IUGU_subacc.rows}")
+        writer.set_values(wks_IUGU_subacc, inicio, linhas)
+    return linhas
+
+def shard_da_conta(account):
+    """Shard responsável pela conta; estável entre execuções e entre processos."""
+    return zlib.crc32(str(account).encode()) % SHARD_COUNT
+
+def separar_contas(contas_ativas):
+    """Separa as subcontas ativas (ids) em grandes e normais, mantendo a ordem da aba Subcontas."""
     return {
-        "Account": account_id,
-        "transactions_total": 0,
-        "saldo_cents": 0
+        "grandes": [conta for conta in contas_ativas if conta in CONTAS_GRANDES],
+        "normais": [conta for conta in contas_ativas if conta not in CONTAS_GRANDES],
+    }
+
+def varrer_contas(ssh_client, contas_grandes, contas_normais, checkpoint=None):
+    """Consulta o saldo das contas e retorna o ResultadosContas preenchido (grandes primeiro).
+
+    Contas que já estão no checkpoint (varredura anterior interrompida) não são consultadas de novo.
+    """
+    # Cada conta tem um slot fixo no armazenamento de resultados, preenchido pelo worker dela
+    resultados = ResultadosContas(conta for conta, _ in contas_grandes + contas_normais)
+    
+    pendentes_grandes, pendentes_normais = [], []
+    for indice, (conta, token) in enumerate(contas_grandes + contas_normais):
+        if checkpoint is not None and conta in checkpoint.contas:
+            transactions_total, saldo_centavos = checkpoint.contas[conta]
+            resultados.registrar(indice, transactions_total, saldo_centavos)
+            atualizar_cursor(conta, transactions_total, saldo_centavos)
+        elif indice < len(contas_grandes):
+            pendentes_grandes.append((indice, conta, token))
+        else:
+            pendentes_normais.append((indice, conta, token))
+    
+    # Contas grandes rodam em um pool próprio, em paralelo com as normais,
+    # para que as mais lentas não segurem o restante da execução
+    print(f"\nProcessando {len(pendentes_grandes)} contas com muitas transações "
+          f"com até {MAX_WORKERS_GRANDES} consultas simultâneas...")
+    executor_grandes = ThreadPoolExecutor(max_workers=max(MAX_WORKERS_GRANDES, 1))
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        futuros_grandes = [
+            executor_grandes.submit(processar_conta_grande, resultados, indice, ssh_client, token, conta, checkpoint)
+            for indice, conta, token in pendentes_grandes
+        ]
+        
+        # Processa contas normais em paralelo, cada consulta em um canal próprio da sessão SSH
+        print(f"\nProcessando {len(pendentes_normais)} contas normais com até {MAX_WORKERS} consultas simultâneas...")
+        futuros = [
+            executor.submit(processar_conta_normal, resultados, indice, ssh_client, token, conta, checkpoint)
+            for indice, conta, token in pendentes_normais
+        ]
+        for futuro in futuros_grandes + futuros:
+            futuro.result()
+    except BaseException:
+        # Interrompida: descarta as contas que ainda não começaram, sem esperar as que estão em andamento
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor_grandes.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    executor_grandes.shutdown()
+    return resultados
+
+def save_parcial(resultados, indices, completo=True):
+    """Salva o resultado deste shard (linhas com a posição na tabela completa e cursores das contas)."""
+    Path(PARCIAIS_DIR).mkdir(parents=True, exist_ok=True)
+    contas = [
+        [indices[i], conta, resultados.totais[i], resultados.saldos[i]]
+        for i, conta in enumerate(resultados.contas) if resultados.preenchidas[i]
+    ]
+    with cursores_lock:
+        cursores_shard = {conta: cursores[conta] for conta in resultados.contas if conta in cursores}
+    parcial = {
+        "shard": SHARD_INDEX,
+        "shards": SHARD_COUNT,
+        "gerado_em": datetime.now(timezone.utc).isoformat(),
+        "completo": completo,
+        "contas": contas,
+        "cursores": cursores_shard,
     }
+    arquivo = Path(PARCIAIS_DIR) / f"parcial_iugu_{SHARD_INDEX}.json"
+    salvar_json(arquivo, parcial)
+    print(f"Parcial do shard {SHARD_INDEX + 1}/{SHARD_COUNT} salvo em {arquivo} ({len(contas)} contas)")
+
+def load_parciais():
+    """Carrega os parciais recentes dos shards, um por índice."""
+    parciais = {}
+    agora = datetime.now(timezone.utc)
+    for arquivo in sorted(Path(PARCIAIS_DIR).glob("parcial_iugu_*.json")):
+        try:
+            with open(arquivo, 'r') as f:
+                parcial = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Erro ao ler parcial {arquivo} ({e}), ignorando")
+            continue
+        idade = (agora - datetime.fromisoformat(parcial["gerado_em"])).total_seconds()
+        if parcial["shards"] != SHARD_COUNT or idade > VALIDADE_PARCIAL_SEGUNDOS:
+            print(f"Parcial {arquivo} ignorado (shards={parcial['shards']}, {idade:.0f}s de idade)")
+            continue
+        parciais[parcial["shard"]] = parcial
+    return parciais
+
+def consolidar_parciais(parciais, contas):
+    """Junta os parciais na tabela completa (`contas`, na ordem do roster); atualiza os cursores globais.
+
+    Contas de shards ausentes ou interrompidos ficam com o último valor conhecido (cursores),
+    sem deslocar as linhas das demais.
+    """
+    resultados = ResultadosContas(contas)
+    posicoes = {conta: indice for indice, conta in enumerate(resultados.contas)}
+    for parcial in parciais.values():
+        for _, conta, transactions_total, saldo_centavos in parcial["contas"]:
+            if conta in posicoes:
+                resultados.registrar(posicoes[conta], transactions_total, saldo_centavos)
+    with cursores_lock:
+        for parcial in parciais.values():
+            cursores.update(parcial["cursores"])
+        completadas = resultados.completar(cursores)
+    if completadas:
+        print(f"{completadas} contas sem parcial nesta rodada ficam com o último saldo conhecido")
+    return resultados
 
 def check_trigger(wks_IUGU_subacc):
     """Verifica se a célula B1 contém TRUE para executar o script."""
     try:
+        inicio = perf_counter()
         status = wks_IUGU_subacc.get_value("B1")
+        # No modo daemon o trigger é verificado a cada poucos segundos: só o histograma, sem linha no JSONL
+        metricas.acumular("sheets_chamada_segundos", perf_counter() - inicio, operacao="get_value")
         return status.strip().upper() == "TRUE"
     except Exception as e:
         print(f"Erro ao verificar trigger: {e}")
         return False
 
-def reset_trigger(wks_IUGU_subacc):
-    """Após a execução, redefine a célula B1 para FALSE."""
-    try:
-        wks_IUGU_subacc.update_value("B1", "FALSE")
-    except Exception as e:
-        print(f"Erro ao resetar trigger: {e}")
+def reset_trigger(writer, wks_IUGU_subacc):
+    """Após a execução, agenda a redefinição da célula B1 para FALSE (enviada no próximo flush)."""
+    writer.update_value(wks_IUGU_subacc, "B1", "FALSE")
 
-def update_status(wks_IUGU_subacc, status):
-    """Atualiza o status de execução na célula A1."""
+def update_status(writer, wks_IUGU_subacc, status):
+    """Atualiza o status de execução na célula A1 imediatamente."""
     try:
-        wks_IUGU_subacc.update_value("A1", status)
+        writer.update_value(wks_IUGU_subacc, "A1", status)
+        writer.flush()
     except Exception as e:
         print(f"Erro ao atualizar status: {e}")
 
-def check_all_accounts():
-    try:
-        print("\nIniciando conexão com Google Sheets...")
-        # Conexão com Google Sheets
+def publicar_resultados(writer, wks_IUGU_subacc, resultados, observacao="", concluida=True):
+    """Escreve a tabela e o status, salva cursores e estado e redefine o trigger em um único envio.
+
+    Com `concluida=False` (varredura parcial) o trigger continua TRUE, para a próxima execução retomar.
+    """
+    if len(resultados):
+        # Atualiza o Google Sheets
+        tz_br = pytz.timezone('America/Sao_Paulo')
+        rodado = datetime.now(pytz.UTC).astimezone(tz_br).strftime("%Y-%m-%d %H:%M:%S")
+        writer.update_value(wks_IUGU_subacc, "A1", f"Última atualização: {rodado}{observacao}")
+
+        # Exporta para o Google Sheets
+        linhas_escritas = export_resultados(writer, wks_IUGU_subacc, resultados)
+        
+        print("\nProcessamento concluído!")
+        print(f"Total de contas processadas: {len(resultados)}")
+        print(f"Execução concluída: {rodado}")
+    else:
+        print("\nNenhum resultado válido foi obtido!")
+        writer.update_value(wks_IUGU_subacc, "A1", "Erro: Nenhum resultado válido obtido")
+    
+    # Salva os cursores para a próxima execução
+    with cursores_lock:
+        save_cursores(cursores)
+    
+    # Reset do trigger
+    if concluida:
+        reset_trigger(writer, wks_IUGU_subacc)
+    
+    # Envia status, tabela e trigger em uma única chamada
+    writer.flush()
+    if len(resultados):
+        save_estado_planilha((2, 1), linhas_escritas)
+
+def merge_shards():
+    """Modo merge: junta os parciais dos shards e escreve a tabela consolidada na aba IUGU Subcontas."""
+    parciais = load_parciais()
+    if not parciais:
+        print(f"Nenhum parcial encontrado em {PARCIAIS_DIR}. Encerrando execução.")
+        return
+    
+    faltando = sorted(set(range(SHARD_COUNT)) - set(parciais))
+    incompletos = sorted(shard for shard, parcial in parciais.items() if not parcial.get("completo", True))
+    print(f"Parciais encontrados: {len(parciais)}/{SHARD_COUNT}")
+    
+    gc = pygsheets.authorize(service_file="controles.json")
+    sh_balance = gc.open("Daily Balance - Nox Pay")
+    wks_IUGU_subacc = sh_balance.worksheet_by_title("IUGU Subcontas")
+    writer = SheetWriter(sh_balance)
+    
+    cursores.update(load_cursores())
+    # O roster dá a tabela completa, inclusive as posições das contas dos shards ausentes;
+    # os shards não compartilham arquivos, então o merge também valida o cache para a próxima execução
+    roster = carregar_subcontas(gc.open("Gateway").worksheet_by_title("Subcontas"), com_tokens=False)
+    resultados = consolidar_parciais(parciais, roster["grandes"] + roster["normais"])
+    pendencias = []
+    if faltando:
+        pendencias.append(f"faltam os shards {', '.join(str(i) for i in faltando)}")
+    if incompletos:
+        pendencias.append(f"shards interrompidos {', '.join(str(i) for i in incompletos)}")
+    observacao = f" (parcial: {'; '.join(pendencias)})" if pendencias else ""
+    # Com shards faltando ou interrompidos o trigger fica ativo e a próxima execução retoma dos checkpoints
+    publicar_resultados(writer, wks_IUGU_subacc, resultados, observacao, concluida=not pendencias)
+
+def conectar_planilhas():
+    """Abre as planilhas usadas pela varredura; retorna (aba Subcontas, planilha do balance, aba IUGU Subcontas)."""
+    print("\nIniciando conexão com Google Sheets...")
+    with metricas.medir("sheets_chamada_segundos", operacao="conexao"):
         gc = pygsheets.authorize(service_file="controles.json")
         sh_gateway = gc.open("Gateway")
         wks_subcontas = sh_gateway.worksheet_by_title("Subcontas")
         sh_balance = gc.open("Daily Balance - Nox Pay")
         wks_IUGU_subacc = sh_balance.worksheet_by_title("IUGU Subcontas")
+    return wks_subcontas, sh_balance, wks_IUGU_subacc
+
+def ler_subcontas(wks_subcontas):
+    """Lê a aba Subcontas e retorna as subcontas ativas como (account, token)."""
+    with metricas.medir("sheets_chamada_segundos", operacao="get_all_records"):
+        registros = wks_subcontas.get_all_records()
+
+    # Filtra apenas subcontas ativas
+    return [(r["account"], r["live_token_full"]) for r in registros if r["NOX"] == "SIM"]
+
+def carregar_subcontas(wks_subcontas, com_tokens=True):
+    """Retorna as subcontas ativas separadas em grandes e normais, usando o cache local quando possível.
+
+    A aba só é baixada de novo quando o modifiedTime da planilha Gateway mudou; se só a
+    lista CONTAS_GRANDES mudou, a separação é refeita a partir do cache. O cache só tem os ids,
+    então com `com_tokens` a aba é lida sempre que os tokens não estão em memória (`tokens_subcontas`).
+    Na prática o cache só economiza chamadas no daemon (tokens em memória entre as varreduras) e no
+    merge (só usa os ids); uma execução avulsa ou um shard do workflow lê a aba direto.
+    """
+    roster = load_roster()
+    tokens_em_memoria = bool(roster) and all(conta in tokens_subcontas for conta in roster["ativas"])
+
+    # Processo novo fora do daemon: a aba vai ser lida de qualquer jeito, então nem consulta o modifiedTime
+    modificado_em = None
+    if not com_tokens or tokens_em_memoria or IUGU_DAEMON:
+        try:
+            with metricas.medir("sheets_chamada_segundos", operacao="modified_time"):
+                modificado_em = wks_subcontas.spreadsheet.updated
+        except Exception as e:
+            print(f"Erro ao consultar a data de modificação da planilha ({e}), lendo a aba Subcontas")
+
+    grandes_config = sorted(CONTAS_GRANDES)
+    cache_valido = bool(roster) and bool(modificado_em) and roster.get("modificado_em") == modificado_em
+    if cache_valido and (tokens_em_memoria or not com_tokens):
+        if roster.get("contas_grandes_config") != grandes_config:
+            roster.update(separar_contas(roster["ativas"]), contas_grandes_config=grandes_config)
+            save_roster(roster)
+        print(f"Subcontas sem alteração desde {modificado_em}, usando cache ({len(roster['ativas'])} ativas)")
+        metricas.incrementar("roster_cache_total", resultado="hit")
+        return roster
+
+    metricas.incrementar("roster_cache_total", resultado="miss")
+    subcontas = ler_subcontas(wks_subcontas)
+    tokens_subcontas.clear()
+    tokens_subcontas.update(subcontas)
+    ativas = [conta for conta, _ in subcontas]
+    roster = {"modificado_em": modificado_em, "ativas": ativas, "contas_grandes_config": grandes_config,
+              **separar_contas(ativas)}
+    if modificado_em:
+        save_roster(roster)
+    print(f"Subcontas lidas da planilha: {len(ativas)} ativas")
+    return roster
+
+def executar_varredura(ssh_client, writer, wks_IUGU_subacc, roster):
+    """Consulta as subcontas (ou a parte deste shard) e publica a tabela ou o parcial."""
+    # Ordem da tabela: contas grandes primeiro, depois as normais (separação já feita no roster)
+    contas_grandes = [(conta, tokens_subcontas[conta]) for conta in roster["grandes"]]
+    contas_normais = [(conta, tokens_subcontas[conta]) for conta in roster["normais"]]
+    indices = list(range(len(contas_grandes) + len(contas_normais)))
+
+    # Com shards, cada processo fica só com as suas contas e guarda a posição delas na tabela completa
+    if SHARD_COUNT > 1:
+        do_shard = [shard_da_conta(conta) == SHARD_INDEX for conta, _ in contas_grandes + contas_normais]
+        indices = [i for i in indices if do_shard[i]]
+        contas_grandes = [c for i, c in enumerate(contas_grandes) if do_shard[i]]
+        contas_normais = [c for i, c in enumerate(contas_normais, len(roster["grandes"])) if do_shard[i]]
+        print(f"Shard {SHARD_INDEX + 1}/{SHARD_COUNT}: {len(indices)} contas, "
+              f"até {rate_limiter.max_requests} requisições por minuto")
+
+    checkpoint = CheckpointVarredura()
+    retomadas = checkpoint.carregar()
+    if retomadas:
+        print(f"Retomando a varredura iniciada em {checkpoint.iniciado_em.isoformat()}: "
+              f"{retomadas} contas já concluídas no checkpoint")
+        metricas.incrementar("iugu_contas_retomadas_total", retomadas)
+    checkpoint.abrir()
+    
+    try:
+        resultados = varrer_contas(ssh_client, contas_grandes, contas_normais, checkpoint)
+        # Com a sessão SSH caída no meio da varredura, as últimas contas voltaram zeradas
+        transporte = ssh_client.get_transport()
+        if transporte is not None and not transporte.is_active():
+            raise ConnectionError("sessão SSH encerrada durante a varredura")
+    except BaseException as e:
+        checkpoint.fechar()
+        publicar_parcial(writer, wks_IUGU_subacc, checkpoint, contas_grandes + contas_normais, indices, e)
+        raise
+    checkpoint.fechar()
+    
+    stats = rate_limiter.stats()
+    print(f"Rate limiter: {stats['requisicoes']} requisições, {stats['esperas']} esperas "
+          f"({stats['tempo_espera_total']:.1f}s no total)")
+    
+    if SHARD_COUNT > 1:
+        # A tabela, os cursores globais e o trigger ficam com o merge
+        save_parcial(resultados, indices)
+    else:
+        publicar_resultados(writer, wks_IUGU_subacc, resultados)
+    checkpoint.limpar()
+
+def publicar_parcial(writer, wks_IUGU_subacc, checkpoint, contas, indices, erro):
+    """Varredura interrompida: publica as contas já concluídas (as do checkpoint), marcadas como parcial.
+
+    Cada conta fica na sua posição da tabela completa; as que não terminaram mantêm o último
+    valor conhecido (cursores), então nenhuma linha se desloca.
+    """
+    parcial = checkpoint.resultados(contas)
+    concluidas = len(parcial)
+    print(f"Varredura interrompida ({type(erro).__name__}: {erro}); "
+          f"{concluidas} de {len(contas)} contas concluídas ficam no checkpoint")
+    if not concluidas:
+        return
+    try:
+        if SHARD_COUNT > 1:
+            # O merge completa as contas que faltam com os cursores
+            save_parcial(parcial, indices, completo=False)
+        else:
+            with cursores_lock:
+                parcial.completar(cursores)
+            publicar_resultados(writer, wks_IUGU_subacc, parcial,
+                                f" (parcial: {concluidas} de {len(contas)} contas)", concluida=False)
+    except Exception as e:
+        print(f"Erro ao publicar o resultado parcial: {e}")
+
+def garantir_ssh(ssh_client):
+    """Reaproveita a sessão SSH enquanto o transport estiver ativo; senão reconecta."""
+    transport = ssh_client.get_transport() if ssh_client else None
+    if transport is not None and transport.is_active():
+        return ssh_client
+    
+    if ssh_client:
+        print("Sessão SSH inativa, reconectando...")
+        close_tunnels()
+        ssh_client.close()
+    ssh_client = connect_ssh()
+    # Keep-alive para a sessão não cair entre uma varredura e outra
+    ssh_client.get_transport().set_keepalive(30)
+    return ssh_client
+
+def executar_daemon():
+    """Modo daemon: verifica o trigger continuamente e varre as contas assim que ele vira TRUE."""
+    if SHARD_COUNT > 1:
+        print("O modo daemon roda a varredura completa; desative SHARD_COUNT para usá-lo.")
+        return
+    
+    print(f"Modo daemon: verificando o trigger a cada {INTERVALO_TRIGGER:.0f} segundos")
+    inicio = monotonic()
+    planilhas = None
+    writer = None
+    ssh_client = None
+    falhas = 0
+    
+    # Os cursores ficam em memória entre as varreduras
+    cursores.update(load_cursores())
+    print(f"Cursores carregados: {len(cursores)} contas")
+    
+    try:
+        while not DAEMON_DURACAO_SEGUNDOS or monotonic() - inicio < DAEMON_DURACAO_SEGUNDOS:
+            try:
+                if planilhas is None:
+                    planilhas = conectar_planilhas()
+                    writer = SheetWriter(planilhas[1])
+                wks_subcontas, _, wks_IUGU_subacc = planilhas
+                
+                if not check_trigger(wks_IUGU_subacc):
+                    sleep(INTERVALO_TRIGGER)
+                    continue
+                
+                print(f"\nTrigger ativo! Iniciando atualização ({datetime.now()})...")
+                # O B1 foi alterado fora do writer: o espelho precisa refletir isso para o FALSE ser reenviado
+                writer.carregar_espelho(wks_IUGU_subacc, [["TRUE"]], (1, 2))
+                update_status(writer, wks_IUGU_subacc, "Atualizando...")
+                
+                # Só baixa a aba Subcontas de novo se a planilha Gateway mudou
+                roster = carregar_subcontas(wks_subcontas)
+                
+                ssh_client = garantir_ssh(ssh_client)
+                executar_varredura(ssh_client, writer, wks_IUGU_subacc, roster)
+                falhas = 0
+                # Métricas exportadas uma vez por varredura, não a cada verificação do trigger
+                metricas.exportar()
+            
+            except Exception as e:
+                print(f"Erro durante a execução: {e}")
+                import traceback
+                print(traceback.format_exc())
+                metricas.exportar()
+                # Reabre as planilhas na próxima volta; o SSH é verificado por garantir_ssh
+                planilhas = None
+                falhas += 1
+                espera = min(5 * 2 ** (falhas - 1), 60)
+                print(f"Tentando novamente em {espera} segundos (falha {falhas} seguida)...")
+                sleep(espera)
+    finally:
+        metricas.exportar()
+        if ssh_client:
+            close_tunnels()
+            ssh_client.close()
+    print("Tempo de vida do daemon esgotado. Encerrando.")
+
+def verificar_trigger():
+    """Modo trigger: lê só a célula B1 e informa ao workflow (GITHUB_OUTPUT) se a varredura deve rodar."""
+    gc = pygsheets.authorize(service_file="controles.json")
+    wks_IUGU_subacc = gc.open("Daily Balance - Nox Pay").worksheet_by_title("IUGU Subcontas")
+    ativo = check_trigger(wks_IUGU_subacc)
+    print("Trigger ativo! Os shards serão executados." if ativo else "Trigger não está ativo (B1 = FALSE).")
+    saida = os.getenv('GITHUB_OUTPUT')
+    if saida:
+        with open(saida, 'a') as f:
+            f.write(f"ativo={'true' if ativo else 'false'}\n")
+
+def check_all_accounts():
+    if IUGU_MODO == "trigger":
+        verificar_trigger()
+        return
+
+    if IUGU_MODO == "merge":
+        try:
+            merge_shards()
+        finally:
+            metricas.exportar()
+        return
+    
+    try:
+        wks_subcontas, sh_balance, wks_IUGU_subacc = conectar_planilhas()
+        writer = SheetWriter(sh_balance)
 
         # Verifica o trigger
         print("Verificando trigger...")
@@ -243,105 +1449,21 @@ def check_all_accounts():
             return
 
         print("Trigger ativo! Iniciando atualização...")
-        update_status(wks_IUGU_subacc, "Atualizando...")
+        update_status(writer, wks_IUGU_subacc, "Atualizando...")
 
-        # Lê as subcontas do Google Sheets
-        df_subcontas = pd.DataFrame(wks_subcontas.get_all_records())
+        # Lê as subcontas do Google Sheets (ou do cache, se a planilha Gateway não mudou)
+        roster = carregar_subcontas(wks_subcontas)
 
-        # Filtra apenas subcontas ativas
-        df_subcontas_ativas = df_subcontas[df_subcontas["NOX"] == "SIM"]
+        # Carrega os cursores da execução anterior
+        cursores.update(load_cursores())
+        print(f"Cursores carregados: {len(cursores)} contas")
 
         # Conecta ao SSH
         ssh_client = connect_ssh()
         
-        # Lista para armazenar resultados
-        resultados = []
-        
-        # Separa contas grandes das normais
-        contas_grandes = df_subcontas_ativas[df_subcontas_ativas["account"].isin(CONTAS_GRANDES)]
-        contas_normais = df_subcontas_ativas[~df_subcontas_ativas["account"].isin(CONTAS_GRANDES)]
-        
-        # Processa primeiro as contas grandes
-        print("\nProcessando contas com muitas transações...")
-        for _, row in contas_grandes.iterrows():
-            token = row["live_token_full"]
-            account = row["account"]
-
-            print(f"\nAccount (grande): {account}")
-            resultado = get_account_balance_large(ssh_client, token, account)
-            
-            if resultado:
-                resultados.append(resultado)
-                print(f"Resultado:")
-                print(f"- Saldo: R$ {resultado['saldo_cents']:,.2f}")
-                print(f"- Total transações: {resultado['transactions_total']}")
-            else:
-                print(f"Conta {account} não retornou dados válidos")
-                resultado = get_account_balance(ssh_client, token, account)
-                if resultado:
-                    resultados.append(resultado)
-                    print(f"Resultado (método alternativo):")
-                    print(f"- Saldo: R$ {resultado['saldo_cents']:,.2f}")
-                    print(f"- Total transações: {resultado['transactions_total']}")
-            
-            sleep(3)  # Pausa entre contas grandes
-        
-        # Processa contas normais em lotes
-        batch_size = 3
-        total_contas = len(contas_normais)
-        
-        for i in range(0, total_contas, batch_size):
-            batch = contas_normais.iloc[i:i+batch_size]
-            print(f"\nProcessando lote {i//batch_size + 1}/{-(-total_contas//batch_size)}")
-            
-            for _, row in batch.iterrows():
-                token = row["live_token_full"]
-                account = row["account"]
-                
-                print(f"Account: {account}")
-                resultado = get_account_balance(ssh_client, token, account)
-                
-                if resultado:
-                    resultados.append(resultado)
-                    print(f"Resultado:")
-                    print(f"- Saldo: R$ {resultado['saldo_cents']:,.2f}")
-                    print(f"- Total transações: {resultado['transactions_total']}")
-                else:
-                    print(f"Conta {account} não retornou dados válidos")
-            
-            if i + batch_size < total_contas:
-                sleep(1)
-        
-        # Cria DataFrame com resultados
-        if resultados:
-            df_resultados = pd.DataFrame(resultados)
-            
-            # Garante a ordem das colunas
-            df_resultados = df_resultados[["Account", "transactions_total", "saldo_cents"]]
-            
-            # Atualiza o Google Sheets
-            tz_br = pytz.timezone('America/Sao_Paulo')
-            rodado = datetime.now(pytz.UTC).astimezone(tz_br).strftime("%Y-%m-%d %H:%M:%S")
-            wks_IUGU_subacc.update_value("A1", f"Última atualização: {rodado}")
-
-            # Exporta para o Google Sheets
-            wks_IUGU_subacc.set_dataframe(
-                df_resultados, 
-                (2,1), 
-                encoding='utf-8', 
-                copy_head=True
-            )
-            
-            print("\nProcessamento concluído!")
-            print(f"Total de contas processadas: {len(resultados)}")
-            print(f"Execução concluída: {rodado}")
-        else:
-            print("\nNenhum resultado válido foi obtido!")
-            wks_IUGU_subacc.update_value("A1", "Erro: Nenhum resultado válido obtido")
-        
-        # Reset do trigger
-        reset_trigger(wks_IUGU_subacc)
+        executar_varredura(ssh_client, writer, wks_IUGU_subacc, roster)
         
+        close_tunnels()
         ssh_client.close()
 
     except Exception as e:
@@ -349,8 +1471,14 @@ def check_all_accounts():
         import traceback
         print(traceback.format_exc())
         if 'ssh_client' in locals():
+            close_tunnels()
             ssh_client.close()
+    finally:
+        metricas.exportar()
 
 if __name__ == "__main__":
     print("Iniciando verificação...")
-    check_all_accounts()
+    if IUGU_DAEMON and IUGU_MODO not in ("merge", "trigger"):
+        executar_daemon()
+    else:
+        check_all_accounts()
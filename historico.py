@@ -0,0 +1,224 @@
+import os
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+import pandas as pd
+from arquivos import escrita_atomica
+from metricas import metricas
+
+# pyarrow é opcional: sem ele o arquivo histórico fica desligado e as abas não são aparadas
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+############# ARQUIVO HISTÓRICO (PARQUET POR DIA) #############
+
+# Diretório do arquivo: <HISTORICO_DIR>/<tabela>/dia=AAAA-MM-DD/dados.parquet
+HISTORICO_DIR = os.getenv('HISTORICO_DIR', "historico")
+
+# Colunas de cada tabela (na ordem das abas), chave natural e coluna de data que define a partição.
+# As linhas de uma mesma chave são deduplicadas mantendo a última gravada.
+TABELAS = {
+    "pagamentos": {
+        "colunas": ["data", "merchant", "provider", "meth", "quantidade", "volume"],
+        "chave": ["data", "merchant", "provider", "meth"],
+        "inteiros": ["quantidade"],
+        "decimais": ["volume"],
+        "data": "data",
+        "formato": "%Y-%m-%d",
+    },
+    "backoffice": {
+        "colunas": ["merchant", "descricao", "valor_total", "data_criacao"],
+        "chave": ["data_criacao", "merchant", "descricao"],
+        "inteiros": [],
+        "decimais": ["valor_total"],
+        "data": "data_criacao",
+        "formato": "%Y-%m-%d %H:%M:%S",
+    },
+}
+
+# Esquema da partição (o dia fica no caminho, não dentro do arquivo)
+PARTICAO = ds.partitioning(pa.schema([("dia", pa.string())]), flavor="hive") if pa else None
+
+# Valores em dinheiro são guardados como decimal com centavos exatos, nunca em float
+CENTAVO = Decimal("0.01")
+TIPO_DECIMAL = pa.decimal128(18, 2) if pa else None
+
+def esquema_arquivo(tabela):
+    """Esquema do Parquet de `tabela` (sem a coluna `dia`, que fica no caminho da partição)."""
+    esquema = TABELAS[tabela]
+    return pa.schema([
+        (coluna, pa.int64() if coluna in esquema["inteiros"]
+         else TIPO_DECIMAL if coluna in esquema["decimais"] else pa.string())
+        for coluna in esquema["colunas"]
+    ])
+
+def disponivel():
+    """Indica se o pyarrow está instalado (sem ele nada é arquivado)."""
+    return pa is not None
+
+def _datas(valores):
+    """Converte datas vindas do banco (datetime ou texto ISO) ou do Sheets (número de série) em datetime.
+
+    O número de série não representa o minuto exato em float; arredondado ao segundo, 23:59 não vira 23:58:59:
+
+    >>> _datas(pd.Series([46312.999305555555, 46312.0, "2026-10-17 23:59:00"])).dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+    ['2026-10-17 23:59:00', '2026-10-17 00:00:00', '2026-10-17 23:59:00']
+    """
+    if pd.api.types.is_datetime64_any_dtype(valores):
+        return valores
+    numericos = valores.map(lambda valor: isinstance(valor, (int, float)) and not isinstance(valor, bool))
+    seriais = pd.to_datetime(
+        pd.to_numeric(valores.where(numericos), errors="coerce"), unit="D", origin="1899-12-30"
+    ).dt.round("s")
+    textos = pd.to_datetime(valores.where(~numericos).astype("string"), errors="coerce", format="ISO8601")
+    return seriais.fillna(textos)
+
+def _decimais(valores):
+    """Converte valores em dinheiro (Decimal do banco, número ou texto do Sheets) em Decimal com centavos.
+
+    Valores inválidos viram None.
+
+    >>> _decimais(pd.Series([Decimal("10.005"), 0.1, "1234.5", "", None])).tolist()
+    [Decimal('10.00'), Decimal('0.10'), Decimal('1234.50'), None, None]
+    """
+    def converter(valor):
+        try:
+            decimal = Decimal(str(valor).strip())
+        except (InvalidOperation, ValueError):
+            return None
+        return decimal.quantize(CENTAVO) if decimal.is_finite() else None
+    return valores.map(converter).astype("object")
+
+def normalizar(tabela, df):
+    """Tipa as colunas da tabela (texto, inteiros e valores em Decimal) e acrescenta a coluna `dia`.
+
+    Aceita tanto os DataFrames das consultas quanto linhas lidas da planilha; linhas sem data válida
+    são descartadas.
+    """
+    esquema = TABELAS[tabela]
+    df = df[esquema["colunas"]].copy()
+
+    datas = _datas(df[esquema["data"]])
+    if datas.isna().any():
+        print(f"Histórico {tabela}: {int(datas.isna().sum())} linhas sem data válida descartadas")
+        df, datas = df[datas.notna()], datas[datas.notna()]
+
+    for coluna in esquema["colunas"]:
+        if coluna in esquema["inteiros"]:
+            df[coluna] = pd.to_numeric(df[coluna], errors="coerce").fillna(0).astype("int64")
+        elif coluna in esquema["decimais"]:
+            df[coluna] = _decimais(df[coluna])
+        elif coluna != esquema["data"]:
+            df[coluna] = df[coluna].astype("string")
+    df[esquema["data"]] = datas.dt.strftime(esquema["formato"])
+    df["dia"] = datas.dt.strftime("%Y-%m-%d")
+    return df
+
+class ArquivoHistorico:
+    """Grava as linhas de cada tabela em um Parquet por dia, deduplicando pela chave natural.
+
+    A partição do dia corrente de cada tabela fica em memória, então o ciclo de um minuto só
+    reescreve um arquivo pequeno (escrita atômica via arquivo temporário).
+    """
+    def __init__(self, diretorio=HISTORICO_DIR):
+        self.diretorio = Path(diretorio)
+        self.particoes = {}  # tabela -> (dia, DataFrame da partição)
+
+    def _caminho(self, tabela, dia):
+        return self.diretorio / tabela / f"dia={dia}" / "dados.parquet"
+
+    def _ler_particao(self, tabela, dia):
+        memoria = self.particoes.get(tabela)
+        if memoria and memoria[0] == dia:
+            return memoria[1]
+        caminho = self._caminho(tabela, dia)
+        if caminho.exists():
+            # Partições gravadas antes dos decimais têm os valores em float
+            existente = pd.read_parquet(caminho)
+            for coluna in TABELAS[tabela]["decimais"]:
+                existente[coluna] = _decimais(existente[coluna])
+            return existente
+        return None
+
+    def arquivar(self, tabela, df):
+        """Incorpora as linhas ao arquivo; retorna quantas linhas foram recebidas."""
+        if pa is None or df is None or df.empty:
+            return 0
+
+        esquema = TABELAS[tabela]
+        with metricas.medir("historico_arquivar_segundos", tabela=tabela):
+            novos = normalizar(tabela, df)
+            for dia, parte in novos.groupby("dia"):
+                parte = parte.drop(columns="dia")
+                existente = self._ler_particao(tabela, dia)
+                if existente is not None:
+                    parte = pd.concat([existente, parte], ignore_index=True)
+                parte = parte.drop_duplicates(esquema["chave"], keep="last").reset_index(drop=True)
+
+                caminho = self._caminho(tabela, dia)
+                caminho.parent.mkdir(parents=True, exist_ok=True)
+                with escrita_atomica(caminho) as tmp_path:
+                    pq.write_table(pa.Table.from_pandas(parte, schema=esquema_arquivo(tabela), preserve_index=False), tmp_path)
+
+                # Só o dia mais recente de cada tabela fica em memória
+                if tabela not in self.particoes or dia >= self.particoes[tabela][0]:
+                    self.particoes[tabela] = (dia, parte)
+        return len(novos)
+
+############# CONSULTAS AO ARQUIVO #############
+
+def ler_historico(tabela, de=None, ate=None, merchant=None, colunas=None, diretorio=HISTORICO_DIR):
+    """Lê o arquivo de `tabela` entre os dias `de` e `ate` (AAAA-MM-DD, inclusive) como tabela do pyarrow.
+
+    Os filtros de dia e de merchant são aplicados na leitura (só as partições do período são abertas).
+    Retorna None se o arquivo ainda não existe.
+    """
+    if pa is None:
+        print("pyarrow não está instalado; o arquivo histórico não está disponível")
+        return None
+
+    base = Path(diretorio) / tabela
+    if not base.exists():
+        return None
+
+    filtro = None
+    for condicao in (
+        ds.field("dia") >= de if de else None,
+        ds.field("dia") <= ate if ate else None,
+        ds.field("merchant") == merchant if merchant else None,
+    ):
+        if condicao is not None:
+            filtro = condicao if filtro is None else filtro & condicao
+
+    # Esquema fixo: partições antigas com valores em float são lidas como decimal
+    esquema = esquema_arquivo(tabela).append(pa.field("dia", pa.string()))
+    dataset = ds.dataset(base, format="parquet", partitioning=PARTICAO, schema=esquema)
+    return dataset.to_table(columns=colunas, filter=filtro)
+
+def volume_diario(merchant=None, de=None, ate=None, diretorio=HISTORICO_DIR):
+    """Quantidade e volume de pagamentos PAID por dia, merchant, provider e método."""
+    tabela = ler_historico("pagamentos", de, ate, merchant,
+                           ["dia", "merchant", "provider", "meth", "quantidade", "volume"], diretorio)
+    if tabela is None:
+        return pd.DataFrame(columns=["dia", "merchant", "provider", "meth", "quantidade", "volume"])
+    agregado = tabela.group_by(["dia", "merchant", "provider", "meth"]).aggregate(
+        [("quantidade", "sum"), ("volume", "sum")]
+    )
+    df = agregado.to_pandas().rename(columns={"quantidade_sum": "quantidade", "volume_sum": "volume"})
+    return df.sort_values(["dia", "merchant", "provider", "meth"]).reset_index(drop=True)
+
+def ajustes_diarios(merchant=None, de=None, ate=None, diretorio=HISTORICO_DIR):
+    """Total e número de minutos com ajustes do backoffice por dia, merchant e descrição."""
+    tabela = ler_historico("backoffice", de, ate, merchant,
+                           ["dia", "merchant", "descricao", "valor_total"], diretorio)
+    if tabela is None:
+        return pd.DataFrame(columns=["dia", "merchant", "descricao", "valor_total", "minutos"])
+    agregado = tabela.group_by(["dia", "merchant", "descricao"]).aggregate(
+        [("valor_total", "sum"), ("valor_total", "count")]
+    )
+    df = agregado.to_pandas().rename(columns={"valor_total_sum": "valor_total", "valor_total_count": "minutos"})
+    return df.sort_values(["dia", "merchant", "descricao"]).reset_index(drop=True)
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from arquivos import escrita_atomica
+
+############# MÉTRICAS DE EXECUÇÃO #############
+
+# Log estruturado (uma linha JSON por medição) e arquivo no formato texto do Prometheus; ambos opcionais
+METRICAS_JSONL = os.getenv('METRICAS_JSONL')
+METRICAS_PROM = os.getenv('METRICAS_PROM')
+
+# Porta do endpoint /metrics (Prometheus) para os processos de longa duração; 0 desliga
+METRICAS_PORTA = int(os.getenv('METRICAS_PORTA', "0"))
+
+# Limites superiores (em segundos) dos buckets dos histogramas de latência
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _rotulos_texto(rotulos):
+    return "{" + ",".join(f"{chave}={valor}" for chave, valor in rotulos) + "}" if rotulos else ""
+
+class Histograma:
+    """Histograma cumulativo no formato do Prometheus (contagem por bucket, soma e total)."""
+    def __init__(self, buckets=BUCKETS_SEGUNDOS):
+        self.buckets = buckets
+        self.contagens = [0] * len(buckets)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.soma += valor
+        self.total += 1
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.contagens[i] += 1
+
+class Metricas:
+    """Registro de histogramas e contadores compartilhado pelas threads de um processo.
+
+    Cada série é identificada pelo nome e pelos rótulos (ex.: transporte="curl").
+    """
+    def __init__(self, arquivo_jsonl=None, arquivo_prom=None):
+        self.arquivo_jsonl = arquivo_jsonl
+        self.arquivo_prom = arquivo_prom
+        self.lock = Lock()
+        self.histogramas = {}  # (nome, rótulos) -> Histograma
+        self.contadores = {}   # (nome, rótulos) -> valor
+        self.acumulados = set()  # (nome, rótulos) dos histogramas sem linha por medição no JSONL
+
+    def observar(self, nome, valor, **rotulos):
+        """Registra um valor (em geral uma latência em segundos) no histograma `nome`."""
+        self._histograma(nome, valor, rotulos)
+        self._registrar({"metrica": nome, "valor": round(valor, 6), **rotulos})
+
+    def acumular(self, nome, valor, **rotulos):
+        """Como `observar`, mas sem linha no JSONL: para medições muito frequentes, que entram
+        no log só como resumo (total e soma) em `exportar`."""
+        chave = self._histograma(nome, valor, rotulos)
+        with self.lock:
+            self.acumulados.add(chave)
+
+    def _histograma(self, nome, valor, rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.lock:
+            if chave not in self.histogramas:
+                self.histogramas[chave] = Histograma()
+            self.histogramas[chave].observar(valor)
+        return chave
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        """Soma `valor` ao contador `nome` (retentativas, bytes, células...)."""
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.lock:
+            self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+    @contextmanager
+    def medir(self, nome, **rotulos):
+        """Mede a duração do bloco; exceções são registradas com o rótulo erro e relançadas."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.observar(nome, time.perf_counter() - inicio, erro=type(e).__name__, **rotulos)
+            raise
+        self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def cronometrado(self, nome, **rotulos):
+        """Decorador que mede cada chamada da função com `medir`."""
+        def decorador(funcao):
+            @wraps(funcao)
+            def envoltorio(*args, **kwargs):
+                with self.medir(nome, **rotulos):
+                    return funcao(*args, **kwargs)
+            return envoltorio
+        return decorador
+
+    def _registrar(self, evento):
+        if not self.arquivo_jsonl:
+            return
+        linha = json.dumps({"ts": round(time.time(), 3), "pid": os.getpid(), **evento}, ensure_ascii=False)
+        with self.lock:
+            with open(self.arquivo_jsonl, "a", encoding="utf-8") as f:
+                f.write(linha + "\n")
+
+    def texto_prometheus(self):
+        """Gera as métricas atuais no formato texto de exposição do Prometheus."""
+        def rotulos_prom(rotulos, extra=()):
+            pares = [f'{chave}="{valor}"' for chave, valor in (*rotulos, *extra)]
+            return "{" + ",".join(pares) + "}" if pares else ""
+
+        linhas = []
+        with self.lock:
+            declarados = set()
+            for (nome, rotulos), hist in sorted(self.histogramas.items()):
+                if nome not in declarados:
+                    linhas.append(f"# TYPE {nome} histogram")
+                    declarados.add(nome)
+                for limite, contagem in zip(hist.buckets, hist.contagens):
+                    linhas.append(f"{nome}_bucket{rotulos_prom(rotulos, [('le', limite)])} {contagem}")
+                linhas.append(f"{nome}_bucket{rotulos_prom(rotulos, [('le', '+Inf')])} {hist.total}")
+                linhas.append(f"{nome}_sum{rotulos_prom(rotulos)} {hist.soma:.6f}")
+                linhas.append(f"{nome}_count{rotulos_prom(rotulos)} {hist.total}")
+            for (nome, rotulos), valor in sorted(self.contadores.items()):
+                if nome not in declarados:
+                    linhas.append(f"# TYPE {nome} counter")
+                    declarados.add(nome)
+                linhas.append(f"{nome}{rotulos_prom(rotulos)} {valor}")
+        return "\n".join(linhas) + "\n"
+
+    def exportar(self):
+        """Grava o arquivo do Prometheus (se configurado) e um resumo dos contadores e dos
+        histogramas acumulados no JSONL."""
+        if self.arquivo_prom:
+            with escrita_atomica(self.arquivo_prom) as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.texto_prometheus())
+        with self.lock:
+            contadores = {
+                nome + _rotulos_texto(rotulos): valor for (nome, rotulos), valor in self.contadores.items()
+            }
+            acumulados = {
+                nome + _rotulos_texto(rotulos): {
+                    "total": self.histogramas[(nome, rotulos)].total,
+                    "soma": round(self.histogramas[(nome, rotulos)].soma, 6),
+                }
+                for nome, rotulos in self.acumulados
+            }
+        if contadores:
+            self._registrar({"metrica": "contadores", "valores": contadores})
+        if acumulados:
+            self._registrar({"metrica": "histogramas", "valores": acumulados})
+
+    def iniciar_servidor(self, porta):
+        """Expõe /metrics em uma thread própria (para o loop contínuo do balances_depuracao)."""
+        registro = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                corpo = registro.texto_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, *args):
+                pass
+
+        servidor = ThreadingHTTPServer(("0.0.0.0", porta), Handler)
+        Thread(target=servidor.serve_forever, daemon=True).start()
+        print(f"Métricas disponíveis em http://0.0.0.0:{porta}/metrics")
+        return servidor
+
+# Registro global do processo
+metricas = Metricas(METRICAS_JSONL, METRICAS_PROM)
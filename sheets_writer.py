@@ -0,0 +1,182 @@
+import pygsheets
+from metricas import metricas
+
+############# ESCRITA EM LOTE NO GOOGLE SHEETS #############
+
+class SheetWriter:
+    """Acumula as escritas de uma planilha e envia só as células alteradas em uma única chamada.
+
+    Mantém um espelho local de cada aba com os valores já escritos; `flush()` compara o que
+    está pendente com o espelho e manda as diferenças em um único values.batchUpdate.
+    Os valores são convertidos para texto, como o `set_dataframe` do pygsheets faz.
+    """
+    def __init__(self, spreadsheet):
+        self.sh = spreadsheet
+        self.espelhos = {}       # título da aba -> {(linha, coluna): valor já escrito}
+        self.pendentes = {}      # título da aba -> {(linha, coluna): valor a escrever}
+        self.proxima_linha = {}  # título da aba -> próxima linha livre para append
+        self.linhas_chave = {}   # título da aba -> {chave: linha} das linhas gravadas via upsert
+
+    def carregar_espelho(self, wks, linhas, inicio=(1, 1)):
+        """Informa valores que já estão na aba (ex.: escritos por uma execução anterior)."""
+        espelho = self.espelhos.setdefault(wks.title, {})
+        for i, linha in enumerate(linhas):
+            for j, valor in enumerate(linha):
+                espelho[(inicio[0] + i, inicio[1] + j)] = str(valor)
+
+    def update_value(self, wks, endereco, valor):
+        """Agenda a escrita de uma célula ('A1' ou (linha, coluna))."""
+        linha, coluna = pygsheets.Address(endereco).index
+        self.pendentes.setdefault(wks.title, {})[(linha, coluna)] = str(valor)
+
+    def set_values(self, wks, inicio, linhas):
+        """Agenda a escrita de uma matriz de valores a partir de `inicio` (linha, coluna)."""
+        pendentes = self.pendentes.setdefault(wks.title, {})
+        for i, linha in enumerate(linhas):
+            for j, valor in enumerate(linha):
+                pendentes[(inicio[0] + i, inicio[1] + j)] = str(valor)
+
+    @staticmethod
+    def linhas_dataframe(df, copy_head=True):
+        """Converte um DataFrame nas linhas de texto que o set_dataframe do pygsheets escreveria."""
+        linhas = df.fillna("NaN").astype(str).values.tolist()
+        if copy_head:
+            linhas.insert(0, [str(coluna) for coluna in df.columns])
+        return linhas
+
+    def set_dataframe(self, wks, df, inicio, copy_head=True):
+        """Agenda a escrita de um DataFrame, no mesmo formato do set_dataframe do pygsheets."""
+        self.set_values(wks, inicio, self.linhas_dataframe(df, copy_head))
+
+    def append_dataframe(self, wks, df, coluna_referencia=9):
+        """Agenda o DataFrame após a última linha preenchida, controlando o offset localmente.
+
+        A aba só é lida uma vez (coluna de referência) para descobrir a primeira linha livre.
+        """
+        if wks.title not in self.proxima_linha:
+            with metricas.medir("sheets_chamada_segundos", operacao="get_col"):
+                coluna = wks.get_col(coluna_referencia, include_tailing_empty=False)
+            self.proxima_linha[wks.title] = len(coluna) + 1
+            print(f"Última linha encontrada em {wks.title}: {self.proxima_linha[wks.title]}")
+
+        linha_inicial = self.proxima_linha[wks.title]
+        self.set_dataframe(wks, df, (linha_inicial, 1), copy_head=False)
+        self.proxima_linha[wks.title] += len(df)
+        return linha_inicial
+
+    def upsert_dataframe(self, wks, df, colunas_chave, coluna_referencia=9):
+        """Reescreve a linha de cada chave já gravada por este writer e faz append das chaves novas."""
+        linhas_chave = self.linhas_chave.setdefault(wks.title, {})
+        linhas = self.linhas_dataframe(df, copy_head=False)
+        chaves = [tuple(chave) for chave in df[colunas_chave].itertuples(index=False)]
+
+        novas = [i for i, chave in enumerate(chaves) if chave not in linhas_chave]
+        if novas:
+            linha_inicial = self.append_dataframe(wks, df.iloc[novas], coluna_referencia)
+            for offset, i in enumerate(novas):
+                linhas_chave[chaves[i]] = linha_inicial + offset
+
+        novas = set(novas)
+        for i, chave in enumerate(chaves):
+            if i not in novas:
+                self.set_values(wks, (linhas_chave[chave], 1), [linhas[i]])
+
+    def remover_linhas(self, wks, inicio, quantidade):
+        """Apaga `quantidade` linhas da aba a partir de `inicio` e desloca o estado local da aba.
+
+        A remoção é enviada na hora (não entra no flush), então não deve haver envio em andamento;
+        espelho, células pendentes, próxima linha livre e linhas do upsert passam a apontar
+        para as novas posições.
+        """
+        with metricas.medir("sheets_chamada_segundos", operacao="delete_rows"):
+            wks.delete_rows(inicio, quantidade)
+        fim = inicio + quantidade
+
+        def deslocar(linha):
+            if linha < inicio:
+                return linha
+            return linha - quantidade if linha >= fim else None
+
+        for celulas in (self.espelhos.get(wks.title), self.pendentes.get(wks.title)):
+            if celulas:
+                deslocadas = {(deslocar(linha), coluna): valor for (linha, coluna), valor in celulas.items()}
+                celulas.clear()
+                celulas.update({celula: valor for celula, valor in deslocadas.items() if celula[0] is not None})
+
+        if wks.title in self.proxima_linha:
+            self.proxima_linha[wks.title] = deslocar(self.proxima_linha[wks.title]) or inicio
+
+        linhas_chave = self.linhas_chave.get(wks.title)
+        if linhas_chave:
+            deslocadas = {chave: deslocar(linha) for chave, linha in linhas_chave.items()}
+            linhas_chave.clear()
+            linhas_chave.update({chave: linha for chave, linha in deslocadas.items() if linha is not None})
+
+    def _ranges_alterados(self, titulo):
+        """Agrupa as células alteradas de uma aba em retângulos (linhas consecutivas com as mesmas colunas)."""
+        espelho = self.espelhos.get(titulo, {})
+        alteradas = {
+            celula: valor for celula, valor in self.pendentes.get(titulo, {}).items()
+            if espelho.get(celula) != valor
+        }
+
+        # Trechos contíguos de colunas alteradas em cada linha
+        colunas_por_linha = {}
+        for linha, coluna in alteradas:
+            colunas_por_linha.setdefault(linha, []).append(coluna)
+
+        trechos = []
+        for linha in sorted(colunas_por_linha):
+            colunas = sorted(colunas_por_linha[linha])
+            inicio = colunas[0]
+            for anterior, coluna in zip(colunas, colunas[1:]):
+                if coluna != anterior + 1:
+                    trechos.append((linha, inicio, anterior))
+                    inicio = coluna
+            trechos.append((linha, inicio, colunas[-1]))
+
+        # Junta trechos de linhas consecutivas que cobrem as mesmas colunas
+        retangulos = []
+        for linha, col_ini, col_fim in trechos:
+            if retangulos:
+                lin_ini, lin_fim, c_ini, c_fim = retangulos[-1]
+                if lin_fim + 1 == linha and (c_ini, c_fim) == (col_ini, col_fim):
+                    retangulos[-1] = (lin_ini, linha, c_ini, c_fim)
+                    continue
+            retangulos.append((linha, linha, col_ini, col_fim))
+
+        return [
+            (retangulo, [[alteradas[(l, c)] for c in range(retangulo[2], retangulo[3] + 1)]
+                         for l in range(retangulo[0], retangulo[1] + 1)])
+            for retangulo in retangulos
+        ], alteradas
+
+    def flush(self):
+        """Envia todas as alterações pendentes em uma única chamada; retorna o número de células escritas."""
+        data = []
+        alteradas_por_aba = {}
+        for titulo in self.pendentes:
+            ranges, alteradas = self._ranges_alterados(titulo)
+            alteradas_por_aba[titulo] = alteradas
+            for (lin_ini, lin_fim, col_ini, col_fim), valores in ranges:
+                inicio = pygsheets.Address((lin_ini, col_ini)).label
+                fim = pygsheets.Address((lin_fim, col_fim)).label
+                data.append({
+                    'dataFilter': {'a1Range': f"'{titulo}'!{inicio}:{fim}"},
+                    'values': valores,
+                    'majorDimension': 'ROWS',
+                })
+
+        total_celulas = sum(len(alteradas) for alteradas in alteradas_por_aba.values())
+        if data:
+            with metricas.medir("sheets_chamada_segundos", operacao="batch_update"):
+                self.sh.client.sheet.values_batch_update_by_data_filter(self.sh.id, data)
+            metricas.incrementar("sheets_celulas_enviadas_total", total_celulas)
+
+        # Só atualiza o espelho depois que a escrita deu certo; em caso de erro, tudo continua pendente
+        for titulo, alteradas in alteradas_por_aba.items():
+            self.espelhos.setdefault(titulo, {}).update(alteradas)
+        self.pendentes = {}
+
+        print(f"✓ Google Sheets: {total_celulas} células alteradas enviadas em {len(data)} intervalos")
+        return total_celulas
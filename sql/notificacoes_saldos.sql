@@ -0,0 +1,41 @@
+-- Triggers do modo por eventos de balances_depuracao.py (MODO_EVENTOS=1).
+--
+-- Cada alteração relevante envia um pg_notify no canal nox_saldos com a tabela e o merchant afetado:
+--   {"tabela": "core_payment", "merchant_id": 123}
+-- As notificações só são entregues após o commit da transação.
+
+CREATE OR REPLACE FUNCTION public.notificar_nox_saldos() RETURNS trigger AS $$
+DECLARE
+    payload JSON;
+BEGIN
+    -- O id é repassado com o tipo original da coluna
+    IF TG_TABLE_NAME = 'core_merchant' THEN
+        payload := json_build_object('tabela', TG_TABLE_NAME, 'merchant_id', NEW.id);
+    ELSE
+        payload := json_build_object('tabela', TG_TABLE_NAME, 'merchant_id', NEW.merchant_id);
+    END IF;
+
+    PERFORM pg_notify('nox_saldos', payload::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Pagamentos novos e mudanças de status (ex.: PAID, REFUNDED)
+DROP TRIGGER IF EXISTS nox_saldos_core_payment ON public.core_payment;
+CREATE TRIGGER nox_saldos_core_payment
+    AFTER INSERT OR UPDATE OF status_text, amount_decimal ON public.core_payment
+    FOR EACH ROW EXECUTE FUNCTION public.notificar_nox_saldos();
+
+-- Ajustes do backoffice
+DROP TRIGGER IF EXISTS nox_saldos_core_backofficetrasactions ON public.core_backofficetrasactions;
+CREATE TRIGGER nox_saldos_core_backofficetrasactions
+    AFTER INSERT OR UPDATE ON public.core_backofficetrasactions
+    FOR EACH ROW EXECUTE FUNCTION public.notificar_nox_saldos();
+
+-- Saldo do merchant
+DROP TRIGGER IF EXISTS nox_saldos_core_merchant ON public.core_merchant;
+CREATE TRIGGER nox_saldos_core_merchant
+    AFTER UPDATE OF balance_decimal ON public.core_merchant
+    FOR EACH ROW
+    WHEN (OLD.balance_decimal IS DISTINCT FROM NEW.balance_decimal)
+    EXECUTE FUNCTION public.notificar_nox_saldos();